@@ -5,6 +5,7 @@ Code for converting ocean drifter data from Schaub's format to ours.
 """
 
 import h5py
+import networkx as nx
 from trajectory_analysis.synthetic_data_gen import *
 
 dataset_folder = 'buoy'
@@ -44,12 +45,11 @@ G.add_edges_from([(edge_list[0][i], edge_list[1][i]) for i in range(len(edge_lis
 V, E = np.array(sorted(G.nodes)), np.array([sorted(x) for x in sorted(G.edges)])
 faces = np.array(sorted([[face_list[j][i] for j in range(3)] for i in range(len(face_list[0]))]))
 
-edge_to_idx = {tuple(e): i for i, e in enumerate(E)}
 coords = hex_coords
 valid_idxs = np.arange(len(coords))
 
 # B1, B2
-B1, B2 = incidence_matrices(G, V, E, faces, edge_to_idx)
+B1, B2 = sparse_incidence_matrices(len(V), E, faces)
 
 # Trajectories
 G_undir = G.to_undirected()
@@ -64,7 +64,7 @@ print('# paths: {}, # paths with prefix length >= 3: {}'.format(len(traj_nodes),
 rev_paths = [path[::-1] for path in paths]
 
 # Save graph image to file
-color_faces(G, V, coords, faces_from_B2(B2, E), filename='madagascar_graph_faces_paths.pdf', paths=[paths[1], paths[48], paths[125]])
+color_faces(G, V, coords, faces, filename='madagascar_graph_faces_paths.pdf', paths=[paths[1], paths[48], paths[125]])
 
 # train / test masks
 np.random.seed(1)
@@ -76,19 +76,13 @@ max_degree = np.max([deg for n, deg in G_undir.degree()])
 
 ## Consolidate dataset
 
-# forward
-prefix_flows_1hop, targets_1hop, last_nodes_1hop, suffixes_1hop, \
-    prefix_flows_2hop, targets_2hop, last_nodes_2hop, suffixes_2hop = path_dataset(G_undir, E, edge_to_idx,
-                                                                                paths, max_degree, include_2hop=True,
-                                                                                truncate_paths=False)
-
-
-# reversed
-rev_prefix_flows_1hop, rev_targets_1hop, rev_last_nodes_1hop, rev_suffixes_1hop, \
-    rev_prefix_flows_2hop, rev_targets_2hop, rev_last_nodes_2hop, rev_suffixes_2hop = path_dataset(G_undir, E, edge_to_idx,
-                                                                                                rev_paths, max_degree,
-                                                                                                include_2hop=True,
-                                                                                                truncate_paths=False)
+# forward + reversed
+(prefix_flows_1hop, targets_1hop, last_nodes_1hop, suffixes_1hop,
+ prefix_flows_2hop, targets_2hop, last_nodes_2hop, suffixes_2hop), \
+    (rev_prefix_flows_1hop, rev_targets_1hop, rev_last_nodes_1hop, rev_suffixes_1hop,
+     rev_prefix_flows_2hop, rev_targets_2hop, rev_last_nodes_2hop, rev_suffixes_2hop) = path_datasets(E, [paths, rev_paths], max_degree,
+                                                                                                    include_2hop=True,
+                                                                                                    truncate_paths=False)
 
 dataset_1hop = [prefix_flows_1hop, B1, B2, targets_1hop, train_mask, test_mask, G_undir, last_nodes_1hop,
                 suffixes_1hop, rev_prefix_flows_1hop, rev_targets_1hop, rev_last_nodes_1hop, rev_suffixes_1hop]
@@ -121,6 +115,12 @@ for arr_1hop, arr_2hop, filename in zip(dataset_1hop, dataset_2hop, filenames):
     if filename == 'G_undir':
         nx.readwrite.gpickle.write_gpickle(G_undir, os.path.join(folder_1hop, filename + '.pkl'))
         nx.readwrite.gpickle.write_gpickle(G_undir, os.path.join(folder_2hop, filename + '.pkl'))
+    elif filename in ('B1', 'B2'):
+        save_incidence(os.path.join(folder_1hop, filename), arr_1hop)
+        save_incidence(os.path.join(folder_2hop, filename), arr_2hop)
+    elif filename in ('flows_in', 'rev_flows_in'):
+        save_flows(os.path.join(folder_1hop, filename), arr_1hop)
+        save_flows(os.path.join(folder_2hop, filename), arr_2hop)
     else:
         np.save(os.path.join(folder_1hop, filename + '.npy'), arr_1hop)
         np.save(os.path.join(folder_2hop, filename + '.npy'), arr_2hop)
@@ -133,4 +133,5 @@ for path in paths:
         edge = tuple(sorted(path[i-1:i+1]))
         edge_set.add(edge)
 
-np.save(folder_1hop + '/prefixes.npy', [path[:-2] for path in paths])
+# ragged, so saved as an object array (loaded with allow_pickle, see data_setup)
+np.save(folder_1hop + '/prefixes.npy', np.array([path[:-2] for path in paths], dtype=object))
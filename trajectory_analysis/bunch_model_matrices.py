@@ -8,37 +8,7 @@ norm_L1 = D2 B1.T D1.inv + B2 D3 B2.T D2.inv
 """
 import numpy as np
 from numpy.linalg import inv, pinv
-from synthetic_data_gen import load_dataset, incidence_matrices
-
-
-def get_faces(G):
-    """
-    Returns a list of the faces in an undirected graph
-    """
-    edges = list(G.edges)
-    faces = []
-    for i in range(len(edges)):
-        for j in range(i + 1, len(edges)):
-            e1 = edges[i]
-            e2 = edges[j]
-            if e1[0] == e2[0]:
-                shared = e1[0]
-                e3 = (e1[1], e2[1])
-            elif e1[1] == e2[0]:
-                shared = e1[1]
-                e3 = (e1[0], e2[1])
-            elif e1[0] == e2[1]:
-                shared = e1[0]
-                e3 = (e1[1], e2[0])
-            elif e1[1] == e2[1]:
-                shared = e1[1]
-                e3 = (e1[0], e2[0])
-            else:  # edges don't connect
-                continue
-
-            if e3[0] in G[e3[1]]:  # if 3rd edge is in graph
-                faces.append(tuple(sorted((shared, *e3))))
-    return list(sorted(set(faces)))
+from synthetic_data_gen import load_dataset, graph_incidence_matrices
 
 
 def compute_D2(B):
@@ -139,9 +109,7 @@ def compute_norm_L1(G):
     """
     Computes the normalized Laplacian matrix
     """
-    edge_to_idx = {edge: i for i, edge in enumerate(G.edges)}
-
-    B1, B2 = incidence_matrices(G, sorted(G.nodes), sorted(G.edges), get_faces(G), edge_to_idx)
+    B1, B2 = [B.toarray() for B in graph_incidence_matrices(G)]  # the normalization is computed densely
     D2 = compute_D2(B2)
     D1 = compute_D1(B1, D2)
 
@@ -159,10 +127,7 @@ if __name__ == '__main__':
     folder_suffix = 'schaub2'
     folder = 'trajectory_data_1hop_' + folder_suffix
 
-    G = load_dataset(folder)[5]
-    edge_to_idx = {edge: i for i, edge in enumerate(G.edges)}
-
-    B1, B2 = incidence_matrices(G, sorted(G.nodes), sorted(G.edges), get_faces(G), edge_to_idx)
+    B1, B2 = [B.toarray() for B in load_dataset(folder)[1]]
 
 
     compute_bunch_matrices(B1, B2)
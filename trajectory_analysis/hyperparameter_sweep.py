@@ -0,0 +1,269 @@
+"""
+Hyperparameter sweeps: trains + evaluates one model per configuration of a grid or random search, in parallel worker
+    processes.
+
+The dataset and shift operators are prepared once: data_setup runs in the main process, and its model inputs + the shift
+    operators of every model in the sweep are written to one memory-mappable file (sweep_dir/inputs.sweep, see
+    model_artifact.py). Each worker process maps that file once, then trains configurations one after the other. With
+    more than one worker, XLA's multi-threaded Eigen kernels are turned off in each worker (if the installed jaxlib
+    still has that flag, see xla_flag_supported), so that workers don't oversubscribe the cores. No parallel speedup is
+    claimed: the sweep has only been timed on a 1-core machine, where more workers only add contention (4 'scone'
+    configurations, 20 epochs, 400-node graph: 645s with 1 worker, 819s with 4, same results).
+    Combinations of SCNN orders that the model ignores or fixes ('scnn2', 'scnn3', 'scnn4') are trained once.
+    Results are collected into one table, written to sweep_dir/results.csv and printed (best test accuracy first).
+
+Run (base arguments as for trajectory_experiments.py; a comma-separated list of values for any of SWEEP_PARAMS sweeps
+    over it):
+    python3 hyperparameter_sweep.py -data_folder_suffix suffix_here -epochs 100 -model scone,scnn3
+        -learning_rate 0.001,0.0003 -hidden_layers 3_16_3_16,3_32_3_32 -workers 8
+
+Sweep arguments + default values:
+   'search': 'grid'; 'grid' (every combination of the swept values) or 'random' (n_configs distinct combinations, sampled
+        uniformly)
+   'n_configs': 10; # of configurations of a random search
+   'workers': 0; # of worker processes; 0 uses one per CPU core
+   'seed': 0; seed of the random search; configuration i initializes its weights with seed + i
+   'sweep_dir': ''; directory for inputs.sweep + results.csv; '' uses sweeps/model_name
+"""
+import os, sys, csv, time, itertools, subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as onp
+import jax.numpy as np
+
+try:
+    from trajectory_analysis.trajectory_experiments import HYPERPARAMS, configure, hyperparams, model_params, data_setup, model_shifts, \
+        edge_flips, shared_input, build_model, shift_arrays, load_shifts
+    from trajectory_analysis.model_artifact import save_artifact, load_artifact
+    from trajectory_analysis.synthetic_data_gen import load_incidence
+except Exception:
+    from trajectory_experiments import HYPERPARAMS, configure, hyperparams, model_params, data_setup, model_shifts, \
+        edge_flips, shared_input, build_model, shift_arrays, load_shifts
+    from model_artifact import save_artifact, load_artifact
+    from synthetic_data_gen import load_incidence
+
+# hyperparameters that can be swept over
+SWEEP_PARAMS = ['model', 'hidden_layers', 'learning_rate', 'weight_decay', 'k1_scnn', 'k2_scnn', 'batch_size']
+SWEEP_ARGS = {'search': 'grid', 'n_configs': 10, 'workers': 0, 'seed': 0, 'sweep_dir': ''}
+METRICS = ['train_loss', 'train_acc', 'test_loss', 'test_acc', 'seconds']
+
+# per worker process: the mapped arrays + metadata of the prepared inputs (see init_worker)
+WORKER = {}
+# keeps each worker's XLA kernels single-threaded, so that concurrent workers don't oversubscribe the cores
+WORKER_XLA_FLAG = '--xla_cpu_multi_thread_eigen=false'
+
+
+def parse_args(args):
+    """
+    Splits command line args into (base args for configure, search space: dict of swept param -> list of values,
+        sweep args: SWEEP_ARGS updated with the parsed values)
+    """
+    base, space, sweep_args = args[:1], {}, dict(SWEEP_ARGS)
+    i = 1
+    while i < len(args) - 1:
+        key, value = args[i][1:], args[i + 1]
+        if key in SWEEP_ARGS:
+            sweep_args[key] = type(SWEEP_ARGS[key])(value)
+        elif key in SWEEP_PARAMS and ',' in value:
+            # parse each value like a single command line argument
+            space[key] = [hyperparams(['-' + key, v])[key] for v in value.split(',')]
+        else:
+            base += args[i:i + 2]
+        i += 2
+    return base, space, sweep_args
+
+def effective_config(config, model):
+    """
+    Returns config with the SCNN filter orders training actually uses: the ones fixed by 'scnn2', 'scnn3' + 'scnn4' (see
+        model_params), and none for models without SCNN filters
+
+    :param model: the model of configurations that don't sweep over it
+    """
+    config = dict(config)
+    model = config.get('model', model)
+    for key in ('k1_scnn', 'k2_scnn'):
+        if key in config:
+            if not model.startswith('scnn'):
+                del config[key]
+            elif model != 'scnn':
+                config[key] = int(model[-1])
+    return config
+
+def sweep_configs(space, search='grid', n_configs=10, seed=0, model=None):
+    """
+    Returns the configurations (dicts of param -> value) of a grid or random search over space (dict of param -> list of
+        values); a random search samples n_configs distinct combinations. Combinations that only differ in SCNN orders a
+        model ignores or overrides are trained once (see effective_config)
+
+    :param model: the model of configurations that don't sweep over it (HYPERPARAMS['model'] by default)
+    """
+    keys = sorted(space)
+    configs = []
+    for values in itertools.product(*[space[key] for key in keys]):
+        config = effective_config(dict(zip(keys, values)), model or HYPERPARAMS['model'])
+        if config not in configs:
+            configs.append(config)
+    if search == 'random':
+        picks = onp.random.RandomState(seed).choice(len(configs), min(int(n_configs), len(configs)), replace=False)
+        configs = [configs[i] for i in sorted(picks)]
+    elif search != 'grid':
+        raise ValueError("search must be 'grid' or 'random'")
+    return configs
+
+def operator_family(model):
+    """
+    Returns the name of the shift operators model uses; 'scone' and the SCNN models share the Hodge Laplacians
+    """
+    return 'hodge' if model == 'scone' or model.startswith('scnn') else model
+
+def prepare(filename, models):
+    """
+    Runs data_setup once (for HYPERPARAMS), then writes its model inputs + the shift operators of each model in models to
+        the memory-mappable file filename
+    """
+    inputs_all, y_all, train_mask, test_mask, shifts, _, _, nbrhoods, n_nbrs, _, _, tables = \
+        data_setup(hops=(1,), load=HYPERPARAMS['load_data'], folder_suffix=HYPERPARAMS['data_folder_suffix'])
+    _, last_nodes, flows = inputs_all[0]
+    arrays = {'last_nodes': onp.asarray(last_nodes), 'y': onp.asarray(y_all[0]), 'train_mask': onp.asarray(train_mask),
+              'test_mask': onp.asarray(test_mask), 'n_nbrs': onp.asarray(n_nbrs), 'nbrhoods': onp.asarray(nbrhoods),
+              'node_edges': onp.asarray(tables['node_edges']), 'node_signs': onp.asarray(tables['node_signs'])}
+    if isinstance(flows, tuple):
+        arrays['flow_edges'], arrays['flow_signs'] = onp.asarray(flows[0]), onp.asarray(flows[1])
+    else:
+        arrays['flows'] = onp.asarray(flows)
+
+    # the shifts of other models are computed from the raw incidence matrices, flipped like data_setup's
+    folder = 'trajectory_data_1hop_' + HYPERPARAMS['data_folder_suffix']
+    B1, B2 = load_incidence(folder + '/B1'), load_incidence(folder + '/B2')
+    flips = edge_flips(B1.shape[1]) if HYPERPARAMS['flip_edges'] else None
+    families = {operator_family(HYPERPARAMS['model']): shifts}
+    for model in models:
+        if operator_family(model) not in families:
+            families[operator_family(model)] = model_shifts(B1, B2, model=model, flips=flips)
+
+    meta = {'shifts': {family: shift_arrays(family_shifts, arrays, prefix=family) for family, family_shifts in families.items()}}
+    save_artifact(filename, arrays, meta)
+
+def xla_flags_with(flags):
+    """
+    Returns XLA_FLAGS with flags appended; XLA reads a value that doesn't start with '--' (even ' ') as a file of flags
+    """
+    return ' '.join(filter(None, [os.environ.get('XLA_FLAGS', '').strip(), flags.strip()]))
+
+def xla_flag_supported(flag):
+    """
+    Returns whether the installed jaxlib accepts XLA flag flag; XLA aborts the process on an unknown flag in XLA_FLAGS,
+        so this starts jax's backend once in a subprocess with it
+    """
+    env = dict(os.environ, XLA_FLAGS=xla_flags_with(flag))
+    return subprocess.run([sys.executable, '-c', 'import jax; jax.devices()'], env=env, capture_output=True).returncode == 0
+
+def init_worker(base_args, filename, xla_flags=''):
+    """
+    Sets up a worker process: adds xla_flags to XLA_FLAGS, parses the base arguments and maps the prepared inputs
+    """
+    # before jax initializes its backend in this process
+    if xla_flags:
+        os.environ['XLA_FLAGS'] = xla_flags_with(xla_flags)
+    configure(base_args)
+    arrays, meta = load_artifact(filename)
+    WORKER.update(arrays=arrays, meta=meta)
+
+def run_config(index, config, seed):
+    """
+    Trains + evaluates the model of config (HYPERPARAMS updated with config) on the prepared inputs; returns a dict of
+        config, its index, METRICS, and the error message if it failed
+    """
+    arrays, meta = WORKER['arrays'], WORKER['meta']
+    params = model_params(dict(HYPERPARAMS, **config))
+    start = time.perf_counter()
+    try:
+        family = operator_family(params['model'])
+        shifts = load_shifts(arrays, meta['shifts'][family], prefix=family)
+        nbrhoods = np.asarray(arrays['nbrhoods'])
+        tables = {'node_edges': np.asarray(arrays['node_edges']), 'node_signs': np.asarray(arrays['node_signs'])}
+        flows = (onp.asarray(arrays['flow_edges']), onp.asarray(arrays['flow_signs'])) if 'flow_edges' in arrays else onp.asarray(arrays['flows'])
+        inputs = [shared_input(nbrhoods, tables, model=params['model']), onp.asarray(arrays['last_nodes']), flows]
+        y, train_mask, test_mask = onp.asarray(arrays['y']), onp.asarray(arrays['train_mask']), onp.asarray(arrays['test_mask'])
+
+        onp.random.seed(seed)
+        scone = build_model(shifts, inputs, y, train_mask, params=params)
+        scone.verbose = False
+        train_loss, train_acc, test_loss, test_acc = scone.train(inputs, y, train_mask, test_mask, onp.asarray(arrays['n_nbrs']),
+                                                                 scan_epochs=params['scan_epochs'])
+        result = {'train_loss': train_loss, 'train_acc': train_acc, 'test_loss': test_loss, 'test_acc': test_acc}
+    except Exception as e:
+        result = {'error': '{}: {}'.format(type(e).__name__, e)}
+    return dict(config, index=index, seconds=time.perf_counter() - start, **result)
+
+def run_sweep(configs, base_args, filename, workers, seed=0):
+    """
+    Runs every configuration in a pool of workers sharing the prepared inputs in filename; returns their results, in
+        order of configs
+    """
+    results, xla_flags = [], ''
+    if workers > 1:
+        if xla_flag_supported(WORKER_XLA_FLAG):
+            xla_flags = WORKER_XLA_FLAG
+        else:
+            print('jaxlib does not accept {}; workers keep multi-threaded kernels'.format(WORKER_XLA_FLAG))
+    context = multiprocessing.get_context('spawn')  # forking a process that already runs jax is unsafe
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker, initargs=(base_args, filename, xla_flags)) as pool:
+        futures = [pool.submit(run_config, i, config, seed + i) for i, config in enumerate(configs)]
+        for future in as_completed(futures):
+            results.append(future.result())
+            print('{}/{} done: {}'.format(len(results), len(configs), format_row(results[-1])))
+    return sorted(results, key=lambda result: result['index'])
+
+def format_value(value):
+    """
+    Returns value as a table cell; hidden layers are written like on the command line (3_16_3_16)
+    """
+    if isinstance(value, list):
+        return '_'.join(str(n) for layer in value for n in layer)
+    if isinstance(value, float):
+        return '{:.6g}'.format(value)
+    return str(value)
+
+def format_row(result):
+    return ', '.join('{}={}'.format(key, format_value(value)) for key, value in result.items() if key != 'index')
+
+def write_results(filename, results, keys):
+    """
+    Writes results to a csv table with columns index, keys (the swept params), METRICS and error
+    """
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['index'] + keys + METRICS + ['error'])
+        for result in results:
+            writer.writerow([format_value(result.get(key, '')) for key in ['index'] + keys + METRICS + ['error']])
+
+def print_results(results, keys):
+    """
+    Prints results as a table, best test accuracy first (failed configurations last)
+    """
+    columns = ['index'] + keys + METRICS
+    rows = [[format_value(result.get(key, '')) for key in columns] + [result.get('error', '')]
+            for result in sorted(results, key=lambda result: -result.get('test_acc', -1))]
+    widths = [max(len(str(cell)) for cell in column) for column in zip(columns + ['error'], *rows)]
+    for row in [columns + ['error']] + rows:
+        print('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+if __name__ == '__main__':
+    base_args, space, sweep_args = parse_args(sys.argv)
+    configure(base_args)
+    configs = sweep_configs(space, sweep_args['search'], sweep_args['n_configs'], sweep_args['seed'])
+    models = sorted(set(config.get('model', HYPERPARAMS['model']) for config in configs))
+
+    sweep_dir = sweep_args['sweep_dir'] or os.path.join('sweeps', HYPERPARAMS['model_name'])
+    os.makedirs(sweep_dir, exist_ok=True)
+    start = time.perf_counter()
+    prepare(os.path.join(sweep_dir, 'inputs.sweep'), models)
+    print('Prepared inputs in {:.1f}s; running {} configurations'.format(time.perf_counter() - start, len(configs)))
+
+    results = run_sweep(configs, base_args, os.path.join(sweep_dir, 'inputs.sweep'),
+                        sweep_args['workers'] or os.cpu_count(), seed=sweep_args['seed'])
+    write_results(os.path.join(sweep_dir, 'results.csv'), results, sorted(space))
+    print('Sweep done in {:.1f}s; results in {}'.format(time.perf_counter() - start, os.path.join(sweep_dir, 'results.csv')))
+    print_results(results, sorted(space))
@@ -0,0 +1,66 @@
+"""
+Import-time benchmark: how long importing each module of this package takes in a fresh Python process (like the
+    short-lived worker processes that load a model), and which heavy dependencies the import pulls in. Importing a
+    module should have no side effects and should not load networkx, matplotlib or pandas; those are only imported by
+    the functions that generate, plot or export datasets.
+
+Run:
+    python3 import_benchmark.py [-repeats 5] [-modules trajectory_experiments,inference_server] [-top 5]
+
+Prints, for each module, the median wall time of `import module` over repeats fresh processes, the heavy dependencies
+    it loaded, and its top slowest imports (cumulative time, from python -X importtime)
+"""
+import os, sys, subprocess
+import statistics
+
+MODULES = ['sparse_shifts', 'model_artifact', 'synthetic_data_gen', 'scone_trajectory_model', 'streaming_predictor',
+           'trajectory_experiments', 'inference_server']
+HEAVY = ['networkx', 'matplotlib', 'pandas', 'treelib']
+
+# prints the import time, then the heavy dependencies that were loaded
+SNIPPET = 'import sys, time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start); ' \
+          'print(",".join(m for m in {heavy} if m in sys.modules))'
+
+
+def import_time(module, repeats=5):
+    """
+    Returns the median time (s) of importing module in repeats fresh processes + the heavy dependencies it loaded
+    """
+    times, heavy = [], ''
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', SNIPPET.format(module=module, heavy=HEAVY)], capture_output=True,
+                             text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split('\n')
+        times.append(float(out[0]))
+        heavy = out[1]
+    return statistics.median(times), heavy.split(',') if heavy else []
+
+def slowest_imports(module, top=5):
+    """
+    Returns the top slowest (cumulative time (s), name) imports of importing module, from python -X importtime
+    """
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], capture_output=True, text=True,
+                         check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+    imports = []
+    for line in err.split('\n'):
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]) / 1e6, fields[2].rstrip()))
+    # direct imports of module only (nested ones are indented further)
+    imports = [(t, name.strip()) for t, name in imports if len(name) - len(name.lstrip()) == 3]
+    return sorted(imports, reverse=True)[:top]
+
+
+if __name__ == '__main__':
+    args = {'repeats': 5, 'modules': MODULES, 'top': 5}
+    for i in range(len(sys.argv) - 1):
+        if sys.argv[i] == '-modules':
+            args['modules'] = sys.argv[i + 1].split(',')
+        elif sys.argv[i] in ('-repeats', '-top'):
+            args[sys.argv[i][1:]] = int(sys.argv[i + 1])
+
+    for module in args['modules']:
+        seconds, heavy = import_time(module, args['repeats'])
+        print('{}: {:.3f}s{}'.format(module, seconds, '; loads ' + ', '.join(heavy) if heavy else ''))
+        for t, name in slowest_imports(module, args['top']):
+            print('    {:.3f}s {}'.format(t, name))
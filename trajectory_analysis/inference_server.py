@@ -0,0 +1,283 @@
+"""
+Local inference server: serves next-node predictions of a trained model over HTTP, on localhost or a Unix socket.
+
+The model is loaded once at startup, from its artifact (models/model_name_model_epochs.scone, written by
+    trajectory_experiments.py; see save_model) if it exists, else from its weights (.npy) + dataset. Concurrent
+    requests are coalesced into batched forward passes: a batch is run as soon as it has max_batch requests, or
+    max_wait_ms after its first request arrived, whichever comes first. Batches are padded to powers of 2, so only a
+    handful of batch shapes are ever compiled (all of them at startup, or loaded from the persistent compilation cache
+    set by -compile_cache; see enable_compile_cache in trajectory_experiments.py).
+
+Run (same model arguments as trajectory_experiments.py, plus the server arguments below):
+    python3 inference_server.py -model_name tanh -model scone -epochs 1000 -data_folder_suffix suffix_here
+
+Server arguments + default values:
+   'host': '127.0.0.1'; address to listen on
+   'port': 8765; TCP port to listen on
+   'socket': ''; if set, listen on this Unix socket path instead of host:port
+   'max_batch': 64; max # of requests per forward pass
+   'max_wait_ms': 5; max time a request waits for other requests to batch with
+
+Requests: POST /predict with a JSON body, either
+    {"path": [n_0, n_1, ..., n_last]}: the trajectory so far, as a list of nodes
+    {"edges": [...], "signs": [...], "last_node": n}: its flow, as the indices of the traversed edges + their +-1
+        orientations (see path_to_sparse_flow in synthetic_data_gen.py)
+Response: {"last_node": n, "nbrs": [...], "probs": [...]}, the probability of each neighbor of n being next
+GET /health returns {"status": "ok"}.
+
+Everything runs offline; from Python, use request(address, payload) to query a running server, e.g.
+    request(('127.0.0.1', 8765), {'path': [3, 7, 12]}) or request('/tmp/scone.sock', {'path': [3, 7, 12]})
+"""
+import os, json, time, queue, socket, threading
+import http.client
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import numpy as onp
+
+try:
+    from trajectory_analysis.trajectory_experiments import HYPERPARAMS, data_setup, build_model, load_weights, artifact_file, load_model, configure
+    from trajectory_analysis.scone_trajectory_model import bucket
+except Exception:
+    from trajectory_experiments import HYPERPARAMS, data_setup, build_model, load_weights, artifact_file, load_model, configure
+    from scone_trajectory_model import bucket
+
+
+class Batcher():
+    def __init__(self, predict_batch, max_batch=64, max_wait=0.005):
+        """
+        Coalesces requests submitted from any thread into batches, run by one worker thread
+
+        :param predict_batch: function mapping a list of requests to a list of results
+        :param max_batch: max # of requests per batch
+        :param max_wait: max time (s) between the first request of a batch arriving and the batch being run
+        """
+        self.predict_batch = predict_batch
+        self.max_batch = int(max_batch)
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request):
+        """
+        Queues request; returns a Future of its result
+        """
+        future = Future()
+        self.requests.put((time.monotonic(), request, future))
+        return future
+
+    def run(self):
+        while True:
+            arrival, request, future = self.requests.get()
+            batch = [(request, future)]
+            deadline = arrival + self.max_wait
+            # take whatever is already queued, waiting for more only until the deadline
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0))[1:])
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.predict_batch([r for r, _ in batch])
+            except Exception as e:
+                for _, f in batch:
+                    f.set_exception(e)
+            else:
+                for (_, f), result in zip(batch, results):
+                    f.set_result(result)
+
+
+class Predictor():
+    def __init__(self, scone, shifts, shared_inputs, nbrhoods, nbr_edges, nbr_signs, n_edges, sparse_flows=False):
+        """
+        Turns requests into model inputs + model outputs into next-node distributions
+
+        :param scone: Scone_GCN with loaded weights
+        :param shared_inputs: model inputs shared by every sample (everything before last nodes + flows)
+        :param nbrhoods: padded (# nodes, max degree) neighbor table, padded with -1
+        :param nbr_edges, nbr_signs: (node, neighbor slot) -> (edge, flow value) tables (see neighbor_edge_tables)
+        :param sparse_flows: whether the model takes sparse (edge indices, signs) flows instead of dense ones
+        """
+        self.scone, self.shifts, self.shared_inputs = scone, shifts, list(shared_inputs)
+        self.nbrhoods, self.nbr_edges, self.nbr_signs = onp.asarray(nbrhoods), onp.asarray(nbr_edges), onp.asarray(nbr_signs)
+        self.n_edges = n_edges
+        self.sparse_flows = sparse_flows
+
+    def parse(self, payload):
+        """
+        Returns (last node, edge indices, signs) of a request payload; raises ValueError if it is invalid
+        """
+        if 'path' in payload:
+            path = [int(n) for n in payload['path']]
+            if len(path) == 0:
+                raise ValueError('empty path')
+            edges, signs = [], []
+            for u, v in zip(path[:-1], path[1:]):
+                slot = onp.nonzero(self.nbrhoods[u] == v)[0] if 0 <= u < len(self.nbrhoods) else []
+                if len(slot) == 0:
+                    raise ValueError('{} is not a neighbor of {}'.format(v, u))
+                edges.append(self.nbr_edges[u, slot[0]])
+                signs.append(self.nbr_signs[u, slot[0]])
+            last_node = path[-1]
+        else:
+            edges, signs, last_node = payload['edges'], payload['signs'], int(payload['last_node'])
+            if len(edges) != len(signs):
+                raise ValueError('edges and signs must have the same length')
+        if not 0 <= last_node < len(self.nbrhoods):
+            raise ValueError('invalid node {}'.format(last_node))
+        edges, signs = onp.asarray(edges, dtype=int), onp.asarray(signs, dtype=onp.float32)
+        if onp.any((edges < 0) | (edges >= self.n_edges)):
+            raise ValueError('invalid edge index')
+        if onp.any(onp.abs(signs) != 1):
+            raise ValueError('signs must be 1 or -1')
+        return last_node, edges, signs
+
+    def predict_batch(self, requests):
+        """
+        Runs one forward pass over a list of parsed requests; returns the next-node distribution of each
+        """
+        n = bucket(len(requests))
+        last_nodes = onp.zeros(n, dtype=int)
+        last_nodes[:len(requests)] = [r[0] for r in requests]
+        if self.sparse_flows:
+            length = bucket(max(len(r[1]) for r in requests))
+            flows = (onp.zeros((n, length), dtype=onp.int32), onp.zeros((n, length), dtype=onp.float32))
+            for i, (_, edges, signs) in enumerate(requests):
+                flows[0][i, :len(edges)], flows[1][i, :len(signs)] = edges, signs
+        else:
+            flows = onp.zeros((n, self.n_edges, 1), dtype=onp.float32)
+            for i, (_, edges, signs) in enumerate(requests):
+                onp.add.at(flows[i, :, 0], edges, signs)
+
+        log_probs = onp.asarray(self.scone.predict(self.shifts, self.shared_inputs + [last_nodes, flows]))[..., 0]
+        results = []
+        for i, (last_node, _, _) in enumerate(requests):
+            valid = self.nbrhoods[last_node] >= 0
+            probs = onp.exp(log_probs[i][valid] - onp.max(log_probs[i][valid]))
+            results.append({'last_node': int(last_node), 'nbrs': self.nbrhoods[last_node][valid].tolist(),
+                            'probs': (probs / probs.sum()).tolist()})
+        return results
+
+    def warm_up(self, max_batch):
+        """
+        Compiles the forward pass for every batch size bucket up to max_batch (single-node paths)
+        """
+        for n in sorted(set(bucket(i) for i in range(1, int(max_batch) + 1))):
+            self.predict_batch([self.parse({'path': [0]})] * n)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.reply(200, {'status': 'ok'})
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self.reply(404, {'error': 'not found'})
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            request = self.server.predictor.parse(payload)
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, {'error': str(e)})
+        try:
+            self.reply(200, self.server.batcher.submit(request).result())
+        except Exception as e:
+            self.reply(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        # no per-request logging
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class Unix_Server(Server):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def make_server(predictor, address, max_batch=64, max_wait=0.005):
+    """
+    Returns a server (not yet serving) for predictor on address: a (host, port) tuple, or a Unix socket path
+    """
+    server = Unix_Server(address, Handler) if isinstance(address, str) else Server(address, Handler)
+    server.predictor = predictor
+    server.batcher = Batcher(predictor.predict_batch, max_batch=max_batch, max_wait=max_wait)
+    return server
+
+
+class Unix_Connection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=10):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(address, payload, timeout=10):
+    """
+    Sends payload to the /predict endpoint of the server at address ((host, port) or Unix socket path); returns the
+        decoded response (a dict with an 'error' key if the request failed)
+    """
+    if isinstance(address, str):
+        connection = Unix_Connection(address, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(*address, timeout=timeout)
+    try:
+        connection.request('POST', '/predict', json.dumps(payload), {'Content-Type': 'application/json'})
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+
+def load_predictor():
+    """
+    Loads the model set in HYPERPARAMS; returns a Predictor. Its model artifact (see save_model) is used if it exists,
+        else the model is rebuilt from its dataset + saved weights
+    """
+    if os.path.exists(artifact_file()):
+        scone, shifts, shared_inputs, nbrhoods, tables, params = load_model(artifact_file())
+        return Predictor(scone, shifts, shared_inputs, nbrhoods, tables['nbr_edges'], tables['nbr_signs'], tables['B1'].shape[1],
+                         sparse_flows=bool(params['sparse_flows']))
+
+    inputs_all, y_all, train_mask, _, shifts, _, _, nbrhoods, _, _, _, tables = \
+        data_setup(hops=(1,), load=True, folder_suffix=HYPERPARAMS['data_folder_suffix'])
+    inputs, y = inputs_all[0], y_all[0]
+    scone = build_model(shifts, inputs, y, train_mask)
+    load_weights(scone)
+
+    return Predictor(scone, shifts, inputs[:-2], nbrhoods, tables['nbr_edges'], tables['nbr_signs'], tables['B1'].shape[1],
+                     sparse_flows=bool(HYPERPARAMS['sparse_flows']))
+
+
+if __name__ == '__main__':
+    configure()
+    predictor = load_predictor()
+    predictor.warm_up(HYPERPARAMS.get('max_batch', 64))
+    address = HYPERPARAMS.get('socket') or (HYPERPARAMS.get('host', '127.0.0.1'), int(HYPERPARAMS.get('port', 8765)))
+    server = make_server(predictor, address, max_batch=HYPERPARAMS.get('max_batch', 64), max_wait=HYPERPARAMS.get('max_wait_ms', 5) / 1000)
+    print('serving on {}'.format(address))
+    server.serve_forever()
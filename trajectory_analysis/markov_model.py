@@ -4,7 +4,6 @@ Author: Nicholas Glaze, Rice ECE (nkg2 at rice.edu)
 Code for Markov model class. Don't mess with this, use it through trajectory_experiments.py
 """
 import numpy as np
-import networkx as nx
 
 class Markov_Model():
     def __init__(self, order):
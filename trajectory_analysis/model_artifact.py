@@ -0,0 +1,66 @@
+"""
+Single-file, memory-mappable model artifacts.
+
+An artifact holds a set of named numpy arrays + a JSON-serializable dict of metadata, so that everything needed to run a
+    trained model (weights, model type + layer spec, shift operators, neighbor tables, edge index; see save_model in
+    trajectory_experiments.py) can be loaded without rebuilding it from the dataset.
+
+Layout (all integers little endian):
+    MAGIC (8 bytes) | format version (uint32) | header length (uint64) | JSON header | padding | array data
+    The header holds the metadata and, for each array, its dtype, shape and byte offset in the file; every array starts
+    at a multiple of ALIGNMENT bytes, so load_artifact can return zero-copy views of one read-only memory map.
+"""
+import json, struct
+import numpy as np
+
+MAGIC = b'SCONEART'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+def save_artifact(filename, arrays, meta):
+    """
+    Writes arrays (dict of name -> numpy array) + meta (JSON-serializable dict) to filename
+    """
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    for name, a in arrays.items():
+        if a.dtype.hasobject:
+            raise ValueError('array {} has dtype object; artifacts only hold numeric arrays'.format(name))
+
+    # offsets are relative to the start of the data section, which is aligned after the header
+    entries, offset = {}, 0
+    for name, a in arrays.items():
+        entries[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+        offset += -(-a.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'meta': meta, 'arrays': entries}).encode()
+
+    prefix = len(MAGIC) + 12 + len(header)
+    data_start = -(-prefix // ALIGNMENT) * ALIGNMENT
+    with open(filename, 'wb') as f:
+        f.write(MAGIC + struct.pack('<IQ', FORMAT_VERSION, len(header)) + header)
+        f.write(b'\0' * (data_start - prefix))
+        for name, a in arrays.items():
+            f.write(a.tobytes())
+            f.write(b'\0' * (-a.nbytes % ALIGNMENT))
+
+def load_artifact(filename):
+    """
+    Returns (arrays, meta) of the artifact in filename; arrays are read-only views of a memory map of the file, so
+        loading is independent of the artifact size
+    """
+    with open(filename, 'rb') as f:
+        magic, (version, header_len) = f.read(len(MAGIC)), struct.unpack('<IQ', f.read(12))
+        if magic != MAGIC:
+            raise ValueError('{} is not a model artifact'.format(filename))
+        if version > FORMAT_VERSION:
+            raise ValueError('{} has format version {}; this code reads versions <= {}'.format(filename, version, FORMAT_VERSION))
+        header = json.loads(f.read(header_len))
+
+    data_start = -(-(len(MAGIC) + 12 + header_len) // ALIGNMENT) * ALIGNMENT
+    buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype, shape = np.dtype(entry['dtype']), tuple(entry['shape'])
+        start = data_start + entry['offset']
+        arrays[name] = buffer[start:start + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+    return arrays, header['meta']
@@ -3,15 +3,14 @@ Author: Nicholas Glaze, Rice ECE (nkg2 at rice.edu)
 
 Projection model described in this paper: https://arxiv.org/pdf/1807.05044.pdf
 
-To use, change :folder_suffix: to the suffix used by your dataset and run this file.
+To use, change :folder_suffix: to the suffix used by your dataset and run this file (or call run_experiment(suffix)).
 """
 folder_suffix = 'buoy'
 
-import networkx as nx
 import numpy as np
 from scipy.linalg import null_space
 from scipy.special import softmax
-from synthetic_data_gen import load_dataset, incidence_matrices
+from synthetic_data_gen import load_dataset, graph_incidence_matrices, load_flows, dense_flows
 
 def build_flow(G, path, edge_to_idx):
     """
@@ -26,34 +25,6 @@ def build_flow(G, path, edge_to_idx):
             flow[edge_to_idx[edge[::-1]]] = -1
     return flow
 
-def get_faces(G):
-    """
-    Returns a list of the faces in an undirected graph
-    """
-    edges = list(G.edges)
-    faces = []
-    for i in range(len(edges)):
-        for j in range(i+1, len(edges)):
-            e1 = edges[i]
-            e2 = edges[j]
-            if e1[0] == e2[0]:
-                shared = e1[0]
-                e3 = (e1[1], e2[1])
-            elif e1[1] == e2[0]:
-                shared = e1[1]
-                e3 = (e1[0], e2[1])
-            elif e1[0] == e2[1]:
-                shared = e1[0]
-                e3 = (e1[1], e2[0])
-            elif e1[1] == e2[1]:
-                shared = e1[1]
-                e3 = (e1[0], e2[0])
-            else: # edges don't connect
-                continue
-
-            if e3[0] in G[e3[1]]: # if 3rd edge is in graph
-                faces.append(tuple(sorted((shared, *e3))))
-    return list(sorted(set(faces)))
 
 def embed(B1, B2):
     """
@@ -126,6 +97,7 @@ def accuracy_2target(y, preds, n_nbrs):
     return n_true_greater / len(true_next)
 
 def test_dataset():
+    import networkx as nx
     A = np.array([
          [0, 1, 1, 1],
          [1, 0, 1, 0],
@@ -147,7 +119,7 @@ def test_dataset():
 
     target_nodes = [1, 2]
 
-    B1, B2 = incidence_matrices(G, sorted(G.nodes), sorted(G.edges), get_faces(G), edge_to_idx)
+    B1, B2 = [B.toarray() for B in graph_incidence_matrices(G)]
     return G, paths, last_nodes, y, edge_to_idx, idx_to_edge, target_nodes, B1, B2
 
 def synthetic_dataset(folder="trajectory_data_1hop_schaub2"):
@@ -155,6 +127,9 @@ def synthetic_dataset(folder="trajectory_data_1hop_schaub2"):
     Load synthetic dataset from folder
     """
     X, B_matrices, y, train_mask, test_mask, G_undir, last_nodes, target_nodes = load_dataset(folder)
+    B_matrices = [B.toarray() for B in B_matrices]  # the projection is computed densely
+    if isinstance(X, tuple):
+        X = dense_flows(*X, B_matrices[0].shape[1])
 
     edge_to_idx = {edge: i for i, edge in enumerate(G_undir.edges)}
     idx_to_edge = {i: edge for i, edge in enumerate(G_undir.edges)}
@@ -193,37 +168,43 @@ def eval_dataset(G, paths, last_nodes, y, edge_to_idx, idx_to_edge, target_nodes
         acc = accuracy(y, preds)
     return ce, acc
 
-# test dataset
-# print(eval_dataset(*test_dataset()))
-
-
-folder = 'trajectory_data_1hop_' + folder_suffix
-
-# synthetic dataset
-G, (B1, B2), flows, last_nodes, target_nodes, y, edge_to_idx, idx_to_edge, train_mask, test_mask = synthetic_dataset(folder='trajectory_data_1hop_' + folder_suffix)
+def run_experiment(folder_suffix):
+    """
+    Runs the standard, reverse, 2-target and transfer experiments on the dataset in trajectory_data_1hop_folder_suffix
+    """
+    # test dataset
+    # print(eval_dataset(*test_dataset()))
 
-max_deg = np.max([len(G[i]) for i in G.nodes])
+    folder = 'trajectory_data_1hop_' + folder_suffix
 
+    # synthetic dataset
+    G, (B1, B2), flows, last_nodes, target_nodes, y, edge_to_idx, idx_to_edge, train_mask, test_mask = synthetic_dataset(folder='trajectory_data_1hop_' + folder_suffix)
 
-print('Avg degree:', 2 * len(G.edges) / len(G.nodes))
+    max_deg = np.max([len(G[i]) for i in G.nodes])
 
-# # Standard test set
-last_nodes_test, y_test, target_nodes_test, flows_test = last_nodes[test_mask == 1], \
-                                                         y[test_mask == 1].T, target_nodes[test_mask == 1], \
-                                                         flows[test_mask == 1].T
+    print('Avg degree:', 2 * len(G.edges) / len(G.nodes))
 
-print('Standard experiment loss / acc:', eval_dataset(G, None, last_nodes_test, y_test, edge_to_idx, idx_to_edge, target_nodes_test, B1, B2, max_deg, flows=flows_test))
+    # # Standard test set
+    last_nodes_test, y_test, target_nodes_test, flows_test = last_nodes[test_mask == 1], \
+                                                             y[test_mask == 1].T, target_nodes[test_mask == 1], \
+                                                             flows[test_mask == 1].T
 
-# Reversed
-flows_rev, last_nodes_rev, target_nodes_rev, targets_rev = tuple(map(np.load, (folder + '/rev_flows_in.npy', folder + '/rev_last_nodes.npy', folder + '/rev_target_nodes.npy', folder + '/rev_targets.npy')))
-print('Reverse experiment loss / acc:', eval_dataset(G, None, last_nodes_rev[test_mask == 1], targets_rev.reshape(targets_rev.shape[:-1])[test_mask == 1].T, edge_to_idx, idx_to_edge, target_nodes_rev[test_mask == 1], B1, B2, max_deg, flows=flows_rev.reshape(flows_rev.shape[:-1])[test_mask == 1].T))
+    print('Standard experiment loss / acc:', eval_dataset(G, None, last_nodes_test, y_test, edge_to_idx, idx_to_edge, target_nodes_test, B1, B2, max_deg, flows=flows_test))
 
+    # Reversed
+    flows_rev = load_flows(folder + '/rev_flows_in')
+    if isinstance(flows_rev, tuple):
+        flows_rev = dense_flows(*flows_rev, B1.shape[1])
+    last_nodes_rev, target_nodes_rev, targets_rev = tuple(map(np.load, (folder + '/rev_last_nodes.npy', folder + '/rev_target_nodes.npy', folder + '/rev_targets.npy')))
+    print('Reverse experiment loss / acc:', eval_dataset(G, None, last_nodes_rev[test_mask == 1], targets_rev.reshape(targets_rev.shape[:-1])[test_mask == 1].T, edge_to_idx, idx_to_edge, target_nodes_rev[test_mask == 1], B1, B2, max_deg, flows=flows_rev.reshape(flows_rev.shape[:-1])[test_mask == 1].T))
 
-# 2-target
-print('2-target acc:', eval_dataset(G, None, last_nodes_test, y_test, edge_to_idx, idx_to_edge, target_nodes_test, B1, B2, max_deg, flows=flows_test, two_target=True)[1])
+    # 2-target
+    print('2-target acc:', eval_dataset(G, None, last_nodes_test, y_test, edge_to_idx, idx_to_edge, target_nodes_test, B1, B2, max_deg, flows=flows_test, two_target=True)[1])
 
-# Transfer
-regional_mask = np.array([1 if i % 3 == 2 else 0 for i in range(y.shape[0])])
-print('Transfer experiment loss / acc:', eval_dataset(G, None, last_nodes[regional_mask == 1], y[regional_mask == 1].T, edge_to_idx, idx_to_edge, target_nodes[regional_mask == 1], B1, B2, max_deg, flows=flows[regional_mask == 1].T))
+    # Transfer
+    regional_mask = np.array([1 if i % 3 == 2 else 0 for i in range(y.shape[0])])
+    print('Transfer experiment loss / acc:', eval_dataset(G, None, last_nodes[regional_mask == 1], y[regional_mask == 1].T, edge_to_idx, idx_to_edge, target_nodes[regional_mask == 1], B1, B2, max_deg, flows=flows[regional_mask == 1].T))
 
 
+if __name__ == '__main__':
+    run_experiment(folder_suffix)
@@ -5,15 +5,140 @@ code for building, training, and testing a SCoNe model. No need to mess with thi
 """
 
 import os
+from functools import wraps, partial
 import numpy as onp
 import jax.numpy as np
-from jax import grad, jit, vmap
-from jax.experimental.optimizers import adam
-import jax.example_libraries.optimizers 
-from treelib import Tree
-import matplotlib.pyplot as plt
-
-onp.random.seed(1030)
+import jax
+from jax import jit, vmap, pmap, value_and_grad, lax, random, tree_util
+from jax.example_libraries.optimizers import adam
+from jax.scipy.special import logsumexp
+
+try:
+    from trajectory_analysis.sparse_shifts import SparseShift
+except Exception:
+    from sparse_shifts import SparseShift
+
+# above this many samples, forward passes are padded to a multiple of it instead of a power of 2 (see bucket)
+BUCKET_STEP = 256
+# max # of entries (nnz * samples * channels) a SparseShift gathers in one forward pass chunk (see Scone_GCN.predict)
+SPARSE_CHUNK_ENTRIES = 1 << 24
+
+def bucket(n, cap=None, step=None):
+    """
+    Rounds n up to a power of 2 (at most cap), so that compiled functions are reused across similar sizes; if step is
+        set, sizes above step are rounded up to a multiple of step instead, which bounds the padding of large sizes
+    """
+    if step is not None and n > step:
+        return -(-int(n) // step) * step
+    size = 1 << max(int(n) - 1, 0).bit_length()
+    return size if cap is None else min(size, cap)
+
+def batch_columns(model):
+    """
+    Wraps a model function so that it is called like its vmapped version (last nodes (N,), flows (N, # edges, C)), but
+        runs the whole batch as the columns of one (# edges, N, C) signal, so each shift is one matrix-matrix product
+        instead of N matrix-vector products. Flows must be the last model input. Sparse flows ((N, L) edge indices,
+        (N, L) signs) are passed through as is; the model's shift() handles their batch axis
+    """
+    @wraps(model)
+    def batched_model(weights, *args):
+        *args, flows = args
+        return model(weights, *args, flows if isinstance(flows, tuple) else np.moveaxis(flows, 0, 1))
+    return batched_model
+
+def group_members(weights):
+    """
+    Converts weights stacked over ensemble members (leading axis of every weight array) to the grouped layout the model
+        functions apply all members with at once: the member axis moves after the shift axis of fused layers,
+        (K, n_k, C_in, C_out) -> (n_k, K, C_in, C_out); per-shift matrices + readout weights keep (K, C_in, C_out)
+    """
+    return [np.swapaxes(w, 0, 1) if w.ndim == 4 else w for w in weights]
+
+def ensemble_members(model):
+    """
+    Wraps a (batched) model function so that it takes weights stacked over ensemble members, and returns each member's
+        log-probabilities, dim (# samples, K, ...). The members are folded into the channels of one forward pass (see
+        group_members), so each shift runs once per batch for all of them
+    """
+    @wraps(model)
+    def member_model(weights, *args):
+        return model(group_members(weights), *args)
+    return member_model
+
+def average_members(model):
+    """
+    Wraps a (batched) model function so that it takes weights stacked over ensemble members (leading axis of every
+        weight array), and returns the log of the members' averaged predicted probabilities
+    """
+    member_model = ensemble_members(model)
+
+    @wraps(model)
+    def ensemble_model(weights, *args):
+        log_probs = member_model(weights, *args)
+        return logsumexp(log_probs, axis=1) - np.log(log_probs.shape[1])
+    return ensemble_model
+
+def take(x, idxs):
+    """
+    Returns the samples idxs of x, which is either an array or a tuple of arrays (sparse flows: edge indices, signs)
+    """
+    return tree_util.tree_map(lambda a: np.asarray(a)[idxs], x)
+
+def pad_flow_length(X):
+    """
+    Pads sparse flows X ((N, L) edge indices, (N, L) signs) with (0, 0) entries to a bucket length (see bucket); dense
+        flows are returned as is
+    """
+    if not isinstance(X, tuple):
+        return X
+    padding = ((0, 0), (0, bucket(X[0].shape[1]) - X[0].shape[1]))
+    return tuple(np.pad(np.asarray(a), padding) for a in X)
+
+def flow_channels(X):
+    """
+    Returns the # of channels of flows X; sparse flows have one
+    """
+    return 1 if isinstance(X, tuple) else X.shape[-1]
+
+def fuse_weights(weights, n_k):
+    """
+    Converts weights from the per-shift layout (n_k (C_in, C_out) matrices per layer, then the readout weights) to the
+        fused layout (one stacked (n_k, C_in, C_out) array per layer, then the readout weights). Use this to load
+        weight files saved before the fused layout existed
+    """
+    n_layers = (len(weights) - 1) // n_k
+    return [onp.stack(weights[i * n_k:(i + 1) * n_k]) for i in range(n_layers)] + [weights[-1]]
+
+def unfuse_weights(weights):
+    """
+    Inverse of fuse_weights
+    """
+    return [w for W in weights[:-1] for w in W] + [weights[-1]]
+
+def mask_nbrs(preds, n_nbrs):
+    """
+    Sets the predictions for each sample's padded neighbor slots (slots >= its # of neighbors) to -100
+    """
+    slots = np.arange(preds.shape[1]).reshape((1, -1) + (1,) * (preds.ndim - 2))
+    return np.where(slots < np.reshape(np.asarray(n_nbrs), (-1,) + (1,) * (preds.ndim - 1)), preds, -100)
+
+@jit
+def masked_metrics(preds, y, mask, n_nbrs, random_targets):
+    """
+    Returns the cross-entropy, accuracy and 2-target accuracy (true target vs random_targets) of the log-probabilities
+        preds over the samples in mask; preds and y have dim (# samples, max degree, 1)
+    """
+    cross_entropy = -np.sum(np.sum(preds * y, axis=(1, 2)) * mask) / np.sum(mask)
+
+    preds = mask_nbrs(preds, n_nbrs)[..., 0]
+    rows = np.arange(preds.shape[0])
+    true_choice = np.argmax(y[..., 0], axis=1)
+
+    correct = np.argmax(preds, axis=1) == true_choice
+    true_probs, random_probs = preds[rows, true_choice], preds[rows, random_targets]
+    two_target = np.where(true_probs > random_probs, 1., np.where(true_probs == random_probs, 0.5, 0.))
+
+    return cross_entropy, np.sum(correct * mask) / np.sum(mask), np.sum(two_target * mask) / np.sum(mask)
 
 class Scone_GCN():
     def __init__(self, epochs, step_size, batch_size, weight_decay, verbose=True):
@@ -26,10 +151,17 @@ class Scone_GCN():
         """
 
         self.random_targets = None
+        self.random_targets_y = None
+
+        self.forward = None
+        self.forward_inputs = ()
+        self.greedy = None
 
         self.trained = False
         self.model = None
         self.model_single = None
+        self.member_model = None
+        self.n_members = None
         self.shifts = None
         self.weights = None
 
@@ -45,173 +177,284 @@ class Scone_GCN():
         Computes cross-entropy loss per flow
         """
         preds = self.model(weights, *self.shifts, *inputs)[mask==1] # dim: (200,13,1)
-        
-        # raise Exception
-        # cross entropy + ridge regularization
-        #print(preds[1])
-        n_shifts = len(self.shifts)
-
-        if self.model_type != 'bunch':
-            n_shifts += 1 # for identity layer
-            return -np.sum(preds * y[mask==1]) / np.sum(mask) + (self.weight_decay * (np.linalg.norm(weights[:n_shifts])**2 + np.linalg.norm(weights[n_shifts:-1])**2 + np.linalg.norm(weights[-1])**2))
+
+        # cross entropy + ridge regularization (sum of squares of every weight, in either weight layout)
+        return -np.sum(preds * y[mask==1]) / np.sum(mask) + self.weight_decay * sum(np.sum(w ** 2) for w in weights)
+
+
+    def batch_loss(self, weights, shifts, inputs, y):
+        """
+        Computes cross-entropy loss per flow + ridge regularization over inputs that are already a batch (no mask), so
+            it can be traced by jit. For an ensemble, returns the sum of the members' losses, so that each member gets
+            the gradient of its own loss
+        """
+        if self.n_members:
+            # (# samples, K, ...), compared to each sample's target
+            preds = self.member_model(weights, *shifts, *inputs)
+            y = np.expand_dims(y, 1)
         else:
-            return -np.sum(preds * y[mask==1]) / np.sum(mask) + (self.weight_decay * (np.linalg.norm(weights[:n_shifts])**2 + np.linalg.norm(weights[n_shifts:-n_shifts])**2 + np.linalg.norm(weights[-n_shifts:])**2))
+            preds = self.model(weights, *shifts, *inputs)
+        return -np.sum(preds * y) / y.shape[0] + self.weight_decay * sum(np.sum(w ** 2) for w in weights)
 
+    def gather(self, inputs, y, idxs):
+        """
+        Returns the inputs + targets of the samples at idxs only; the last two model inputs (last nodes, flows) are
+            per-sample, the rest are shared
+        """
+        return list(inputs[:-2]) + [take(inputs[-2], idxs), take(inputs[-1], idxs)], take(y, idxs)
 
-    def accuracy(self, shifts, inputs, y, mask, n_nbrs):
+    def map_chunks(self, fn, shifts, inputs, weights, chunk_size=None):
         """
-        Computes ratio of correct predictions
+        Runs fn(last nodes, flows) over the per-sample inputs in chunks; returns its outputs (one row per sample) in
+            order. Every chunk is padded (by repeating samples) to a bucket size, so that differently sized inputs
+            (masks, reverse sets, served batches) mostly reuse the same compiled functions
+
+        :param chunk_size: if set, runs fn over chunks of at most this many samples. Ensembles of K members default to
+            chunks of 1 / K of the samples, so that their peak memory matches a single model's. With sparse shifts,
+            chunks are also capped at SPARSE_CHUNK_ENTRIES / (nnz * channels * K) samples, since S @ x gathers an
+            (nnz, samples, K * channels) array before summing it into rows
         """
-        target_choice = np.argmax(y[mask==1], axis=1)
-        preds = onp.array(self.model(self.weights, *shifts, *inputs))
+        n_samples = len(inputs[-2])
+        if chunk_size is None and self.n_members:
+            chunk_size = bucket(-(-n_samples // weights[0].shape[0]), step=BUCKET_STEP)
+        nnz = max([S.nnz for S in shifts if isinstance(S, SparseShift)], default=0)
+        if nnz:
+            n_members = weights[0].shape[0] if self.n_members else 1
+            max_samples = SPARSE_CHUNK_ENTRIES // (nnz * max(w.shape[-1] for w in weights) * n_members)
+            # largest power of 2 under the cap, so that chunks are bucket sizes
+            sparse_chunk = 1 << max(max_samples.bit_length() - 1, 0)
+            chunk_size = sparse_chunk if chunk_size is None else min(chunk_size, sparse_chunk)
+        if chunk_size is None or n_samples <= chunk_size:
+            chunk_size = n_samples
+
+        # (# chunks, padded chunk size) sample indices; the last chunk wraps around to the first samples
+        idxs = onp.arange(-(-n_samples // chunk_size) * chunk_size).reshape((-1, chunk_size)) % n_samples
+        idxs = idxs[:, onp.arange(bucket(chunk_size, step=BUCKET_STEP)) % chunk_size]
+        return np.concatenate([fn(*self.gather(inputs, inputs[-2], chunk)[0][-2:])[:chunk_size] for chunk in idxs])[:n_samples]
+
+    def predict(self, shifts, inputs, weights=None, chunk_size=None):
+        """
+        Returns the model's log-probabilities for every sample in inputs, using a jitted forward pass (recompiled only
+            when the shared, non-per-sample inputs change). The # of samples and the path length of sparse flows are
+            padded to bucket sizes, so that differently sized inputs mostly reuse the same compiled functions
 
-        # make best choice out of each node's neighbors
-        for i in range(len(preds)):
-            preds[i, n_nbrs[i]:] = -100
+        :param chunk_size: max # of samples per forward pass (see map_chunks)
+        """
+        weights = self.weights if weights is None else weights
+        shared = tuple(inputs[:-2])
+        if self.forward is None or len(shared) != len(self.forward_inputs) \
+                or any(a is not b for a, b in zip(shared, self.forward_inputs)):
+            self.forward_inputs = shared
+            self.forward = jit(lambda weights, shifts, last_nodes, X: self.model(weights, *shifts, *shared, last_nodes, X))
+
+        def forward(last_nodes, X):
+            return self.forward(list(weights), shifts, np.asarray(last_nodes), tree_util.tree_map(np.asarray, pad_flow_length(X)))
+        return self.map_chunks(forward, shifts, inputs, weights, chunk_size)
+
+    def sample_random_targets(self, y, n_nbrs):
+        """
+        Returns, for each sample, a random neighbor slot different from its true target (if it has another neighbor).
+            Cached per y, so repeated 2-target evaluations compare against the same random targets
+        """
+        if self.random_targets_y is not y:
+            true_choice = onp.argmax(y, axis=1).reshape(-1)
+            n_nbrs = onp.asarray(n_nbrs)
+            random_targets = onp.random.randint(0, high=onp.maximum(n_nbrs - 1, 1))
+            random_targets += random_targets >= true_choice  # skip over the true target
+            self.random_targets = onp.where(n_nbrs > 1, random_targets, true_choice)
+            self.random_targets_y = y
+        return self.random_targets
 
-        pred_choice = np.argmax(preds[mask==1], axis=1)
-        return np.mean(pred_choice == target_choice)
+    def accuracy(self, shifts, inputs, y, mask, n_nbrs):
+        """
+        Computes ratio of correct predictions
+        """
+        preds = self.predict(shifts, inputs)
+        return masked_metrics(preds, np.asarray(y), np.asarray(mask), np.asarray(n_nbrs), np.zeros(len(y), dtype=int))[1]
 
     def two_target_accuracy(self, shifts, inputs, y, mask, n_nbrs):
         """
         Computes the ratio of the time the model correctly identifies which of the true target and a random, different
             target is correct.
         """
-        if type(self.random_targets) != onp.ndarray:
-            self.random_targets = onp.random.randint(0, high=n_nbrs, size=inputs[1].shape[0])
-
-        preds = onp.array(self.model(self.weights, *shifts, *inputs))
-
-        # make best choice out of each node's neighbors
-        for i in range(len(preds)):
-            preds[i, n_nbrs[i]:] = -100
-
-        pred_choice = np.argmax(preds[mask == 1], axis=1)
-
-        for i in range(preds.shape[0]):
-            while self.random_targets[i] == pred_choice[i]:
-               self.random_targets[i] = onp.random.randint(0, high=n_nbrs[i])
-
-
-        all_row_idxs = range(len(self.random_targets))
-        random_probs = preds[all_row_idxs, self.random_targets]
-
-        true_choice = onp.argmax(y, axis=1).reshape((y.shape[0],))
-        true_probs = preds[all_row_idxs, true_choice]
+        preds = self.predict(shifts, inputs)
+        random_targets = self.sample_random_targets(y, n_nbrs)
+        return masked_metrics(preds, np.asarray(y), np.asarray(mask), np.asarray(n_nbrs), random_targets)[2]
 
-        correct = 0
-        true_masked, random_masked = true_probs[mask==1], random_probs[mask==1]
-        for t, r in zip(true_masked, random_masked):
-            if t > r:
-                correct += 1
-            elif t == r:
-                correct += 0.5
-        return correct / sum(mask)
+    def evaluate(self, shifts, inputs, y, masks, n_nbrs, metrics=('loss', 'acc', '2target')):
+        """
+        Runs the model once over inputs, then computes every requested metric for every mask from the cached
+            log-probabilities
 
-    def multi_hop_accuracy_binary(self, shifts, inputs, y, mask, nbrhoods, E_lookup, last_nodes, n_nbrs, hops):
+        :param masks: dict of mask name -> 1-D binary array (e.g. {'train': train_mask, 'test': test_mask})
+        :param metrics: any of 'loss' (cross-entropy + ridge regularization, as in :function loss:), 'acc', '2target'
+        Returns dict of mask name -> dict of metric -> value
+        """
+        preds = self.predict(shifts, inputs)
+        y, n_nbrs = np.asarray(y), np.asarray(n_nbrs)
+        if '2target' in metrics:
+            random_targets = self.sample_random_targets(y, n_nbrs)
+        else:
+            random_targets = np.zeros(len(y), dtype=int)
+        regularization = self.weight_decay * sum(np.sum(np.asarray(w) ** 2) for w in self.weights)
+        if self.n_members:
+            # average over the ensemble's members
+            regularization /= self.weights[0].shape[0]
+
+        report = {}
+        for name, mask in masks.items():
+            cross_entropy, acc, two_target = masked_metrics(preds, y, np.asarray(mask), n_nbrs, random_targets)
+            values = {'loss': float(cross_entropy + regularization), 'acc': float(acc), '2target': float(two_target)}
+            report[name] = {metric: values[metric] for metric in metrics}
+        return report
+
+    def evaluate_members(self, shifts, inputs, y, masks, n_nbrs, metrics=('loss', 'acc')):
         """
-        Returns the accuracy of the model in making multi-hop predictions
+        Evaluates each member of an ensemble on its own; returns a list of reports (see evaluate), one per member
         """
-        cur_inputs = list(inputs)
-        cur_nodes = onp.array(last_nodes)
-        for h in range(hops):
-            preds = onp.array(self.model(self.weights, *shifts, *cur_inputs))
-            # make best choice out of each node's neighbors
-            for i in range(len(preds)):
-                preds[i, n_nbrs[i]:] = -100
-
-            pred_choice = onp.argmax(preds, axis=1)
-
-            if h == hops - 1:
-                return np.average(pred_choice[mask==1] == onp.argmax(y[mask == 1], axis=1))
-
-            cur_nbrhoods = onp.array(nbrhoods)[cur_nodes]
-            next_nodes = []
-            for Nv, c in zip(cur_nbrhoods, pred_choice):
-                next_node = Nv[c[0]]
-                next_nodes.append(next_node)
-
-            # categorize new edges into +1 and -1 orientation
-            next_edge_cols_pos, next_edge_cols_neg = [], []
-            next_edge_rows_pos, next_edge_rows_neg = [], []
-            for idx, (i, j) in enumerate(zip(cur_nodes, next_nodes)):
-                if j is None:
-                    print(idx, i, j)
-                    raise Exception
-                try:
-                    next_edge_cols_pos.append(E_lookup[(i, j)])
-                    next_edge_rows_pos.append(idx)
-                except KeyError:
-                    next_edge_cols_neg.append(E_lookup[(j, i)])
-                    next_edge_rows_neg.append(idx)
-
-
-            cur_inputs[-1][next_edge_rows_pos, next_edge_cols_pos] = 1
-            cur_inputs[-1][next_edge_rows_neg, next_edge_cols_neg] = -1
-
-    def multi_hop_accuracy_dist(self, shifts, inputs, target_nodes, masks, nbrhoods, E_lookup, last_nodes, prefixes, hops):
+        weights, reports = self.weights, []
+        try:
+            for k in range(weights[0].shape[0]):
+                # an ensemble of one member predicts that member's probabilities
+                self.weights = [w[k:k + 1] for w in weights]
+                reports.append(self.evaluate(shifts, inputs, y, masks, n_nbrs, metrics=metrics))
+        finally:
+            self.weights = weights
+        return reports
+
+    def multi_hop_accuracy_binary(self, shifts, inputs, y, mask, nbrhoods, nbr_edges, nbr_signs, hops):
+        """
+        Returns the accuracy of the model in making multi-hop predictions: every sample greedily takes its most likely
+            hop hops - 1 times, then its last prediction is compared to y. The whole rollout is one compiled function
+            (recompiled only when hops or the shared inputs change); each hop is a forward pass, a gather of the chosen
+            (edge, flow value) from nbr_edges, nbr_signs (see neighbor_edge_tables) and a scatter into the flows. Like
+            predict, it runs over bucket-sized chunks of the samples (see map_chunks)
+        """
+        shared = tuple(inputs[:-2])
+        if self.greedy is None or self.greedy[0] != hops or len(shared) != len(self.greedy[1]) \
+                or any(a is not b for a, b in zip(shared, self.greedy[1])):
+
+            def greedy(weights, shifts, nbrhoods, nbr_edges, nbr_signs, last_nodes, flows):
+                for h in range(hops):
+                    # best choice out of each node's neighbors
+                    preds = self.model(weights, *shifts, *shared, last_nodes, flows)[..., 0]
+                    choice = np.argmax(np.where(nbrhoods[last_nodes] >= 0, preds, -np.inf), axis=1)
+                    if h == hops - 1:
+                        return choice
+
+                    edges, signs = nbr_edges[last_nodes, choice], nbr_signs[last_nodes, choice]
+                    if isinstance(flows, tuple):
+                        flows = (np.concatenate([flows[0], edges[:, None]], axis=1), np.concatenate([flows[1], signs[:, None]], axis=1))
+                    else:
+                        flows = flows.at[np.arange(len(edges)), edges, 0].add(signs)
+                    last_nodes = nbrhoods[last_nodes, choice]
+
+            self.greedy = (hops, shared, jit(greedy))
+
+        nbrhoods, nbr_edges, nbr_signs = np.asarray(nbrhoods), np.asarray(nbr_edges), np.asarray(nbr_signs)
+
+        def greedy(last_nodes, flows):
+            return self.greedy[2](list(self.weights), shifts, nbrhoods, nbr_edges, nbr_signs, np.asarray(last_nodes),
+                                  tree_util.tree_map(np.asarray, pad_flow_length(flows)))
+        pred_choice = self.map_chunks(greedy, shifts, inputs, self.weights)
+        mask = onp.asarray(mask)
+        return onp.average(onp.asarray(pred_choice)[mask == 1] == onp.argmax(onp.asarray(y)[mask == 1][..., 0], axis=1))
+
+    def multi_hop_accuracy_dist(self, shifts, inputs, target_nodes, masks, nbrhoods, nbr_edges, nbr_signs, hops):
         """
         Returns accuracy of the model in making multi-hop predictions, using distributions at each intermediate hop
-            instead of binary choices
+            instead of binary choices: for each sample, the average probability of the hops-step paths that end at its
+            target node (every path is expanded, see rollout)
         """
-        nbrhoods_unpadded = [nbrhood[onp.where(nbrhood != -1)] for nbrhood in nbrhoods]
-        path_trees = [Tree() for _ in range(inputs[-1].shape[0])]
-        # initialize leaves
-        for i in range(len(path_trees)):
-            path_trees[i].create_node(tag=last_nodes[i], identifier=str(last_nodes[i]), data=[inputs[-1][i], 1])
-
-        # build trees
-        for h in range(hops):
-            for i in range(len(path_trees)):
-                for leaf in path_trees[i].leaves():
-                    flow = leaf.data[0]
-
-                    probs = onp.array(onp.exp(self.model_single(self.weights, *shifts, inputs[0], leaf.tag, leaf.data[0])))
-
-                    nbrs = onp.array(nbrhoods_unpadded[leaf.tag])
-                    for j in range(len(nbrs)):
-                        new_edge = (int(leaf.tag), nbrs[j])
-                        new_flow = onp.array(flow)
-                        if new_edge[0] < new_edge[1]:
-                            flow_val = 1
-
-                        else:
-                            flow_val = -1
-                        new_flow[E_lookup[tuple(sorted(new_edge))]] = flow_val
-
-                        prob_so_far = leaf.data[1]
-                        path_trees[i].create_node(tag=nbrs[j], identifier=leaf.identifier + str(nbrs[j]), data=[new_flow, prob_so_far * probs[j]], parent=leaf.identifier)
-
-
-        # find prob that target node is reached for each flow
-        target_probs = onp.zeros(len(path_trees))
-        for i in range(len(path_trees)):
-            target_prob = 0
-            valid_paths = 0
-
-            for leaf in path_trees[i].leaves():
-                if leaf.tag == target_nodes[i]:
-                    valid_paths += 1
-                    target_prob += leaf.data[1]
-            target_prob /= valid_paths
-            target_probs[i] = target_prob
+        paths, log_probs = self.rollout(shifts, inputs, nbrhoods, nbr_edges, nbr_signs, hops)
+        at_target = (paths[..., -1] == onp.asarray(target_nodes)[:, None]) & onp.isfinite(log_probs)
+        target_probs = onp.sum(onp.exp(log_probs) * at_target, axis=1) / onp.sum(at_target, axis=1)
 
         return [onp.average(target_probs[mask == 1]) for mask in masks]
 
-        # get all paths from last_node to target_node (using nx.all_simple_paths, cutoff 2)
-        # compute + memoize the target vector at each node in each path; build a dict of probability that path is followed
-        #   as each path is stepped through
-        # return average of that dict's values
+    def rollout(self, shifts, inputs, nbrhoods, nbr_edges, nbr_signs, hops, beam_width=None, top_k=None,
+                target_nodes=None, chunk_size=4096):
+        """
+        Batched beam search over the next hops of every sample. At each hop, the model is run once over all frontier
+            states (sample, partial path), every state is extended to each neighbor of its last node, and each sample
+            keeps its beam_width most likely paths
+
+        :param nbrhoods: padded (# nodes, max degree) neighbor table, padded with -1
+        :param nbr_edges: (# nodes, max degree) edge between each node + neighbor slot (see neighbor_edge_tables)
+        :param nbr_signs: (# nodes, max degree) matching flow value of the hop
+        :param hops: # of hops to forecast
+        :param beam_width: # of paths kept per sample after each hop; None keeps every path (exact)
+        :param top_k: # of most likely paths to return per sample; None returns the whole beam
+        :param target_nodes: if given, also returns the probability of each sample's forecast ending at its target node
+            (a lower bound, if paths were pruned)
+        :param chunk_size: max # of states per forward pass (see predict)
+        :return: paths (# samples, k, hops) of predicted nodes and their log-probabilities (# samples, k), most likely
+            first (-inf for padding, if a sample has fewer than k paths); [target reach probabilities (# samples,)]
+        """
+        nbrhoods, nbr_edges, nbr_signs = np.asarray(nbrhoods), np.asarray(nbr_edges), np.asarray(nbr_signs)
+        shared, flows = list(inputs[:-2]), tree_util.tree_map(np.asarray, inputs[-1])
+        last_nodes = np.asarray(inputs[-2])[:, None]
+        n_samples, max_degree = last_nodes.shape[0], nbrhoods.shape[1]
 
-    def generate_weights(self, in_channels, hidden_layers, out_channels):
+        log_probs = np.zeros((n_samples, 1))
+        paths = np.zeros((n_samples, 1, 0), dtype=np.int32)
+        for h in range(hops):
+            # one forward pass over every (sample, path) state; padded neighbor slots are impossible
+            preds = self.predict(shifts, shared + [last_nodes.ravel(), flows], chunk_size=chunk_size)
+            preds = np.where(nbrhoods[last_nodes] >= 0, preds[..., 0].reshape(last_nodes.shape + (max_degree,)), -np.inf)
+            candidates = (log_probs[..., None] + preds).reshape((n_samples, -1))
+
+            # keep the most likely extensions of each sample's paths
+            n_states = log_probs.shape[1]
+            k = candidates.shape[1] if beam_width is None else min(int(beam_width), candidates.shape[1])
+            log_probs, idxs = lax.top_k(candidates, k)
+            parents, slots = idxs // max_degree, idxs % max_degree
+            prev_nodes = np.take_along_axis(last_nodes, parents, axis=1)
+            last_nodes = np.maximum(nbrhoods[prev_nodes, slots], 0)
+            paths = np.concatenate([np.take_along_axis(paths, parents[..., None], axis=1), last_nodes[..., None]], axis=-1)
+
+            # add the hop to the flow of each kept path
+            if h < hops - 1:
+                flows = take(flows, (np.arange(n_samples)[:, None] * n_states + parents).ravel())
+                edges, signs = nbr_edges[prev_nodes, slots].ravel(), nbr_signs[prev_nodes, slots].ravel()
+                if isinstance(flows, tuple):
+                    flows = (np.concatenate([flows[0], edges[:, None]], axis=1), np.concatenate([flows[1], signs[:, None]], axis=1))
+                else:
+                    flows = flows.at[np.arange(len(edges)), edges, 0].add(signs)
+
+        paths, log_probs = onp.asarray(paths), onp.asarray(log_probs)
+        if target_nodes is None:
+            return paths[:, :top_k], log_probs[:, :top_k]
+
+        at_target = paths[..., -1] == onp.asarray(target_nodes)[:, None]
+        return paths[:, :top_k], log_probs[:, :top_k], onp.sum(onp.exp(log_probs) * at_target, axis=1)
+
+    def generate_weights(self, in_channels, hidden_layers, out_channels, fused=False, n_members=None):
         """
         :param in_channels: # of channels in model inputs
         :param hidden_layers: see :function train:
         :param out_channels: # of channels in model outputs
         :param model_type:   what model this is (Bunch has slightly different weights)
+        :param fused: if True, each layer's weights are one stacked (# shifts, C_in, C_out) array instead of
+            # shifts separate matrices (see fuse_weights)
+        :param n_members: if set, generates this many independent sets of weights (an ensemble), stacked along a new
+            leading axis of every weight array
         """
+        if fused and self.model_type == 'bunch':
+            raise ValueError('fused weights are not supported for the bunch model')
+        if n_members and self.model_type == 'bunch':
+            raise ValueError('ensembles are not supported for the bunch model')
+
         weight_shapes = []
-        if len(hidden_layers) > 0:
+        if len(hidden_layers) > 0 and fused:
+            weight_shapes += [(hidden_layers[0][0], in_channels, hidden_layers[0][1])]
+
+            for i in range(len(hidden_layers) - 1):
+                weight_shapes += [(hidden_layers[i+1][0], hidden_layers[i][1], hidden_layers[i+1][1])]
+
+            weight_shapes += [(hidden_layers[-1][1], out_channels)]
+
+        elif len(hidden_layers) > 0:
             weight_shapes += [(in_channels, hidden_layers[0][1])] * hidden_layers[0][0]
 
             for i in range(len(hidden_layers) - 1):
@@ -223,56 +466,75 @@ class Scone_GCN():
             else:
                 weight_shapes += [(hidden_layers[-1][1], out_channels)]
 
+        if weight_shapes:
+            # an ensemble's members are drawn independently, stacked along a new leading axis
+            members = (n_members,) if n_members else ()
             self.weights = []
             for s in weight_shapes:
-                self.weights.append(0.01 * onp.random.randn(*s))
-
+                self.weights.append(0.01 * onp.random.randn(*members, *s))
         else:
             self.weights = [(in_channels, out_channels)]
 
-        print('# of parameters: {}'.format(onp.sum([onp.prod(w) for w in weight_shapes])))
+        n_params = onp.sum([onp.prod(w) for w in weight_shapes])
+        if n_members:
+            print('# of parameters: {} per member, {} members'.format(n_params, n_members))
+        else:
+            print('# of parameters: {}'.format(n_params))
 
 
-    def setup(self, model, hidden_layers, shifts, inputs, y, in_axes, train_mask, model_type='scone'):
+    def setup(self, model, hidden_layers, shifts, inputs, y, in_axes, train_mask, model_type='scone', batched=False, fused=False, n_members=None):
         """
         Set up model for training / calling
         in_axes: the keywords for vmap, for batching 
+        batched: if True, batch flows as columns of one signal matrix (see batch_columns) instead of vmapping
+        fused: if True, generate weights in the fused layout (see generate_weights)
+        n_members: if set, sets up an ensemble of this many models (see generate_weights), trained in lockstep; the model
+            then predicts the members' averaged probabilities
         """
         self.model_type = model_type
         n_train_samples = sum(train_mask)
         self.shifts = shifts # assign shift matrices
         # set up model for batching
-        self.model = vmap(model, in_axes=in_axes)
+        self.model = batch_columns(model) if batched else vmap(model, in_axes=in_axes)
         self.model_single = model
+        if n_members:
+            self.member_model, self.model = ensemble_members(self.model), average_members(self.model)
+        self.n_members = n_members
         # generate weights
-        in_channels, out_channels = inputs[-1].shape[-1], y.shape[-1]
-        # inputs[-1]=X, which is of #flows,#edges,1
+        in_channels, out_channels = flow_channels(inputs[-1]), y.shape[-1]
+        # inputs[-1]=X, which is of #flows,#edges,1 (or sparse flows, see batch_columns)
         # in_channels = 1, out_channels=1
-        self.generate_weights(in_channels, hidden_layers, out_channels)
+        self.generate_weights(in_channels, hidden_layers, out_channels, fused=fused, n_members=n_members)
         
-    def setup_scnn(self, model, hidden_layers, k1, k2, shifts, inputs, y, in_axes, train_mask, model_type):
+    def setup_scnn(self, model, hidden_layers, k1, k2, shifts, inputs, y, in_axes, train_mask, model_type, batched=False, fused=False, n_members=None):
         """
         Set up model for training / calling
         in_axes: the keywords for vmap, for batching 
+        batched: if True, batch flows as columns of one signal matrix (see batch_columns) instead of vmapping
+        fused: if True, generate weights in the fused layout (see generate_weights)
+        n_members: if set, sets up an ensemble of this many models (see setup)
         """
         self.model_type = model_type
         n_train_samples = sum(train_mask)
         self.shifts = shifts
         # set up model for batching
-        self.model = vmap(model, in_axes=in_axes)
+        self.model = batch_columns(model) if batched else vmap(model, in_axes=in_axes)
         self.model_single = model
+        if n_members:
+            self.member_model, self.model = ensemble_members(self.model), average_members(self.model)
+        self.n_members = n_members
         # generate weights
-        in_channels, out_channels = inputs[-1].shape[-1], y.shape[-1]
-        # inputs[-1]=X, which is of #flows,#edges,1
+        in_channels, out_channels = flow_channels(inputs[-1]), y.shape[-1]
+        # inputs[-1]=X, which is of #flows,#edges,1 (or sparse flows, see batch_columns)
         # in_channels = 1, out_channels=1
         # for scnn, we need to modify the hidden layers parameter
         # from e.g., 3_16_3_16 to 1+K_1+K_2,_16_1+K_1+K_2,_16
         hidden_layers = list((1+k1+k2,hidden_layers[i][1]) for i in range(len(hidden_layers)))
             
-        self.generate_weights(in_channels, hidden_layers, out_channels)
+        self.generate_weights(in_channels, hidden_layers, out_channels, fused=fused, n_members=n_members)
         
 
-    def train(self, inputs, y, train_mask, test_mask, n_nbrs):
+    def train(self, inputs, y, train_mask, test_mask, n_nbrs, scan_epochs=False, n_devices=1):
         """
         Trains a batched SCoNe model to predict y using the given X and shift operators.
         Model can have any number of shifts and inputs.
@@ -285,28 +547,25 @@ class Scone_GCN():
         :param test_ratio: ratio of data used as test data
         :param train_mask: 1-D binary array
         :param hops: number of steps to take before returning prediction todo implement
+        :param scan_epochs: if True, each epoch (shuffle + all of its steps) runs on device as one compiled lax.scan
+        :param n_devices: if > 1, each batch is split across this many devices (data parallel, shifts + weights are
+            replicated, gradients are averaged across devices). On CPU, start Python with
+            XLA_FLAGS=--xla_force_host_platform_device_count=n_devices to get several host devices
         """
         #orig_upper_weights = [self.weights[i*3 + 2] for i in range(3)]
 
-        X = inputs[-1]
-        N = X.shape[0]
         n_train_samples = sum(train_mask)
         n_test_samples = sum(test_mask)
         n_batches = n_train_samples // self.batch_size
 
-        batch_mask = ''
-
-
-        @jit
-        def gradient_step(weights, inputs, y):
-            grads = grad(self.loss)(weights, inputs, y, batch_mask)
-
-            for i in range(len(weights)):
-                weights[i] -= self.step_size * grads[i]
-
-            return weights
-
-
+        if n_devices > 1:
+            if scan_epochs:
+                raise ValueError('scan_epochs is not supported with n_devices > 1')
+            if self.batch_size % n_devices != 0:
+                raise ValueError('batch_size ({}) must be divisible by n_devices ({})'.format(self.batch_size, n_devices))
+            if jax.local_device_count() < n_devices:
+                raise ValueError('{} devices requested, but only {} available; on CPU, set XLA_FLAGS='
+                                 '--xla_force_host_platform_device_count={}'.format(n_devices, jax.local_device_count(), n_devices))
 
         init_fun, update_fun, get_params = adam(self.step_size)
 
@@ -314,42 +573,80 @@ class Scone_GCN():
         non_faces_all, non_faces = [], []
         faces_all, faces = [], []
 
-        def adam_step(i, opt_state, inputs, y):
-            g = grad(self.loss)(self.weights, inputs, y, batch_mask)
-            # non_faces.append(onp.mean([onp.mean(onp.abs(g[i*3])) for i in range(3)] + [onp.mean(onp.abs(g[i*3 + 1])) for i in range(3)]))
-            # faces.append(onp.mean([onp.mean(onp.abs(g[i*3 + 2])) for i in range(3)]))
-            return update_fun(i, g, opt_state)
+        # training samples stay on device; each step gathers a fixed-size batch of them
+        train_idxs = onp.where(onp.asarray(train_mask) == 1)[0]
+        train_inputs, train_y = self.gather(inputs, y, train_idxs)
+        train_last_nodes, train_X = train_inputs[-2:]
+        shared_inputs = train_inputs[:-2]
 
-        self.adam_state = init_fun(self.weights)
-        unshuffled_batch_mask = onp.array([1] * self.batch_size + [0] * (N - self.batch_size))
+        @jit
+        def adam_step(i, opt_state, shifts, batch_idxs, last_nodes, X, y):
+            # loss, gradient + optimizer update in one compiled step
+            batch_inputs, batch_y = self.gather(shared_inputs + [last_nodes, X], y, batch_idxs)
+            loss, g = value_and_grad(self.batch_loss)(get_params(opt_state), shifts, batch_inputs, batch_y)
+            return update_fun(i, g, opt_state), loss
 
+        @jit
+        def adam_epoch(epoch, key, opt_state, shifts, last_nodes, X, y):
+            # shuffle on device, then scan over the epoch's batches
+            batches = random.permutation(key, len(train_idxs))[:n_batches * self.batch_size].reshape((n_batches, self.batch_size))
 
+            def step(opt_state, batch):
+                b, batch_idxs = batch
+                return adam_step(epoch * n_batches + b, opt_state, shifts, batch_idxs, last_nodes, X, y)
 
-        # train
-        for i in range(self.epochs * n_batches):
-            batch_mask = onp.array(unshuffled_batch_mask)
-            onp.random.shuffle(batch_mask)
+            return lax.scan(step, opt_state, (np.arange(n_batches), batches))
+
+        @partial(pmap, axis_name='batch', in_axes=(None, 0, None, 0, 0, 0))
+        def parallel_adam_step(i, opt_state, shifts, last_nodes, X, y):
+            # each device takes the gradient over its shard of the batch, then gradients are averaged across devices
+            loss, g = value_and_grad(self.batch_loss)(get_params(opt_state), shifts, shared_inputs + [last_nodes, X], y)
+            loss, g = lax.pmean((loss, g), axis_name='batch')
+            return update_fun(i, g, opt_state), loss
+
+        self.weights = list(self.weights)
+        self.adam_state = init_fun(self.weights)
+        if n_devices > 1:
+            # one replica of the optimizer state per device
+            self.adam_state = tree_util.tree_map(lambda x: np.broadcast_to(x, (n_devices,) + x.shape), self.adam_state)
+        key = random.PRNGKey(onp.random.randint(2 ** 31))
+        perm = onp.arange(len(train_idxs))
 
-            batch_mask = onp.logical_and(batch_mask, train_mask)
+        # train
+        for epoch in range(self.epochs):
+            if scan_epochs:
+                key, epoch_key = random.split(key)
+                self.adam_state, _ = adam_epoch(epoch, epoch_key, self.adam_state, self.shifts, train_last_nodes, train_X, train_y)
+            elif n_devices > 1:
+                onp.random.shuffle(perm)
+                for b in range(n_batches):
+                    batch_idxs = perm[b * self.batch_size:(b + 1) * self.batch_size].reshape((n_devices, -1))
+                    self.adam_state, _ = parallel_adam_step(epoch * n_batches + b, self.adam_state, self.shifts, train_last_nodes[batch_idxs], take(train_X, batch_idxs), train_y[batch_idxs])
+            else:
+                onp.random.shuffle(perm)
+                for b in range(n_batches):
+                    self.adam_state, _ = adam_step(epoch * n_batches + b, self.adam_state, self.shifts, perm[b * self.batch_size:(b + 1) * self.batch_size], train_last_nodes, train_X, train_y)
 
-            # self.weights = gradient_step(self.weights, batch_inputs, batch_y)
-            self.adam_state = adam_step(i, self.adam_state, inputs, y)
-            self.weights = get_params(self.adam_state)
+            if n_devices > 1:
+                self.weights = [w[0] for w in get_params(self.adam_state)]
+            else:
+                self.weights = get_params(self.adam_state)
 
-            if i % n_batches == n_batches - 1:
-                train_loss = self.loss(self.weights, inputs, y, train_mask)
-                train_acc = self.accuracy(self.shifts, inputs, y, train_mask, n_nbrs)
-                test_loss = self.loss(self.weights, inputs, y, test_mask)
-                test_acc = self.accuracy(self.shifts, inputs, y, test_mask, n_nbrs)
-                print('Epoch {} -- train loss: {:.6f} -- train acc {:.3f} -- test loss {:.6f} -- test acc {:.3f}'
-                      .format(i // n_batches, train_loss, train_acc, test_loss, test_acc))
+            if n_batches > 0:
+                report = self.evaluate(self.shifts, inputs, y, {'train': train_mask, 'test': test_mask}, n_nbrs, metrics=('loss', 'acc'))
+                train_loss, train_acc = report['train']['loss'], report['train']['acc']
+                test_loss, test_acc = report['test']['loss'], report['test']['acc']
+                if self.verbose:
+                    print('Epoch {} -- train loss: {:.6f} -- train acc {:.3f} -- test loss {:.6f} -- test acc {:.3f}'
+                          .format(epoch, train_loss, train_acc, test_loss, test_acc))
 
                 non_faces_all.append(onp.mean(non_faces))
                 faces_all.append(onp.mean(faces))
 
-        print("Epochs: {}, learning rate: {}, batch size: {}, model: {}".format(
-            self.epochs, self.step_size, self.batch_size, self.model.__name__)
-        )
+        if self.verbose:
+            print("Epochs: {}, learning rate: {}, batch size: {}, model: {}".format(
+                self.epochs, self.step_size, self.batch_size, self.model.__name__)
+            )
 
         # Save gradient magnitudes to file
         # plt.plot(non_faces_all)
@@ -371,8 +668,8 @@ class Scone_GCN():
         """
         Return the loss and accuracy for the given inputs
         """
-        loss = self.loss(self.weights, test_inputs, y, test_mask)
-        acc = self.accuracy(self.shifts, test_inputs, y, test_mask, n_nbrs)
+        report = self.evaluate(self.shifts, test_inputs, y, {'test': test_mask}, n_nbrs, metrics=('loss', 'acc'))
+        loss, acc = report['test']['loss'], report['test']['acc']
 
         if self.verbose:
             print("Test loss: {:.6f}, Test acc: {:.3f}".format(loss, acc))
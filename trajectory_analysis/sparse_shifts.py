@@ -0,0 +1,114 @@
+"""
+Sparse shift operators for the SCoNe / SCNN / Ebli models.
+
+The Hodge Laplacians L1_lower = B1.T @ B1 and L1_upper = B2 @ B2.T only have a handful of nonzeros per row, so storing
+    them as dense |E| x |E| matrices wastes memory quadratically in the number of edges. SparseShift keeps an operator
+    in COO form (sorted by row) and applies it with a segment sum, so it can be dropped in anywhere a dense shift matrix
+    is used (S @ x), including under vmap / grad / jit. It also keeps a padded table of each column's nonzeros, so that
+    S @ x for a sparse x (e.g. a flow, which only touches the edges of its path) only reads the columns x touches.
+"""
+import numpy as onp
+import jax.numpy as np
+from jax import tree_util
+from jax.ops import segment_sum
+from scipy import sparse
+
+
+@tree_util.register_pytree_node_class
+class SparseShift():
+    def __init__(self, rows, cols, vals, shape, col_rows=None, col_vals=None):
+        """
+        :param rows: row index of each nonzero, sorted
+        :param cols: column index of each nonzero
+        :param vals: value of each nonzero
+        :param shape: (n_rows, n_cols) of the operator
+        :param col_rows: (n_cols, max column nnz) row indices of the nonzeros of each column, padded with 0
+        :param col_vals: (n_cols, max column nnz) values of the nonzeros of each column, padded with 0
+        """
+        self.rows = rows
+        self.cols = cols
+        self.vals = vals
+        self.shape = tuple(shape)
+        self.col_rows = col_rows
+        self.col_vals = col_vals
+
+    def __matmul__(self, x):
+        """
+        Applies the operator to x, which has shape (n_cols, ...); cost is O(nnz * prod(x.shape[1:]))
+        """
+        vals = self.vals.reshape((-1,) + (1,) * (x.ndim - 1))
+        return segment_sum(vals * x[self.cols], self.rows, num_segments=self.shape[0], indices_are_sorted=True)
+
+    def column_sum(self, idxs, weights):
+        """
+        Returns S @ x for the sparse vector x with values weights at indices idxs, i.e. the weighted sum of the columns
+            idxs of S; cost is O(len(idxs) * max column nnz)
+        """
+        rows, vals = self.col_rows[idxs], self.col_vals[idxs] * weights[:, None]
+        return np.zeros(self.shape[0], vals.dtype).at[rows.ravel()].add(vals.ravel())
+
+    @property
+    def nnz(self):
+        return self.vals.shape[0]
+
+    def todense(self):
+        return np.zeros(self.shape).at[self.rows, self.cols].add(self.vals)
+
+    def to_scipy(self):
+        return sparse.csr_matrix((onp.asarray(self.vals), (onp.asarray(self.rows), onp.asarray(self.cols))), shape=self.shape)
+
+    def tree_flatten(self):
+        return (self.rows, self.cols, self.vals, self.col_rows, self.col_vals), self.shape
+
+    @classmethod
+    def tree_unflatten(cls, shape, children):
+        rows, cols, vals, col_rows, col_vals = children
+        return cls(rows, cols, vals, shape, col_rows, col_vals)
+
+    @classmethod
+    def from_scipy(cls, M):
+        """
+        Builds a SparseShift from a scipy sparse matrix (or a dense numpy array)
+        """
+        M = sparse.csr_matrix(M)
+        M.eliminate_zeros()
+        col_rows, col_vals = padded_columns(M)
+        M = M.tocoo()  # csr -> coo keeps the nonzeros sorted by row
+        return cls(np.array(M.row, dtype=np.int32), np.array(M.col, dtype=np.int32), np.array(M.data), M.shape,
+                   np.array(col_rows, dtype=np.int32), np.array(col_vals))
+
+
+def padded_columns(M):
+    """
+    Returns the row indices + values of the nonzeros in each column of scipy sparse matrix M, padded with (0, 0) to the
+        max column nnz
+    """
+    M = sparse.csc_matrix(M)
+    counts = onp.diff(M.indptr)
+    cols = onp.repeat(onp.arange(M.shape[1]), counts)
+    slots = onp.arange(M.nnz) - onp.repeat(M.indptr[:-1], counts)
+
+    col_rows = onp.zeros((M.shape[1], max(counts.max(initial=0), 1)), dtype=int)
+    col_vals = onp.zeros(col_rows.shape)
+    col_rows[cols, slots] = M.indices
+    col_vals[cols, slots] = M.data
+    return col_rows, col_vals
+
+
+def hodge_laplacians(B1, B2, flips=None):
+    """
+    Returns the lower and upper Hodge Laplacians (L1_lower = B1.T B1, L1_upper = B2 B2.T) as scipy CSR matrices, without
+        forming any dense |E| x |E| intermediates
+
+    :param flips: optional vector of +-1 per edge; if given, returns F L F for F = diag(flips)
+    """
+    B1, B2 = sparse.csr_matrix(B1), sparse.csr_matrix(B2)
+    L1_lower = (B1.T @ B1).tocsr()
+    L1_upper = (B2 @ B2.T).tocsr()
+
+    if flips is not None:
+        F = sparse.diags(onp.asarray(flips, dtype=onp.float64))
+        L1_lower = (F @ L1_lower @ F).tocsr()
+        L1_upper = (F @ L1_upper @ F).tocsr()
+
+    return L1_lower, L1_upper
@@ -0,0 +1,224 @@
+"""
+Incremental next-node prediction for trajectories that grow one hop at a time (e.g. live tracking).
+
+The first layer of the SCoNe / SCNN / Ebli models is linear in the flow: its pre-activation is sum_k (S_k @ flow) @ W_k,
+    with S_0 = I and S_k the shifts + their powers (SCNN, Ebli). The hop over edge e (flow value s) adds
+    s * sum_k S_k[:, e] W_k to it, which only touches the rows in the nonzero pattern of column e of the S_k; powers are
+    applied recursively to that column (S^2[:, e] = S @ S[:, e]), so they are never formed. A Streaming_Predictor keeps
+    this pre-activation per trajectory, so a hop costs O(nnz of one column of each S_k) instead of a full forward pass.
+    The deeper layers + readout are then only evaluated on the edges they depend on: the readout at the last node needs
+    the last layer on the edges incident to its neighbors, which needs the layer before on those edges and their
+    neighbors up to the highest power of the shifts, and so on.
+
+Usage (see the -streaming experiment in trajectory_experiments.py):
+    predictor = Streaming_Predictor(scone, *streaming_operators(shifts), B1, nbrhoods)
+    trajectory = predictor.start(node)
+    for node in observed_nodes:
+        predictor.push(trajectory, node)
+        log_probs = predictor.predict(trajectory)  # over the neighbors of node, like Scone_GCN.predict
+"""
+from functools import partial
+import numpy as onp
+import jax.numpy as np
+from jax import jit
+from jax.scipy.special import logsumexp
+from scipy import sparse
+
+try:
+    from trajectory_analysis.synthetic_data_gen import incident_edge_tables, neighbor_edge_tables
+    from trajectory_analysis.scone_trajectory_model import fuse_weights, bucket
+except Exception:
+    from synthetic_data_gen import incident_edge_tables, neighbor_edge_tables
+    from scone_trajectory_model import fuse_weights, bucket
+
+
+def sparse_product(S, idxs, x):
+    """
+    Returns S @ x for the sparse vector x (values x at indices idxs) as (row indices, values), gathered from the columns
+        idxs of the CSC matrix S only
+    """
+    counts = onp.diff(S.indptr)[idxs]
+    positions = onp.repeat(S.indptr[idxs] - onp.cumsum(counts) + counts, counts) + onp.arange(counts.sum())
+    rows, inverse = onp.unique(S.indices[positions], return_inverse=True)
+    return rows, onp.bincount(inverse, weights=S.data[positions] * onp.repeat(x, counts), minlength=len(rows))
+
+@jit
+def add_hop(pre, rows, slots, vals, W):
+    """
+    Adds the hop's nonzeros (row, weight slot, value) of sign * S_k[:, edge] (see Streaming_Predictor.hop_columns) to the
+        first layer pre-activation pre (# edges, C): pre[row] += value * W[slot]. Padded entries have value 0
+    """
+    return pre.at[rows].add(vals[:, None] * W[slots, 0])
+
+@partial(jit, static_argnames=('orders',))
+def local_readout(pre, layers, W_out, fields, blocks, selections, positions, signs, orders):
+    """
+    Log-softmax over the neighbor slots of one node, computed from the first layer pre-activation, only over the edges
+        each layer is needed on
+
+    :param fields: for each layer, the edges it is needed on
+    :param blocks: for each deeper layer, the nonzeros (row, column, value) of each shift's block over the previous
+        layer's field; each shift is applied to the signal orders[k] times, recursively
+    :param selections: for each deeper layer, the positions of its field in the previous layer's
+    :param positions: (max degree, max degree) positions of the edges incident to each neighbor in the last layer's field
+    :param signs: matching entries of B1 (0 for padding)
+    """
+    x = np.tanh(pre[fields[0]])
+    for layer_blocks, selection, W in zip(blocks, selections, layers[1:]):
+        # powers are only exact away from the edge of the field, which the selected edges are (see receptive_field)
+        shifted = [x]
+        for (i, j, vals), k in zip(layer_blocks, orders):
+            y = x
+            for _ in range(k):
+                y = np.zeros_like(x).at[i].add(vals[:, None] * y[j])
+                shifted.append(y)
+        x = np.tanh(np.einsum('kjc,kcd->jd', np.stack(shifted), W)[selection])
+    logits = np.sum(signs[..., None] * x[positions], axis=1) @ W_out
+    return logits - logsumexp(logits) # log of the softmax function
+
+
+class Trajectory():
+    def __init__(self, node, pre):
+        """
+        Streaming state of one trajectory
+
+        :param node: first node of the trajectory
+        :param pre: first layer pre-activation of its (empty) flow
+        """
+        self.path = [int(node)]
+        self.pre = pre
+
+    @property
+    def last_node(self):
+        return self.path[-1]
+
+
+class Streaming_Predictor():
+    def __init__(self, scone, shifts, orders, B1, nbrhoods):
+        """
+        :param scone: trained Scone_GCN with a 'scone', 'scnn' or 'ebli' model (weights in either layout)
+        :param shifts: the model's shift matrices (scipy sparse or numpy arrays; see streaming_operators in
+            trajectory_experiments.py)
+        :param orders: the highest power of each shift a layer applies; the layer's weights after the identity are those
+            of S_0, S_0^2, ..., S_0^orders[0], S_1, ... (e.g. (1, 1) for scone, (k1, k2) for scnn, (3,) for ebli)
+        :param B1: node-edge incidence matrix the model was trained with (columns flipped, if edges were flipped)
+        :param nbrhoods: padded (# nodes, max degree) table of each node's sorted neighbors, padded with -1
+        """
+        if scone.n_members:
+            raise ValueError('streaming prediction is not supported for ensembles')
+        self.orders = tuple(int(k) for k in orders)
+        n_k = 1 + sum(self.orders)
+        weights = list(scone.weights)
+        if weights[0].ndim == 2:
+            weights = fuse_weights(weights, n_k)
+        self.layers = [np.asarray(W) for W in weights[:-1]]
+        self.W_out = np.asarray(weights[-1])
+        if any(W.shape[0] != n_k for W in self.layers):
+            raise ValueError('expected {} weight matrices per layer for shift orders {}'.format(n_k, self.orders))
+        if self.layers[0].shape[1] != 1:
+            raise ValueError('streaming prediction needs single-channel flows')
+
+        # the shifts (columns are gathered for hops), and the union of their nonzero patterns + the identity's
+        self.n_edges = B1.shape[1]
+        self.shifts = [sparse.csc_matrix(S) for S in shifts]
+        self.pattern = (sparse.identity(self.n_edges, format='csr') + sum(abs(S) for S in self.shifts)).tocsr()
+
+        self.nbrhoods = onp.asarray(nbrhoods)
+        self.nbr_edges, self.nbr_signs = neighbor_edge_tables(B1, self.nbrhoods)
+        self.node_edges, self.node_signs = incident_edge_tables(B1)
+        self.receptive_fields = {}
+
+    def start(self, node):
+        """
+        Returns a new trajectory starting at node
+        """
+        return Trajectory(node, np.zeros((self.n_edges, self.layers[0].shape[-1])))
+
+    def hop_columns(self, edge, sign):
+        """
+        Returns the nonzeros (rows, weight slots, values) of sign * S_k[:, edge] for every operator S_k of the first layer
+            (identity first), padded with (0, 0, 0) to a bucket size; powers are applied recursively to the column
+        """
+        rows, slots, vals = [onp.array([edge])], [onp.array([0])], [onp.array([float(sign)])]
+        for S, k in zip(self.shifts, self.orders):
+            idxs, x = rows[0], vals[0]
+            for _ in range(k):
+                idxs, x = sparse_product(S, idxs, x)
+                rows.append(idxs), slots.append(onp.full(len(idxs), len(slots))), vals.append(x)
+
+        size = sum(len(r) for r in rows)
+        padded = onp.zeros((3, bucket(size)))
+        padded[:, :size] = onp.concatenate(rows), onp.concatenate(slots), onp.concatenate(vals)
+        return np.array(padded[0], dtype=np.int32), np.array(padded[1], dtype=np.int32), np.array(padded[2])
+
+    def push(self, trajectory, node):
+        """
+        Extends trajectory by the hop from its last node to node, which must be one of its neighbors
+        """
+        slot = onp.nonzero(self.nbrhoods[trajectory.last_node] == node)[0]
+        if len(slot) == 0:
+            raise ValueError('{} is not a neighbor of {}'.format(node, trajectory.last_node))
+        edge, sign = self.nbr_edges[trajectory.last_node, slot[0]], self.nbr_signs[trajectory.last_node, slot[0]]
+
+        trajectory.pre = add_hop(trajectory.pre, *self.hop_columns(edge, sign), self.layers[0])
+        trajectory.path.append(int(node))
+        return trajectory
+
+    def from_path(self, path):
+        """
+        Returns the trajectory of path (list of nodes)
+        """
+        trajectory = self.start(path[0])
+        for node in path[1:]:
+            self.push(trajectory, node)
+        return trajectory
+
+    def predict(self, trajectory):
+        """
+        Returns the log-probabilities of the next hop from trajectory's last node, over its padded neighbor slots; dim
+            (max degree, 1), like one row of Scone_GCN.predict
+        """
+        return local_readout(trajectory.pre, self.layers, self.W_out, *self.receptive_field(trajectory.last_node),
+                             orders=self.orders)
+
+    def receptive_field(self, node):
+        """
+        Returns the inputs of local_readout for last node node (cached): the edges the first layer is needed on, the
+            deeper layers' blocks of the shifts + the positions of their fields, and the readout's positions + signs.
+            Each layer's field extends the next one's by max(orders) hops of the shifts, so the powers applied
+            recursively within it are exact on the next field. Sizes are padded to powers of 2 (padded entries of the
+            blocks are zero, and no selection or readout position of a real edge points at a padded one)
+        """
+        if node in self.receptive_fields:
+            return self.receptive_fields[node]
+
+        edges, signs = self.node_edges[self.nbrhoods[node]], self.node_signs[self.nbrhoods[node]]
+        fields = [onp.unique(edges[signs != 0])]
+        for _ in self.layers[1:]:
+            field = fields[0]
+            for _ in range(max(self.orders)):
+                field = onp.union1d(field, self.pattern[field].indices)
+            fields.insert(0, field)
+
+        blocks, selections = [], []
+        for field, next_field in zip(fields[:-1], fields[1:]):
+            layer_blocks = []
+            for S in self.shifts:
+                A = S[field][:, field].tocoo()
+                block = onp.zeros((3, bucket(A.nnz)))
+                block[:, :A.nnz] = A.row, A.col, A.data
+                i, j, vals = block
+                layer_blocks.append((np.array(i, dtype=np.int32), np.array(j, dtype=np.int32), np.array(vals)))
+            blocks.append(layer_blocks)
+            selection = onp.zeros(bucket(len(next_field), self.n_edges), dtype=int)
+            selection[:len(next_field)] = onp.searchsorted(field, next_field)
+            selections.append(np.array(selection))
+
+        padded = []
+        for field in fields:
+            padded.append(onp.zeros(bucket(len(field), self.n_edges), dtype=int))
+            padded[-1][:len(field)] = field
+        positions = onp.searchsorted(fields[-1], edges) * (signs != 0)
+
+        self.receptive_fields[node] = [np.array(field) for field in padded], blocks, selections, np.array(positions), np.array(signs)
+        return self.receptive_fields[node]
@@ -4,17 +4,26 @@ Author: Nicholas Glaze, Rice ECE (nkg2 at rice.edu)
 Synthetic dataset generation; to generate a dataset, edit the function call in __main__ and run this file. The dataset
     will be saved into two folders: trajectory_data_1hop_ + your_folder_suffix, and trajectory_data_2hop_ + suffix.
     -Generating a dataset also generates a pdf with a cool pic of your graph!
+    -For large benchmark graphs (millions of nodes), random_SC_complex() builds the complex (edges, faces, CSR adjacency)
+        with array ops only, without networkx; shortest_path_walks(..., n_anchors=...) generates (millions of) walks on it.
+        generate_dataset(..., walks='bfs') chains the two into a dataset (from the command line: trajectory_experiments.py
+        -load_data 0 -walks bfs, see its arguments).
 
 If you want to use your own data, it'd be helpful to read this, and generate a synthetic one to better understand the
     format.
 
 Description of dataset; your dataset should have all of these files:
 trajectory_data_1hop/
-    -B1.npy: B1 incidence matrix (nodes-edges); generate with incidence_matrices()
-    -B2.npy: B2 incidence matrix (edges-faces); generate with incidence_matrices()
+    -B1.npz: B1 incidence matrix (nodes-edges), as a scipy sparse matrix (saved with scipy.sparse.save_npz); generate
+        with sparse_incidence_matrices(), save with save_incidence()
+        -alternatively, B1.npy: the same matrix, dense (the format of older datasets)
+    -B2.npz: B2 incidence matrix (edges-faces), in the same format; generate with sparse_incidence_matrices()
     -flows_in.npy: array of flows, each with dimension (n_edges) representing each path; 1 if this edge is traversed
         "forward" (lower # node -> higher # node), -1 if traversed in "reverse", 0 if not traversed
-        -convert path (list of nodes) to flow with path_to_flow()
+        -convert path (list of nodes) to flow with path_to_flow(), or many paths at once with path_flows()
+        -alternatively, flows_in.npz: the same flows in ragged sparse form (edges, signs, offsets); flow i traverses
+            edges[offsets[i]:offsets[i+1]], with the matching +-1 in signs. Convert paths with path_to_sparse_flow() +
+            to_sparse_flows(); generate_dataset(..., sparse_flows=True) saves this format (also for rev_flows_in)
     -G_undir.pkl: undirected networkx graph representing the dataset's graphs
     -last_nodes.npy: the last node in each trajectory prefix; we forecast the step from this node to one of its neighbors
     -rev_flows_in.npy: same as flows_in, but reversed path direction -- (1,2,3) becomes (3,2,1)
@@ -35,11 +44,11 @@ trajectory_data_2hop/
 
 
 import numpy as np
-import networkx as nx
-from scipy.spatial import Delaunay
+from scipy import sparse
 import os
-import matplotlib.pyplot as plt
-import pandas as pd
+from itertools import chain
+# networkx, matplotlib, pandas + scipy.spatial are imported in the functions that build, plot or export datasets, so
+#   that loading a saved model (see save_model in trajectory_experiments.py) doesn't import them
 
 def strip_paths(paths):
     """
@@ -65,6 +74,8 @@ def color_faces(G, V, coords, faces, filename='graph_faces.pdf', paths=None):
     """
     Saves a plot of the graph, with faces colored in
     """
+    import networkx as nx
+    import matplotlib.pyplot as plt
     for f in np.array(faces):
         plt.gca().add_patch(plt.Polygon(coords[f], facecolor=(173/256,216/256,240/256, 0.5), ec='k', linewidth=0.3))
 
@@ -79,22 +90,23 @@ def color_faces(G, V, coords, faces, filename='graph_faces.pdf', paths=None):
             nx.draw_networkx_edges(G.to_directed(), pos=coords_dict, edgelist=edges, edge_color='red', width=1.5, arrows=True, arrowsize=7, node_size=3)
     plt.savefig(filename)
 
-def random_SC_graph(n, holes=True):
+def random_SC_complex(n, holes=True):
     """
-    Randomly generates a graph of simplicial complexes, made up of n nodes.
-    Graph has holes in top left and bottom right regions.
+    Randomly generates the simplicial complex of random_SC_graph (same nodes, edges + faces) with array ops only, without
+        building a networkx graph; scales to millions of nodes.
 
     :param n: # of nodes in graph
 
     Returns:
-        NetworkX DiGraph object G
-        Sorted list of nodes V
-        Sorted list of edges E
-        Map  (edge tuples -> indices in E) edge_to_idx
-        List of faces
+        (n, 2) array of node coordinates coords, sorted from bottom-left to top-right
+        Sorted (|E|, 2) array of edges E, each edge (smaller node, larger node)
+        Sorted (# faces, 3) array of faces, each face in increasing node order
+        Sorted array of edge keys (E[:, 0] * n + E[:, 1]); the index of edge (a, b), a < b, is
+            np.searchsorted(edge_keys, a * n + b) (the array form of edge_to_idx)
+        Symmetric n x n CSR adjacency matrix A
         List of valid node indexes (nodes not in either hole)
-
     """
+    from scipy.spatial import Delaunay
     np.random.seed(1)
     coords = np.random.rand(n,2)
 
@@ -106,36 +118,117 @@ def random_SC_graph(n, holes=True):
     np.random.seed(1030)
     tri = Delaunay(coords)
 
-    valid_idxs = np.where((np.linalg.norm(coords - [1/4, 3/4], axis=1) > 1/8) \
-                          & (np.linalg.norm(coords - [3/4, 1/4], axis=1) > 1/8))[0]
-
+    valid = (np.linalg.norm(coords - [1/4, 3/4], axis=1) > 1/8) & (np.linalg.norm(coords - [3/4, 1/4], axis=1) > 1/8)
     if not holes:
-        valid_idxs = np.array(range(len(coords)))
-    faces = np.array(sorted([sorted(t) for t in tri.simplices if np.in1d(t, valid_idxs).all()]))
+        valid[:] = True
+    valid_idxs = np.where(valid)[0]
+
+    # faces with all 3 nodes valid, each sorted, in lexicographic order
+    faces = np.sort(tri.simplices[valid[tri.simplices].all(axis=1)], axis=1)
+    faces = faces[np.lexsort(faces.T[::-1])]
+
+    # edges (a, b), (b, c), (a, c) of every face (a, b, c), deduplicated by their key a * n + b
+    tails, heads = faces[:, [0, 1, 0]].ravel().astype(np.int64), faces[:, [1, 2, 2]].ravel().astype(np.int64)
+    edge_keys = np.sort(tails * n + heads)
+    edge_keys = edge_keys[np.r_[True, edge_keys[1:] != edge_keys[:-1]]]
+    E = np.stack([edge_keys // n, edge_keys % n], axis=1).astype(faces.dtype)
+
+    A = sparse.csr_matrix((np.ones(2 * len(E), dtype=np.int8), (np.concatenate([E[:, 0], E[:, 1]]), np.concatenate([E[:, 1], E[:, 0]]))),
+                          shape=(n, n))
+    return coords, E, faces, edge_keys, A, valid_idxs
+
+def random_SC_graph(n, holes=True):
+    """
+    Randomly generates a graph of simplicial complexes, made up of n nodes.
+    Graph has holes in top left and bottom right regions. The complex is built by random_SC_complex; use that directly
+        for large graphs, where the networkx graph + edge_to_idx dict are slow to build.
+
+    :param n: # of nodes in graph
+
+    Returns:
+        NetworkX DiGraph object G
+        Sorted list of nodes V
+        Sorted list of edges E
+        Map  (edge tuples -> indices in E) edge_to_idx
+        List of faces
+        List of valid node indexes (nodes not in either hole)
+
+    """
+    import networkx as nx
+    coords, E, faces, _, A, valid_idxs = random_SC_complex(n, holes=holes)
 
     # SC matrix construction
     G = nx.DiGraph()
     G.add_nodes_from(np.arange(n)) # add nodes that are excluded to keep indexing easy
-    E = []
-    for f in faces:
-        [a,b,c] = sorted(f)
-        E.append((a,b))
-        E.append((b,c))
-        E.append((a,c))
-
+    G.add_edges_from(E.tolist())
     V = np.array(G.nodes)
-    E = np.array(sorted(set(E)))
-
-    for e in E:
-        G.add_edge(*e)
 
-
-    edge_to_idx = {tuple(E[i]): i for i in range(len(E))}
-    print('Average degree:', np.average([G.degree[node] for node in range(n)]))
+    edge_to_idx = dict(zip(map(tuple, E.tolist()), range(len(E))))
+    print('Average degree:', A.nnz / n)
     print('Nodes:', len(V), 'Edges:', len(E))
 
     return G, V, E, faces, edge_to_idx, coords, valid_idxs
 
+def closed_wedges(indptr, indices, edge_keys):
+    """
+    Returns the triangles (u, v, w) of an oriented graph: every wedge u -> v -> w that is closed by an edge u -> w
+
+    :param indptr, indices: CSR structure of the oriented graph, with sorted indices
+    :param edge_keys: sorted keys u * n + w of its edges
+    """
+    n = len(indptr) - 1
+    u = np.repeat(np.arange(n), np.diff(indptr))
+    v = indices
+
+    # out-neighbors w of each v, gathered for every edge u -> v
+    counts = np.diff(indptr)[v]
+    offsets = np.repeat(indptr[v] - (np.cumsum(counts) - counts), counts)
+    u, v, w = np.repeat(u, counts), np.repeat(v, counts), indices[np.arange(counts.sum()) + offsets]
+
+    keys = u.astype(np.int64) * n + w
+    closed = edge_keys[np.minimum(np.searchsorted(edge_keys, keys), len(edge_keys) - 1)] == keys
+    return np.stack([u[closed], v[closed], w[closed]], axis=1)
+
+def triangles(A):
+    """
+    Returns the triangles (faces) of an undirected graph as a sorted (# faces, 3) array, each face in increasing node
+        order, as used by incidence_matrices + sparse_incidence_matrices
+
+    Each edge is oriented from the endpoint of lower to higher (degree, node), so each triangle is found exactly once,
+        as a closed wedge (see closed_wedges); a node has O(sqrt(|E|)) out-neighbors of higher degree, so this takes
+        O(|E|^1.5) time + memory (vs. O(sum of deg^2) for all wedges).
+
+    :param A: n x n adjacency matrix (scipy sparse or dense); only its nonzero pattern is used
+    """
+    A = sparse.coo_matrix(A)
+    n = A.shape[0]
+    rows, cols = A.row[A.row != A.col], A.col[A.row != A.col]
+    degrees = np.bincount(np.concatenate([rows, cols]), minlength=n)  # 2x the degree if A is symmetric; same order
+    rank = np.empty(n, dtype=np.int64)
+    rank[np.lexsort((np.arange(n), degrees))] = np.arange(n)
+
+    # oriented graph over node ranks, lower -> higher
+    tails, heads = np.minimum(rank[rows], rank[cols]), np.maximum(rank[rows], rank[cols])
+    U = sparse.csr_matrix((np.ones(len(tails), dtype=np.int8), (tails, heads)), shape=(n, n))
+    U.sum_duplicates()
+    edge_keys = np.repeat(np.arange(n, dtype=np.int64), np.diff(U.indptr)) * n + U.indices
+
+    found = closed_wedges(U.indptr, U.indices, edge_keys)
+
+    # back to nodes, each face sorted, faces in lexicographic order
+    faces = np.sort(np.argsort(rank)[found], axis=1)
+    return faces[np.lexsort(faces.T[::-1])]
+
+def get_faces(G):
+    """
+    Returns the faces (triangles) of an undirected networkx graph, as a sorted (# faces, 3) array of nodes, each face in
+        increasing node order (see triangles)
+    """
+    nodes = np.array(sorted(G.nodes))
+    edges = np.searchsorted(nodes, np.array(list(G.edges)).reshape((-1, 2)))
+    A = sparse.coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(len(nodes), len(nodes)))
+    return nodes[triangles(A)]
+
 def incidence_matrices(G, V, E, faces, edge_to_idx):
     """
     Returns incidence matrices B1 and B2
@@ -145,10 +238,11 @@ def incidence_matrices(G, V, E, faces, edge_to_idx):
     :param E: list of edges
     :param faces: list of faces in G
 
-    Returns B1 (|V| x |E|) and B2 (|E| x |faces|)
+    Returns B1 (|V| x |E|) and B2 (|E| x |faces|), as dense arrays (see sparse_incidence_matrices for large complexes)
     B1[i][j]: -1 if node is is tail of edge j, 1 if node is head of edge j, else 0 (tail -> head) (smaller -> larger)
     B2[i][j]: 1 if edge i appears sorted in face j, -1 if edge i appears reversed in face j, else 0; given faces with sorted node order
     """
+    import networkx as nx
     B1 = np.array(nx.incidence_matrix(G, nodelist=V, edgelist=E, oriented=True).todense())
     B2 = np.zeros([len(E),len(faces)])
 
@@ -160,6 +254,57 @@ def incidence_matrices(G, V, E, faces, edge_to_idx):
         B2[e_idxs[-1], f_idx] = -1
     return B1, B2
 
+def sparse_incidence_matrices(n, E, faces):
+    """
+    Returns incidence matrices B1 (n x |E|) and B2 (|E| x |faces|) as scipy CSC matrices, with the entries of
+        incidence_matrices, built straight from index arrays: time + memory are linear in the size of the complex
+
+    :param n: # of nodes
+    :param E: (|E|, 2) array of edges in any order, each edge (smaller node, larger node); columns follow its order
+    :param faces: (# faces, 3) array of faces, each face in increasing node order
+    """
+    E, faces = np.asarray(E, dtype=np.int64).reshape((-1, 2)), np.asarray(faces, dtype=np.int64).reshape((-1, 3))
+    B1 = sparse.csc_matrix((np.tile([-1., 1.], len(E)), (E.ravel(), np.repeat(np.arange(len(E)), 2))), shape=(n, len(E)))
+
+    # edges (a, b), (b, c), (a, c) of face (a, b, c), found by their keys a * n + b among the sorted edge keys
+    edge_keys = E[:, 0] * n + E[:, 1]
+    order = np.argsort(edge_keys)
+    edge_keys = edge_keys[order]
+    face_keys = faces[:, [0, 1, 0]] * n + faces[:, [1, 2, 2]]
+    e_idxs = np.minimum(np.searchsorted(edge_keys, face_keys), len(E) - 1)
+    if np.any(edge_keys[e_idxs] != face_keys):
+        raise ValueError('faces must only contain edges in E')
+    e_idxs = order[e_idxs]
+    B2 = sparse.csc_matrix((np.tile([1., 1., -1.], len(faces)), (e_idxs.ravel(), np.repeat(np.arange(len(faces)), 3))),
+                           shape=(len(E), len(faces)))
+    return B1, B2
+
+def graph_incidence_matrices(G):
+    """
+    Returns the sparse incidence matrices B1 + B2 (see sparse_incidence_matrices) of an undirected networkx graph, with
+        the triangles of G as faces; rows + columns follow the sorted nodes + edges of G
+    """
+    nodes = np.array(sorted(G.nodes))
+    E = np.sort(np.searchsorted(nodes, np.array(list(G.edges)).reshape((-1, 2))), axis=1)
+    E = E[np.lexsort(E.T[::-1])]
+    A = sparse.coo_matrix((np.ones(len(E)), (E[:, 0], E[:, 1])), shape=(len(nodes), len(nodes)))
+    return sparse_incidence_matrices(len(nodes), E, triangles(A))
+
+def save_incidence(filename, B):
+    """
+    Saves incidence matrix B (sparse or dense) to filename + '.npz', as a scipy sparse matrix
+    """
+    sparse.save_npz(filename + '.npz', sparse.csc_matrix(B))
+
+def load_incidence(filename):
+    """
+    Loads the incidence matrix saved by save_incidence, or the dense filename + '.npy' of older datasets; returns a scipy
+        CSC matrix either way
+    """
+    if os.path.exists(filename + '.npz'):
+        return sparse.csc_matrix(sparse.load_npz(filename + '.npz'))
+    return sparse.csc_matrix(np.load(filename + '.npy'))
+
 def faces_from_B2(B2, E):
     """
     Given a B2 matrix, returns the list of faces.
@@ -198,24 +343,8 @@ def generate_random_walks(G, points, valid_idxs, m=1000):
             i,j is -1 if decreasing node #
             else 0
     """
-    points_valid = points[valid_idxs]
-
-    # "partition" node space
-    # 0: middle
-    # 1: upper
-    # 2: lower
-    BEGIN = valid_idxs[np.sum(points_valid, axis=1) < 1 / 4]
-    END = valid_idxs[np.sum(points_valid, axis=1) > 7 / 4]
-
-    A012 = valid_idxs[(np.sum(points_valid, axis=1) > 1 / 4) & (np.sum(points_valid, axis=1) < 1)]
-    A0 = A012[(points[A012, 1] - points[A012, 0] < 1 / 2) & (points[A012, 1] - points[A012, 0] > -1 / 2)]
-    A1 = A012[points[A012, 1] - points[A012, 0] > 1 / 2]
-    A2 = A012[points[A012, 1] - points[A012, 0] < -1 / 2]
-
-    B012 = valid_idxs[(np.sum(points_valid, axis=1) < 7 / 4) & (np.sum(points_valid, axis=1) > 1)]
-    B0 = B012[(points[B012, 1] - points[B012, 0] < 1 / 2) & (points[B012, 1] - points[B012, 0] > -1 / 2)]
-    B1_ = B012[points[B012, 1] - points[B012, 0] > 1 / 2]
-    B2_ = B012[points[B012, 1] - points[B012, 0] < -1 / 2]
+    import networkx as nx
+    BEGIN, (A0, A1, A2), (B0, B1_, B2_), END = walk_regions(points, valid_idxs)
 
     paths = []
     G_undir = G.to_undirected()
@@ -242,6 +371,210 @@ def generate_random_walks(G, points, valid_idxs, m=1000):
 
     return G_undir, paths
 
+def walk_regions(points, valid_idxs):
+    """
+    Partitions the valid nodes into the regions walks go through: returns BEGIN, (A0, A1, A2), (B0, B1, B2), END, where
+        region 0 is the middle, 1 the upper and 2 the lower band of the graph (see generate_random_walks)
+    """
+    points_valid = points[valid_idxs]
+
+    # "partition" node space
+    # 0: middle
+    # 1: upper
+    # 2: lower
+    BEGIN = valid_idxs[np.sum(points_valid, axis=1) < 1 / 4]
+    END = valid_idxs[np.sum(points_valid, axis=1) > 7 / 4]
+
+    A012 = valid_idxs[(np.sum(points_valid, axis=1) > 1 / 4) & (np.sum(points_valid, axis=1) < 1)]
+    A0 = A012[(points[A012, 1] - points[A012, 0] < 1 / 2) & (points[A012, 1] - points[A012, 0] > -1 / 2)]
+    A1 = A012[points[A012, 1] - points[A012, 0] > 1 / 2]
+    A2 = A012[points[A012, 1] - points[A012, 0] < -1 / 2]
+
+    B012 = valid_idxs[(np.sum(points_valid, axis=1) < 7 / 4) & (np.sum(points_valid, axis=1) > 1)]
+    B0 = B012[(points[B012, 1] - points[B012, 0] < 1 / 2) & (points[B012, 1] - points[B012, 0] > -1 / 2)]
+    B1_ = B012[points[B012, 1] - points[B012, 0] > 1 / 2]
+    B2_ = B012[points[B012, 1] - points[B012, 0] < -1 / 2]
+    return BEGIN, (A0, A1, A2), (B0, B1_, B2_), END
+
+# per walk generating process: graph, regions + (if every region node is an anchor) BFS trees (see shortest_path_walks)
+WALKER = {}
+
+def anchor_trees(A, anchors):
+    """
+    Builds the BFS predecessor tree of each anchor on the symmetric CSR graph A
+
+    :param anchors: list of anchor arrays: one for each A region, then one for END
+    Returns a dict with the (# anchors, n) predecessors preds (negative for the root + unreachable nodes), the branch of
+        each node in each tree (the root's child its path to the root goes through, the root for itself + unreachable
+        nodes), the roots, and the tree indices of each A region's (a_trees) + of END's (end_trees) anchors
+    """
+    from scipy.sparse.csgraph import breadth_first_order
+    roots = np.concatenate(anchors)
+    # A is symmetric, so a directed BFS gives the undirected tree without converting A to CSC for every root
+    preds = np.stack([breadth_first_order(A, root, directed=True, return_predecessors=True)[1] for root in roots]).astype(np.int32)
+
+    # pointer jumping: every node points at its parent until that is a child of the root, which points at itself
+    branches = np.empty_like(preds)
+    nodes = np.arange(A.shape[0], dtype=preds.dtype)
+    for pred, root, branch in zip(preds, roots, branches):
+        branch[:] = np.where((pred == root) | (pred < 0), nodes, pred)
+        while True:
+            jumped = branch[branch]
+            if np.array_equal(jumped, branch):
+                break
+            branch[:] = jumped
+
+    tree_idxs = np.split(np.arange(len(roots)), np.cumsum([len(a) for a in anchors])[:-1])
+    return {'preds': preds, 'branches': branches, 'roots': roots, 'a_trees': tree_idxs[:3], 'end_trees': tree_idxs[3]}
+
+def tree_walks(preds, trees, starts, roots):
+    """
+    Walks from each start node up its BFS tree to the root, i.e. along a shortest path start -> root
+
+    :param preds: (# trees, n) predecessor of each node in each tree (negative for the root + unreachable nodes)
+    :param trees, starts, roots: tree, start node + root node of each walk
+    Returns the (# walks, max length) walks, padded with -1, and whether each start reaches its root
+    """
+    walks = [starts]
+    reached = np.ones(len(starts), dtype=bool)
+    # only the walks that haven't reached their root yet are stepped
+    active = np.nonzero(starts != roots)[0]
+    cur = starts[active]
+    while len(active):
+        nxt = preds[trees[active], cur]
+        reached[active[nxt < 0]] = False
+        step = np.full(len(starts), -1, dtype=starts.dtype)
+        step[active] = np.maximum(nxt, -1)
+        walks.append(step)
+        keep = (nxt >= 0) & (nxt != roots[active])
+        active, cur = active[keep], nxt[keep]
+    return np.stack(walks, axis=1), reached
+
+def candidate_walks(rng, trees, region, size):
+    """
+    Samples size walks BEGIN -> A -> B -> END through region 0, 1 or 2 (see shortest_path_walks), with A + END nodes
+        drawn from the anchors of trees (see anchor_trees); returns the valid ones (simple paths) as a (# valid, max
+        length) array padded with -1 on the right
+    """
+    BEGIN, Bs = WALKER['BEGIN'], WALKER['Bs']
+    preds, branches, roots = trees['preds'], trees['branches'], trees['roots']
+    a_tree = trees['a_trees'][region][rng.integers(len(trees['a_trees'][region]), size=size)]
+    end_tree = trees['end_trees'][rng.integers(len(trees['end_trees']), size=size)]
+    v_begin, v_2 = rng.choice(BEGIN, size), rng.choice(Bs[region], size)
+
+    # v_begin -> v_1 + v_2 -> v_1 both end in v_1's tree, so they only meet at v_1 if they come from different branches;
+    #   most rejected walks fail this, so they are dropped before being assembled
+    keep = branches[a_tree, v_begin] != branches[a_tree, v_2]
+    a_tree, end_tree, v_begin, v_2 = a_tree[keep], end_tree[keep], v_begin[keep], v_2[keep]
+    v_1, v_end = roots[a_tree], roots[end_tree]
+    size = len(a_tree)
+
+    # v_begin -> v_1 + v_2 -> v_1 in v_1's tree, v_2 -> v_end in v_end's tree
+    first, ok_1 = tree_walks(preds, a_tree, v_begin, v_1)
+    middle, ok_2 = tree_walks(preds, a_tree, v_2, v_1)
+    last, ok_3 = tree_walks(preds, end_tree, v_2, v_end)
+
+    # path = first[:-1] + reversed(middle)[:-1] + last, i.e. v_1 .. the node before v_2, then v_2 .. v_end
+    len_1, len_2 = (first >= 0).sum(axis=1), (middle >= 0).sum(axis=1)
+    first[np.arange(size), len_1 - 1] = -1
+    cols = np.arange(middle.shape[1] - 1)
+    middle = np.where(cols < len_2[:, None] - 1, np.take_along_axis(middle, np.maximum(len_2[:, None] - 1 - cols, 0), axis=1), -1)
+    joined = np.concatenate([first, middle, last], axis=1)
+
+    # left-align each path
+    valid = joined >= 0
+    paths = np.full((size, valid.sum(axis=1).max(initial=0)), -1, dtype=joined.dtype)
+    paths[np.nonzero(valid)[0], (np.cumsum(valid, axis=1) - 1)[valid]] = joined[valid]
+
+    # simple paths only: no node repeats within a row
+    nodes = np.sort(paths, axis=1)
+    simple = ~np.any((nodes[:, 1:] == nodes[:, :-1]) & (nodes[:, 1:] >= 0), axis=1)
+    return paths[ok_1 & ok_2 & ok_3 & simple]
+
+def walk_chunk(start, stop, seed):
+    """
+    Generates walks start..stop - 1 (walk i goes through region i % 3) from the random stream seed (a SeedSequence);
+        returns their nodes, concatenated, + the length of each walk
+    """
+    rng = np.random.default_rng(seed)
+    if WALKER['n_anchors'] is None:
+        trees = WALKER['trees']
+    else:
+        trees = anchor_trees(WALKER['A'], [rng.choice(region, min(WALKER['n_anchors'], len(region)), replace=False)
+                                           for region in WALKER['As'] + (WALKER['END'],)])
+
+    idxs = np.arange(start, stop)
+    region_paths = []
+    for region in range(3):
+        n_walks, accepted = np.sum(idxs % 3 == region), []
+        while sum(len(a) for a in accepted) < n_walks:
+            accepted.append(candidate_walks(rng, trees, region, max(2 * (n_walks - sum(len(a) for a in accepted)), 16)))
+        width = max(a.shape[1] for a in accepted)
+        region_paths.append(np.concatenate([np.pad(a, ((0, 0), (0, width - a.shape[1])), constant_values=-1) for a in accepted])[:n_walks])
+
+    # interleave the regions' walks, then concatenate the (left-aligned) rows
+    paths = np.full((len(idxs), max(p.shape[1] for p in region_paths)), -1, dtype=region_paths[0].dtype)
+    for region in range(3):
+        paths[idxs % 3 == region, :region_paths[region].shape[1]] = region_paths[region]
+    return paths[paths >= 0], (paths >= 0).sum(axis=1)
+
+def init_walker(state):
+    WALKER.clear()
+    WALKER.update(state)
+
+def shortest_path_walks(A, points, valid_idxs, m=1000, n_anchors=None, seed=0, n_jobs=1, chunk_size=3000):
+    """
+    Generates m walks like generate_random_walks (walk i goes BEGIN -> A_k -> B_k -> END along shortest paths, with
+        k = i % 3, and is a simple path), at scale: walks are assembled in batches, with array ops, by following the BFS
+        predecessor trees of their A + END nodes (the anchors) on the CSR graph.
+
+    Anchors: by default, every node of each A region + of END is an anchor, and each walk draws its A + END nodes
+        uniformly, as generate_random_walks does; the trees are built once, which takes (|A0| + |A1| + |A2| + |END|)
+        BFS runs + as many n int32 arrays, so this only suits small + medium graphs. With n_anchors set, each chunk
+        draws its own n_anchors anchors of each A region + of END (uniformly, from its random stream) and builds their
+        trees, i.e. 4 * n_anchors BFS runs per chunk, and its walks draw their A + END nodes among those; the A + END
+        nodes are then still uniform over the regions, but walks of the same chunk share them, and only about
+        n_anchors^2 (A, END) pairs per region + chunk occur. Raise chunk_size to spend fewer BFS runs per walk, lower it
+        (or raise n_anchors) for more distinct pairs.
+
+    Walks are generated in chunks of chunk_size, each from its own random stream (spawned from seed), so the result only
+        depends on seed + chunk_size, not on n_jobs.
+
+    :param A: n x n adjacency matrix (scipy sparse), e.g. from random_SC_complex
+    :param points: list of (x, y) points that make up the graph's nodes
+    :param valid_idxs: list of valid node indexes
+    :param m: # of walks to generate
+    :param n_anchors: None to use every region node as an anchor, else the (max) # of anchors per region + chunk
+    :param n_jobs: if > 1, chunks are generated in this many worker processes
+
+    Returns (nodes, offsets): walk i is nodes[offsets[i]:offsets[i+1]]
+    """
+    A = sparse.csr_matrix(A)
+    A = sparse.csr_matrix(A + A.T)
+    BEGIN, As, Bs, END = walk_regions(points, valid_idxs)
+    state = {'A': A, 'BEGIN': BEGIN, 'As': As, 'Bs': Bs, 'END': END, 'n_anchors': n_anchors}
+    if n_anchors is None:
+        state['trees'] = anchor_trees(A, list(As) + [END])
+
+    chunk_size = -(-int(chunk_size) // 3) * 3  # whole region cycles per chunk
+    bounds = list(range(0, m, chunk_size)) + [m]
+    seeds = np.random.SeedSequence(seed).spawn(len(bounds) - 1)
+    if n_jobs > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn, not fork: the calling process may already run jax
+        with ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context('spawn'), initializer=init_walker,
+                                 initargs=(state,)) as pool:
+            chunks = list(pool.map(walk_chunk, bounds[:-1], bounds[1:], seeds))
+    else:
+        init_walker(state)
+        chunks = [walk_chunk(start, stop, seed) for start, stop, seed in zip(bounds[:-1], bounds[1:], seeds)]
+        WALKER.clear()
+
+    nodes = np.concatenate([c[0] for c in chunks])
+    offsets = np.concatenate([[0], np.cumsum(np.concatenate([c[1] for c in chunks]))])
+    return nodes, offsets
+
 def split_paths(paths, truncate_paths=True, suffix_size=2):
     """
     Truncates paths (if indicated), then splits each into prefix + suffix
@@ -278,6 +611,50 @@ def generate_Bconds(G_undir, B1, last_nodes, max_degree):
         B_conds.append(B_cond)
     return B_conds
 
+def incident_edge_tables(B1):
+    """
+    Returns, for each node, the indices of its incident edges and the matching entries of B1 (edge orientations), padded
+        with (0, 0) to the max degree. An extra padding row is appended, so node index -1 selects no edges.
+        Row v of B1 @ x is then np.sum(signs[v] * x[edges[v]]), without touching the other |E| - deg(v) entries of x
+    """
+    B1 = sparse.csr_matrix(B1)
+    counts = np.diff(B1.indptr)
+    rows = np.repeat(np.arange(B1.shape[0]), counts)
+    slots = np.arange(B1.nnz) - np.repeat(B1.indptr[:-1], counts)
+
+    edges = np.zeros((B1.shape[0] + 1, counts.max()), dtype=int)
+    signs = np.zeros((B1.shape[0] + 1, counts.max()))
+    edges[rows, slots] = B1.indices
+    signs[rows, slots] = B1.data
+    return edges, signs
+
+def neighbor_edge_tables(B1, nbrhoods):
+    """
+    Returns, for each node v and neighbor slot k of the padded nbrhoods table (-1 = padding), the index of the edge
+        between v and nbrhoods[v, k], and the flow value of the hop v -> nbrhoods[v, k], i.e. -B1[v, edge] (1 if the hop
+        follows the edge orientation, tail -> head, else -1; see path_to_flow). Padded slots get (0, 0)
+    """
+    B1 = sparse.csc_matrix(B1)
+    B1.sort_indices()
+    if np.any(np.diff(B1.indptr) != 2):
+        raise ValueError('each column of B1 must have exactly two nonzeros')
+    ends, orientation = B1.indices.reshape((-1, 2)), B1.data.reshape((-1, 2))
+
+    # (node, node) -> edge index + 1
+    n = max(B1.shape[0], len(nbrhoods))
+    lookup = sparse.csr_matrix((np.arange(1, B1.shape[1] + 1), (ends[:, 0], ends[:, 1])), shape=(n, n))
+    lookup = (lookup + lookup.T).tocsr()
+
+    nbrhoods = np.asarray(nbrhoods)
+    nodes = np.broadcast_to(np.arange(nbrhoods.shape[0])[:, None], nbrhoods.shape)
+    valid = nbrhoods >= 0
+    edges = np.zeros(nbrhoods.shape, dtype=int)
+    edges[valid] = np.asarray(lookup[nodes[valid], nbrhoods[valid]]).ravel() - 1
+
+    signs = np.zeros(nbrhoods.shape)
+    signs[valid] = -np.where(ends[edges, 0] == nodes, orientation[edges, 0], orientation[edges, 1])[valid]
+    return edges, signs
+
 def neighborhood(G, v):
     '''
     G: networkx undirected graph
@@ -343,53 +720,225 @@ def path_to_flow(path, edge_to_idx, m):
             f[k] -= 1
     return f
 
-def path_dataset(G_undir, E, edge_to_idx, paths, max_degree, include_2hop=True, truncate_paths=True):
+def path_to_sparse_flow(path, edge_to_idx):
+    '''
+    Sparse version of path_to_flow: returns the indices of the edges traversed by path, and their signs (1 if
+        traversed forward, lower # node -> higher # node, else -1)
+    '''
+    edges, signs = [], []
+    for v0, v1 in zip(path[:-1], path[1:]):
+        if v0 < v1:
+            edges.append(edge_to_idx[(v0,v1)])
+            signs.append(1)
+        else:
+            edges.append(edge_to_idx[(v1,v0)])
+            signs.append(-1)
+    return np.array(edges, dtype=np.int32), np.array(signs, dtype=np.int8)
+
+def to_sparse_flows(flows):
+    """
+    Converts flows to the ragged sparse format (edges, signs, offsets): flow i traverses edges[offsets[i]:offsets[i+1]]
+        with signs signs[offsets[i]:offsets[i+1]]
+
+    :param flows: list of (edges, signs) pairs from path_to_sparse_flow, or dense flows of shape (n_flows, n_edges, 1)
     """
-    Builds necessary matrices for 1-hop and 2-hop learning, from a list of paths
+    if isinstance(flows, np.ndarray):
+        flows = flows.reshape((flows.shape[0], -1))
+        flows = [(np.nonzero(f)[0], f[np.nonzero(f)[0]]) for f in flows]
+    lengths = [len(e) for e, _ in flows]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    edges = np.concatenate([e for e, _ in flows] + [np.zeros(0)]).astype(np.int32)
+    signs = np.concatenate([s for _, s in flows] + [np.zeros(0)]).astype(np.int8)
+    return edges, signs, offsets
+
+def pad_sparse_flows(edges, signs, offsets):
     """
-    # 1-hop
-    prefixes_1hop, suffixes, last_nodes = split_paths(paths, truncate_paths=truncate_paths,
-                                                      suffix_size=(2 if include_2hop else 1))
-    suffixes_1hop = [s[0] for s in suffixes]
-    prefix_flows = np.array([path_to_flow(p, edge_to_idx, len(E)) for p in prefixes_1hop])
+    Pads ragged sparse flows to arrays of shape (n_flows, max path length), padded with edge 0 + sign 0
+    """
+    lengths = np.diff(offsets)
+    flows = np.repeat(np.arange(len(lengths)), lengths)
+    slots = np.arange(len(edges)) - np.repeat(offsets[:-1], lengths)
 
-    targets = np.array(
-        [neighborhood_to_onehot(neighborhood(G_undir, prefix[-1]), suffix, max_degree) for prefix, suffix in
-         zip(prefixes_1hop, suffixes_1hop)])
+    edges_pad = np.zeros((len(lengths), max(lengths.max(initial=0), 1)), dtype=np.int32)
+    signs_pad = np.zeros(edges_pad.shape, dtype=np.float32)
+    edges_pad[flows, slots] = edges
+    signs_pad[flows, slots] = signs
+    return edges_pad, signs_pad
 
-    if not include_2hop:
-        return prefix_flows, targets, last_nodes, suffixes_1hop, [], [], [], []
+def dense_flows(edges, signs, offsets, m):
+    """
+    Converts ragged sparse flows back to dense flows of shape (n_flows, m, 1)
+    """
+    lengths = np.diff(offsets)
+    flows = np.zeros((len(lengths), m, 1))
+    np.add.at(flows, (np.repeat(np.arange(len(lengths)), lengths), edges, 0), signs)
+    return flows
 
-    # 2-hop
-    prefixes_2hop = [np.concatenate([p, [s]]) for p, s in zip(prefixes_1hop, suffixes_1hop)]
-    suffixes_2hop = [s[1] for s in suffixes]
-    last_nodes_2hop = [s[0] for s in suffixes]
-    prefix_flows_2hop = np.array([path_to_flow(p, edge_to_idx, len(E)) for p in prefixes_2hop])
+def save_flows(filename, flows):
+    """
+    Saves flows to filename + '.npy' if dense, or to filename + '.npz' if in the ragged sparse format
+    """
+    if isinstance(flows, tuple):
+        edges, signs, offsets = flows
+        np.savez(filename + '.npz', edges=edges, signs=signs, offsets=offsets)
+    else:
+        np.save(filename + '.npy', flows)
 
-    targets_2hop = np.array(
-        [neighborhood_to_onehot(neighborhood(G_undir, prefix[-1]), suffix, max_degree) for prefix, suffix in
-         zip(prefixes_2hop, suffixes_2hop)])
+def load_flows(filename):
+    """
+    Loads flows saved by save_flows; returns dense flows, or a ragged sparse (edges, signs, offsets) tuple
+    """
+    if os.path.exists(filename + '.npz'):
+        f = np.load(filename + '.npz')
+        return f['edges'], f['signs'], f['offsets']
+    return np.load(filename + '.npy')
 
-    return prefix_flows, targets, last_nodes, suffixes_1hop, prefix_flows_2hop, targets_2hop, last_nodes_2hop, suffixes_2hop
+def edge_lookup(E, n, tails, heads, symmetric=False):
+    """
+    Returns the index in E of each edge (tails[i], heads[i]) (in either orientation), by searchsorted on the sorted edge
+        keys tail * n + head; -1 for node pairs that are not edges. If symmetric, returns instead the slot of heads[i]
+        among the sorted neighbors of tails[i] (the row of neighborhood_to_onehot), -1 if it isn't a neighbor
 
-def generate_dataset(n, m, folder, holes=True):
-    # generate graph
-    G, V, E, faces, edge_to_idx, coords, valid_idxs = random_SC_graph(n, holes=holes)
+    :param E: (|E|, 2) array of edges
+    :param n: any integer larger than every node
+    """
+    E = np.asarray(E, dtype=np.int64).reshape((-1, 2))
+    tails, heads = np.asarray(tails, dtype=np.int64), np.asarray(heads, dtype=np.int64)
+    if symmetric:
+        keys = np.sort(np.concatenate([E[:, 0] * n + E[:, 1], E[:, 1] * n + E[:, 0]]))
+        queries = tails * n + heads
+    else:
+        keys = np.minimum(E[:, 0], E[:, 1]) * n + np.maximum(E[:, 0], E[:, 1])
+        order = np.argsort(keys)
+        keys = keys[order]
+        queries = np.minimum(tails, heads) * n + np.maximum(tails, heads)
+    idxs = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    found = (keys[idxs] == queries) if len(keys) else np.zeros(len(queries), dtype=bool)
+    if symmetric:
+        # position among the keys tails[i] * n + (neighbor)
+        idxs = idxs - np.searchsorted(keys, tails * n)
+    else:
+        idxs = order[idxs] if len(keys) else idxs
+    return np.where(found, idxs, -1)
 
+def path_flows(nodes, offsets, E, n):
+    """
+    Batch version of path_to_sparse_flow: converts ragged paths (path i is nodes[offsets[i]:offsets[i+1]], each with at
+        least one node) to ragged sparse flows (edges, signs, offsets) (see to_sparse_flows) in one vectorized pass
+    """
+    nodes, offsets = np.asarray(nodes, dtype=np.int64), np.asarray(offsets, dtype=np.int64)
+    # hops between consecutive nodes of the same path
+    same_path = np.ones(max(len(nodes) - 1, 0), dtype=bool)
+    same_path[offsets[1:-1] - 1] = False
+    tails, heads = nodes[:-1][same_path], nodes[1:][same_path]
+
+    edges = edge_lookup(E, n, tails, heads)
+    if np.any(edges < 0):
+        raise ValueError('paths must only traverse edges in E')
+    signs = np.where(tails < heads, 1, -1).astype(np.int8)
+    return edges.astype(np.int32), signs, offsets - np.arange(len(offsets))
+
+def path_datasets(E, path_sets, max_degree, include_2hop=True, truncate_paths=True, sparse_flows=False):
+    """
+    Builds the matrices of path_dataset for several sets of paths at once (e.g. forward + reversed paths): the prefixes of
+        every set + hop are encoded together, in one vectorized pass (path_flows for the flows, edge_lookup for the target
+        slots). Returns the outputs of path_dataset for each set
 
+    :param E: (|E|, 2) array of edges
+    :param path_sets: list of lists of paths (each a list of nodes)
+    """
+    suffix_size = 2 if include_2hop else 1
+    splits = [split_paths(paths, truncate_paths=truncate_paths, suffix_size=suffix_size) for paths in path_sets]
+
+    # one ragged array of prefixes per set + hop; the 2-hop prefixes are the 1-hop ones + their first suffix node
+    variants = []
+    for prefixes, suffixes, last_nodes in splits:
+        lengths = np.array([len(p) for p in prefixes], dtype=np.int64)
+        nodes = np.fromiter(chain.from_iterable(prefixes), dtype=np.int64, count=lengths.sum())
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        suffixes = np.asarray(suffixes, dtype=np.int64).reshape((-1, suffix_size))
+        variants.append((nodes, offsets, np.asarray(last_nodes, dtype=np.int64), suffixes[:, 0]))
+        if include_2hop:
+            variants.append((np.insert(nodes, offsets[1:], suffixes[:, 0]), offsets + np.arange(len(offsets)), suffixes[:, 0], suffixes[:, 1]))
+
+    nodes = np.concatenate([v[0] for v in variants])
+    offsets = np.concatenate([[0]] + [v[1][1:] + sum(len(u[0]) for u in variants[:k]) for k, v in enumerate(variants)])
+    last_nodes, next_nodes = np.concatenate([v[2] for v in variants]), np.concatenate([v[3] for v in variants])
+    n = int(max(np.max(E, initial=0), np.max(nodes, initial=0))) + 1
+
+    edges, signs, flow_offsets = path_flows(nodes, offsets, E, n)
+    slots = edge_lookup(E, n, last_nodes, next_nodes, symmetric=True)
+    targets = np.zeros((len(slots), max_degree, 1))
+    targets[np.nonzero(slots >= 0)[0], slots[slots >= 0], 0] = 1
+
+    # split back into sets + hops
+    results, start = [], 0
+    for k in range(len(variants)):
+        stop = start + len(variants[k][1]) - 1
+        flows = (edges[flow_offsets[start]:flow_offsets[stop]], signs[flow_offsets[start]:flow_offsets[stop]],
+                 flow_offsets[start:stop + 1] - flow_offsets[start])
+        results.append((flows if sparse_flows else dense_flows(*flows, len(E)), targets[start:stop]))
+        start = stop
+
+    datasets = []
+    for i, (prefixes, suffixes, last_nodes) in enumerate(splits):
+        if include_2hop:
+            (flows, targets), (flows_2hop, targets_2hop) = results[2 * i], results[2 * i + 1]
+            datasets.append((flows, targets, last_nodes, [s[0] for s in suffixes], flows_2hop, targets_2hop,
+                             [s[0] for s in suffixes], [s[1] for s in suffixes]))
+        else:
+            flows, targets = results[i]
+            datasets.append((flows, targets, last_nodes, [s[0] for s in suffixes], [], [], [], []))
+    return datasets
 
-    # B1, B2
-    B1, B2 = incidence_matrices(G, V, E, faces, edge_to_idx)
-    G_undir, paths = generate_random_walks(G, coords, valid_idxs, m=m)
-    rev_paths = [path[::-1] for path in paths]
+def path_dataset(G_undir, E, edge_to_idx, paths, max_degree, include_2hop=True, truncate_paths=True, sparse_flows=False):
+    """
+    Builds necessary matrices for 1-hop and 2-hop learning, from a list of paths (see path_datasets, which this calls for
+        one set of paths; edges + neighbors are looked up in E, G_undir + edge_to_idx are only kept for compatibility)
 
-    # Save image of graph to file
-    color_faces(G.to_undirected(), V, coords, faces, filename='synthetic_graph_faces_paths.pdf',
-                paths=[paths[11], paths[7][:-1], paths[18][:-1]])
+    :param sparse_flows: if True, returns the prefix flows in the ragged sparse format (see to_sparse_flows())
+    """
+    return path_datasets(E, [paths], max_degree, include_2hop=include_2hop, truncate_paths=truncate_paths,
+                         sparse_flows=sparse_flows)[0]
+
+def generate_dataset(n, m, folder, holes=True, sparse_flows=False, walks='networkx', n_anchors=None, n_jobs=1):
+    """
+    Generates m walks on a random graph of n nodes, and saves them as a dataset to trajectory_data_1hop_ + folder and
+        trajectory_data_2hop_ + folder (see the description above)
 
+    :param walks: 'networkx' to generate walks with generate_random_walks on the networkx graph of random_SC_graph (also
+        saves a pdf of the graph with a few walks), or 'bfs' to generate them with shortest_path_walks on the CSR graph of
+        random_SC_complex, for large graphs + millions of walks (best with sparse_flows)
+    :param n_anchors, n_jobs: see shortest_path_walks; 'bfs' only
+    """
+    import networkx as nx
+    if walks == 'networkx':
+        # generate graph
+        G, V, E, faces, edge_to_idx, coords, valid_idxs = random_SC_graph(n, holes=holes)
+        G_undir, paths = generate_random_walks(G, coords, valid_idxs, m=m)
+
+        # Save image of graph to file
+        color_faces(G.to_undirected(), V, coords, faces, filename='synthetic_graph_faces_paths.pdf',
+                    paths=[paths[11], paths[7][:-1], paths[18][:-1]])
+    elif walks == 'bfs':
+        coords, E, faces, _, A, valid_idxs = random_SC_complex(n, holes=holes)
+        nodes, offsets = shortest_path_walks(A, coords, valid_idxs, m=m, n_anchors=n_anchors, n_jobs=n_jobs)
+        nodes = nodes.tolist()
+        paths = [nodes[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+        # the dataset format keeps the graph as a networkx graph (see load_dataset)
+        G_undir = nx.Graph()
+        G_undir.add_nodes_from(range(n))
+        G_undir.add_edges_from(E.tolist())
+    else:
+        raise ValueError("walks must be 'networkx' or 'bfs'")
+
+    # B1, B2
+    B1, B2 = sparse_incidence_matrices(n, E, faces)
+    rev_paths = [path[::-1] for path in paths]
 
     # train / test masks
-    train_mask = np.asarray([1] * int(len(paths) * 0.8) + [0] * int(len(paths) * 0.2))
+    train_mask = np.asarray([1] * int(len(paths) * 0.8) + [0] * (len(paths) - int(len(paths) * 0.8)))
     np.random.shuffle(train_mask)
     test_mask = 1 - train_mask
 
@@ -397,13 +946,12 @@ def generate_dataset(n, m, folder, holes=True):
     max_degree = np.max([deg for n, deg in G_undir.degree()])
     print('max degree:',max_degree)
 
-    # forward
-    prefix_flows_1hop, targets_1hop, last_nodes_1hop, suffixes_1hop, \
-        prefix_flows_2hop, targets_2hop, last_nodes_2hop, suffixes_2hop = path_dataset(G_undir, E, edge_to_idx, paths, max_degree)
-
-    # reversed
-    rev_prefix_flows_1hop, rev_targets_1hop, rev_last_nodes_1hop, rev_suffixes_1hop, \
-        rev_prefix_flows_2hop, rev_targets_2hop, rev_last_nodes_2hop, rev_suffixes_2hop = path_dataset(G_undir, E, edge_to_idx, rev_paths, max_degree)
+    # forward + reversed
+    (prefix_flows_1hop, targets_1hop, last_nodes_1hop, suffixes_1hop,
+     prefix_flows_2hop, targets_2hop, last_nodes_2hop, suffixes_2hop), \
+        (rev_prefix_flows_1hop, rev_targets_1hop, rev_last_nodes_1hop, rev_suffixes_1hop,
+         rev_prefix_flows_2hop, rev_targets_2hop, rev_last_nodes_2hop, rev_suffixes_2hop) = path_datasets(E, [paths, rev_paths], max_degree,
+                                                                                                        sparse_flows=sparse_flows)
 
     dataset_1hop = [prefix_flows_1hop, B1, B2, targets_1hop, train_mask, test_mask, G_undir, coords, last_nodes_1hop,
                     suffixes_1hop, rev_prefix_flows_1hop, rev_targets_1hop, rev_last_nodes_1hop, rev_suffixes_1hop]
@@ -423,14 +971,22 @@ def generate_dataset(n, m, folder, holes=True):
         if filename == 'G_undir':
             nx.readwrite.gpickle.write_gpickle(G_undir, os.path.join(folder_1hop, filename + '.pkl'))
             nx.readwrite.gpickle.write_gpickle(G_undir, os.path.join(folder_2hop, filename + '.pkl'))
+        elif filename in ('B1', 'B2'):
+            save_incidence(os.path.join(folder_1hop, filename), arr_1hop)
+            save_incidence(os.path.join(folder_2hop, filename), arr_2hop)
+        elif filename in ('flows_in', 'rev_flows_in'):
+            save_flows(os.path.join(folder_1hop, filename), arr_1hop)
+            save_flows(os.path.join(folder_2hop, filename), arr_2hop)
         else:
             np.save(os.path.join(folder_1hop, filename + '.npy'), arr_1hop)
             np.save(os.path.join(folder_2hop, filename + '.npy'), arr_2hop)
 
 def load_dataset(folder):
     """
-    Loads training data from trajectory_data folder
+    Loads training data from trajectory_data folder; flows are returned in the format they were saved in (dense, or
+        ragged sparse if the folder has flows_in.npz), B1 + B2 as scipy CSC matrices (see load_incidence)
     """
+    import networkx as nx
     file_paths = [os.path.join(folder, ar + '.npy') for ar in ('flows_in', 'B1', 'B2', 'targets', 'train_mask', 'test_mask', 'G_undir', 'last_nodes', 'target_nodes')]
     G_undir = nx.readwrite.gpickle.read_gpickle(file_paths[6][:-4] + '.pkl')
     remap = {node: int(node) for node in G_undir.nodes}
@@ -442,20 +998,24 @@ def load_dataset(folder):
     except:
         prefixes = None
 
-    return np.load(file_paths[0]), [np.load(p) for p in file_paths[1:3]], np.load(file_paths[3]),  np.load(file_paths[4]), np.load(file_paths[5]), G_undir, np.load(file_paths[7]), np.load(file_paths[8])
+    return load_flows(file_paths[0][:-4]), [load_incidence(p[:-4]) for p in file_paths[1:3]], np.load(file_paths[3]),  np.load(file_paths[4]), np.load(file_paths[5]), G_undir, np.load(file_paths[7]), np.load(file_paths[8])
 
 def to_rnn_format(folder, prefixes_file=None):
     """
     Converts dataset to the format used by this repo https://github.com/wuhao5688/RNN-TrajModel
     """
+    import networkx as nx
     # load paths + graph
     G_undir = nx.readwrite.gpickle.read_gpickle(folder + '/G_undir.pkl')
     remap = {node: int(node) for node in G_undir.nodes}
     G_undir = nx.relabel_nodes(G_undir, remap)
     E = list(G_undir.edges)
 
-    flows, last_nodes, target_nodes, train_mask, test_mask = [np.load(folder + '/' + name + '.npy') for name in ('flows_in', 'last_nodes', 'target_nodes', 'train_mask',
+    last_nodes, target_nodes, train_mask, test_mask = [np.load(folder + '/' + name + '.npy') for name in ('last_nodes', 'target_nodes', 'train_mask',
                                                                'test_mask')]
+    flows = load_flows(folder + '/flows_in')
+    if isinstance(flows, tuple):
+        flows = dense_flows(*flows, len(E))
 
     if not prefixes_file:
         prefixes = [flow_to_path(flow, E, last_node) for flow, last_node in zip(flows, last_nodes)]
@@ -513,6 +1073,7 @@ def to_rnn_format(folder, prefixes_file=None):
     f.close()
 
 if __name__ == '__main__':
+    import pandas as pd
     folder_suffix = 'working' # make this whatever you want
     generate_dataset(400, 1000, folder_suffix)
     a = np.load('trajectory_data_1hop_working/target_nodes.npy')
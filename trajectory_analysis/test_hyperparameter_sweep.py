@@ -0,0 +1,28 @@
+"""
+Smoke tests of hyperparameter_sweep.py: one sweep with 2 worker processes on a small generated dataset.
+
+Run from this folder:
+    python3 -m pytest test_hyperparameter_sweep.py
+"""
+from hyperparameter_sweep import configure, prepare, run_sweep, sweep_configs, xla_flag_supported
+from synthetic_data_gen import generate_dataset
+
+
+def test_xla_flag_supported():
+    assert not xla_flag_supported('--xla_not_a_flag=false')
+    assert xla_flag_supported('')
+
+
+def test_run_sweep_two_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    generate_dataset(400, 60, 'smoke', sparse_flows=True, walks='bfs', n_anchors=4)
+    base_args = ['hyperparameter_sweep.py', '-data_folder_suffix', 'smoke', '-model', 'scone', '-epochs', '2',
+                 '-hidden_layers', '3_4_3_4', '-batch_size', '16', '-sparse_flows', '1', '-compile_cache', '']
+    configure(base_args)
+    filename = str(tmp_path / 'inputs.sweep')
+    prepare(filename, ['scone'])
+
+    configs = sweep_configs({'learning_rate': [0.001]})
+    results = run_sweep(configs, base_args, filename, workers=2)
+    assert len(results) == 1 and 'error' not in results[0], results
+    assert 0 <= results[0]['test_acc'] <= 1 and results[0]['learning_rate'] == 0.001
@@ -0,0 +1,114 @@
+"""
+Offline tests of the inference server's request path (Predictor) and request batching (Batcher), without a socket.
+
+Run from this folder:
+    python3 -m pytest test_inference_server.py
+"""
+import time
+import numpy as onp
+import pytest
+
+from inference_server import Batcher, Predictor
+
+# graph 0 - 1 - 2 - 0 (one triangle) + 2 - 3; edges (0, 1), (0, 2), (1, 2), (2, 3)
+NBRHOODS = onp.array([[1, 2, -1], [0, 2, -1], [0, 1, 3], [2, -1, -1]])
+NBR_EDGES = onp.array([[0, 1, 0], [0, 2, 0], [1, 2, 3], [3, 0, 0]])
+NBR_SIGNS = onp.array([[1, 1, 0], [-1, 1, 0], [-1, -1, 1], [-1, 0, 0]])
+N_EDGES = 4
+
+
+class Stub_Model():
+    """
+    Stands in for a trained Scone_GCN: the logit of neighbor slot j is (j + 1) * (flow . [1, 2, 3, 4]), so predictions
+        depend on each sample's own flow only. Records the # of samples of every forward pass
+    """
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict(self, shifts, inputs):
+        last_nodes, flows = inputs[-2:]
+        self.batch_sizes.append(len(last_nodes))
+        if isinstance(flows, tuple):
+            dense = onp.zeros((len(last_nodes), N_EDGES))
+            onp.add.at(dense, (onp.repeat(onp.arange(len(last_nodes)), flows[0].shape[1]), flows[0].ravel()), flows[1].ravel())
+        else:
+            dense = flows[..., 0]
+        logits = onp.arange(1, NBRHOODS.shape[1] + 1) * (dense @ onp.arange(1., N_EDGES + 1))[:, None]
+        return (logits - onp.log(onp.exp(logits).sum(axis=1, keepdims=True)))[..., None]
+
+
+def predictor(sparse_flows=False):
+    return Predictor(Stub_Model(), [], [], NBRHOODS, NBR_EDGES, NBR_SIGNS, N_EDGES, sparse_flows=sparse_flows)
+
+
+def test_parse_path_matches_flow():
+    last_node, edges, signs = predictor().parse({'path': [0, 1, 2]})
+    assert last_node == 2
+    assert edges.tolist() == [0, 2] and signs.tolist() == [1, 1]
+
+    last_node, edges, signs = predictor().parse({'edges': [0, 2], 'signs': [1, 1], 'last_node': 2})
+    assert last_node == 2
+    assert edges.tolist() == [0, 2] and signs.tolist() == [1, 1]
+
+
+@pytest.mark.parametrize('payload', [
+    {'path': []},
+    {'path': [0, 3]},  # not neighbors
+    {'path': [0, 9]},
+    {'edges': [0, 2], 'signs': [1], 'last_node': 2},
+    {'edges': [7], 'signs': [1], 'last_node': 1},
+    {'edges': [0], 'signs': [2], 'last_node': 1},
+    {'edges': [0], 'signs': [0.5], 'last_node': 1},
+    {'edges': [0], 'signs': [1], 'last_node': 4},
+])
+def test_parse_rejects_malformed_requests(payload):
+    with pytest.raises(ValueError):
+        predictor().parse(payload)
+
+
+@pytest.mark.parametrize('sparse_flows', [False, True])
+def test_predict_batch_mixed_sizes(sparse_flows):
+    server = predictor(sparse_flows)
+    payloads = [{'path': [3]}, {'path': [0, 1, 2]}, {'path': [1, 0, 2, 3]}]
+    requests = [server.parse(payload) for payload in payloads]
+
+    results = server.predict_batch(requests)
+    assert server.scone.batch_sizes == [4]  # 3 requests, padded to a bucket size
+
+    for request, result in zip(requests, results):
+        assert result['nbrs'] == NBRHOODS[request[0]][NBRHOODS[request[0]] >= 0].tolist()
+        assert onp.isclose(sum(result['probs']), 1)
+        # batched with other (longer + shorter) requests, each gets the result it gets on its own
+        assert onp.allclose(result['probs'], server.predict_batch([request])[0]['probs'])
+
+
+def test_batcher_flushes_at_deadline():
+    sizes = []
+    batcher = Batcher(lambda batch: sizes.append(len(batch)) or [2 * r for r in batch], max_batch=64, max_wait=0.2)
+    start = time.monotonic()
+    futures = [batcher.submit(r) for r in range(3)]
+    assert [f.result(timeout=5) for f in futures] == [0, 2, 4]
+    elapsed = time.monotonic() - start
+
+    # not full, so the requests waited for the deadline of the first, then ran as one batch
+    assert sizes == [3]
+    assert 0.15 <= elapsed < 2
+
+
+def test_batcher_splits_full_batches():
+    sizes = []
+    batcher = Batcher(lambda batch: sizes.append(len(batch)) or [2 * r for r in batch], max_batch=2, max_wait=0.2)
+    futures = [batcher.submit(r) for r in range(5)]
+    assert [f.result(timeout=5) for f in futures] == [0, 2, 4, 6, 8]
+    assert sizes == [2, 2, 1]
+
+
+def test_batcher_fails_whole_batch():
+    def fail(batch):
+        raise RuntimeError('forward pass failed')
+
+    batcher = Batcher(fail, max_batch=4, max_wait=0.05)
+    futures = [batcher.submit(r) for r in range(2)]
+    for f in futures:
+        with pytest.raises(RuntimeError):
+            f.result(timeout=5)
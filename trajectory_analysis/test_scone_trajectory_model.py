@@ -0,0 +1,40 @@
+"""
+Tests of Scone_GCN's chunked evaluation (map_chunks) on a small generated dataset.
+
+Run from this folder:
+    python3 -m pytest test_scone_trajectory_model.py
+"""
+import numpy as onp
+import pytest
+
+import scone_trajectory_model
+from synthetic_data_gen import generate_dataset
+from trajectory_experiments import configure, data_setup, build_model
+
+
+@pytest.mark.parametrize('args', [['-sparse_flows', '1'], ['-sparse_flows', '0'], ['-sparse_flows', '1', '-ensemble', '2', '-fused', '1']])
+def test_multi_hop_accuracy_binary_chunks(tmp_path, monkeypatch, args):
+    monkeypatch.chdir(tmp_path)
+    generate_dataset(400, 60, 'chunks', sparse_flows=args[1] == '1', walks='bfs', n_anchors=4)
+    configure(['trajectory_experiments.py', '-data_folder_suffix', 'chunks', '-model', 'scnn3', '-hidden_layers', '3_8_3_8',
+               '-sparse', '1', '-compile_cache', ''] + args)
+    inputs_all, y_all, train_mask, test_mask, shifts, _, _, nbrhoods, n_nbrs, _, _, tables = data_setup(hops=(1, 2), folder_suffix='chunks')
+    (inputs_1hop, _), (y_1hop, y_2hop) = inputs_all, y_all
+    onp.random.seed(0)
+    scone = build_model(shifts, inputs_1hop, y_1hop, train_mask)
+    mask = onp.ones(len(y_1hop))
+
+    def accs():
+        return [scone.multi_hop_accuracy_binary(shifts, inputs_1hop, y, mask, nbrhoods, tables['nbr_edges'], tables['nbr_signs'], hops)
+                for hops, y in ((1, y_1hop), (2, y_2hop))]
+
+    whole = accs()
+    # a few samples per chunk; the 2-hop rollout compiled last is reused, once per chunk
+    monkeypatch.setattr(scone_trajectory_model, 'SPARSE_CHUNK_ENTRIES', 1 << 18)
+    hops, shared, greedy = scone.greedy
+    calls = []
+    scone.greedy = (hops, shared, lambda *args: calls.append(len(args[-2])) or greedy(*args))
+    assert scone.multi_hop_accuracy_binary(shifts, inputs_1hop, y_2hop, mask, nbrhoods, tables['nbr_edges'], tables['nbr_signs'], 2) == whole[1]
+    assert len(calls) > 1 and len(set(calls)) == 1
+    assert accs() == whole
+    assert onp.isclose(whole[0], scone.evaluate(shifts, inputs_1hop, y_1hop, {'all': mask}, n_nbrs, metrics=('acc',))['all']['acc'])
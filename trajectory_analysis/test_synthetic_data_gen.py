@@ -0,0 +1,61 @@
+"""
+Tests of the sparse dataset construction in synthetic_data_gen.py against the dense reference construction.
+
+Run from this folder:
+    python3 -m pytest test_synthetic_data_gen.py
+"""
+import networkx as nx
+import numpy as onp
+import pytest
+
+from synthetic_data_gen import generate_dataset, incidence_matrices, load_dataset, load_flows, sparse_incidence_matrices
+
+# two triangles 0 - 1 - 2 and 1 - 2 - 3, + the edge 3 - 4
+EDGES = [(0, 1), (0, 2), (1, 2), (1, 3), (2, 3), (3, 4)]
+FACES = onp.array([[0, 1, 2], [1, 2, 3]])
+
+
+@pytest.mark.parametrize('order', [onp.arange(len(EDGES)), onp.array([5, 2, 0, 4, 1, 3])])
+def test_sparse_incidence_matrices_match_dense(order):
+    E = onp.array(EDGES)[order]
+    G = nx.Graph()
+    G.add_edges_from(EDGES)
+    B1, B2 = incidence_matrices(G, sorted(G.nodes), [tuple(e) for e in E], FACES, {tuple(e): i for i, e in enumerate(E)})
+
+    sparse_B1, sparse_B2 = sparse_incidence_matrices(G.number_of_nodes(), E, FACES)
+    assert onp.array_equal(sparse_B1.toarray(), B1)
+    assert onp.array_equal(sparse_B2.toarray(), B2)
+    assert not onp.any((sparse_B1 @ sparse_B2).toarray())
+
+
+def test_sparse_incidence_matrices_rejects_unknown_faces():
+    with pytest.raises(ValueError):
+        sparse_incidence_matrices(5, onp.array(EDGES), onp.array([[0, 1, 3]]))
+
+
+@pytest.mark.parametrize('sparse_flows', [False, True])
+def test_generate_dataset_bfs_walks(tmp_path, monkeypatch, sparse_flows):
+    monkeypatch.chdir(tmp_path)
+    n, m = 400, 60
+    generate_dataset(n, m, 'bfs', sparse_flows=sparse_flows, walks='bfs', n_anchors=4)
+
+    for hop in (1, 2):
+        folder = 'trajectory_data_{}hop_bfs'.format(hop)
+        flows, (B1, B2), targets, train_mask, test_mask, G_undir, last_nodes, target_nodes = load_dataset(folder)
+        assert B1.shape == (n, G_undir.number_of_edges()) and B2.shape[0] == B1.shape[1]
+        assert not onp.any((B1 @ B2).toarray())
+        assert isinstance(flows, tuple) == sparse_flows
+        assert len(flows[2]) - 1 == m if sparse_flows else flows.shape == (m, B1.shape[1], 1)
+        assert onp.array_equal(train_mask + test_mask, onp.ones(m))
+        assert targets.shape == (m, max(d for _, d in G_undir.degree()), 1)
+
+        # each target is the slot of the target node among the last node's sorted neighbors
+        for last_node, target_node, target in zip(last_nodes, target_nodes, targets[..., 0]):
+            assert onp.array_equal(target[:G_undir.degree(last_node)], onp.array(sorted(G_undir[last_node])) == target_node)
+
+        # each flow ends at its last node
+        if sparse_flows:
+            edges, signs = flows[0][flows[2][1:] - 1], flows[1][flows[2][1:] - 1]
+            E = onp.array(sorted(tuple(sorted(e)) for e in G_undir.edges))
+            assert onp.array_equal(onp.where(signs > 0, E[edges, 1], E[edges, 0]), last_nodes)
+    assert load_flows('trajectory_data_1hop_bfs/rev_flows_in') is not None
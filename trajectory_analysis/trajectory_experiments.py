@@ -16,12 +16,17 @@ Train a SCoNe model on a dataset:
     -The default hyperparameters should work pretty well on the default graph size. You'll probably have to play with
         them for other graphs, though.
 
+    -Importing this file has no side effects; from other code, call configure(args) to parse arguments (e.g.
+        configure(['-model', 'scone', '-data_folder_suffix', 'suffix_here'])) before using it. Import time is tracked
+        by import_benchmark.py
+
 
 
 
 Arguments + default values for trajectory_experiments.py:
-   'model': 'scone'; which model to use, of ('scone', 'ebli', or 'bunch')
+   'model': 'scone'; which model to use, of ('scone', 'scnn', 'ebli', or 'bunch')
         -'scone': ours
+        -'scnn': SCNN with filters of order k1_scnn (lower) and k2_scnn (upper); 'scnn2', 'scnn3', 'scnn4' set both orders
         -'ebli':  https://arxiv.org/pdf/2010.03633.pdf
         -'bunch': https://arxiv.org/pdf/2012.06010.pdf
    'epochs': 1000; # of training epochs
@@ -33,14 +38,48 @@ Arguments + default values for trajectory_experiments.py:
    'regional': 0; if 1, trains a model over upper graph region and tests over lower region (Transfer experiment)
 
    'hidden_layers': 3_16_3_16_3_16 (corresponds to [(3, 16), (3, 16), (3, 16)]; each tuple is a layer (# of shift matrices, # of units in layer) )
-        -'scone' and 'ebli' require 3_#_3_#_ ...; 'bunch' requires 7_#_7_#_ ...
+        -'scone' requires 3_#_3_#_ ...; 'ebli' requires 4_#_4_#_ ...; 'bunch' requires 7_#_7_#_ ...; for 'scnn' the # of shifts is ignored
+   'k1_scnn', 'k2_scnn': 3; orders of the SCNN filters over the lower / upper Laplacian
    'describe': 1; describes the dataset being used
    'load_data': 1; if 0, generate new data; if 1, load data from folder set in data_folder_suffix
+   'n_nodes', 'n_walks': 400, 1000; size of the graph + # of walks of generated data (load_data 0)
+   'walks': 'networkx'; how generated data's walks are found (see generate_dataset): 'networkx', or 'bfs' for large graphs
+        + millions of walks (best with sparse_flows 1, which also saves the flows in the sparse format)
+   'n_anchors': 0; with walks 'bfs', the # of anchors per region + chunk of walks (see shortest_path_walks); 0 uses every
+        region node
    'load_model': 0; if 0, train a new model, if 1, load model from file model_name.npy. Must set hidden_layers regardless of choice
+        -trained models are saved to models/model_name_model_epochs.npy (weights only) and to a .scone model artifact
+            next to it (weights, hyperparameters, shift operators + neighbor tables; see save_model), which load_model()
+            and inference_server.py load without the dataset
    'markov': 0; include tests using a 2nd-order Markov model
    'model_name': 'model'; name of model to use when load_model = 1
 
    'flip_edges': 0; if 1, flips orientation of a random subset of edges. with tanh activation, should perform equally
+   'sparse': 0; if 1, shift operators are stored + applied as sparse matrices (memory / compute scale with nnz instead of |E|^2)
+   'batched': 0; if 1, runs each batch of flows as the columns of one signal matrix instead of vmapping over flows
+   'fused': 0; if 1, stores each layer's weights as one stacked matrix, applied to the concatenated shifted signals
+        (not supported for 'bunch'). Models saved without it are converted on load
+   'scan_epochs': 0; if 1, runs each training epoch (device-side shuffle + all batch steps) as one compiled lax.scan
+   'sparse_flows': 0; if 1, flows are fed to the model as (edge indices, +-1 signs) of the edges on each path instead of
+        dense |E|-vectors, so the first layer's shifts are sums of a few shift matrix columns. Datasets saved in either
+        format (flows_in.npy or flows_in.npz, see synthetic_data_gen.py) are converted as needed
+   'streaming': 0; if 1, also replays each test trajectory hop by hop through a Streaming_Predictor (incremental
+        first layer; see streaming_predictor.py) and reports its per-hop latency. Not supported for 'bunch'
+   'multi_hop': 0; if 1, also reports 2-hop forecasts: the accuracy of greedy rollouts, the probability of reaching the 2-hop target (every path expanded)
+        and the accuracy of the most likely 2-hop path, found by beam search (see Scone_GCN.rollout)
+   'beam_width': 0; if > 0, # of paths kept per trajectory after each hop of the 2-hop beam search; 0 keeps every path
+   'devices': 1; if > 1, splits each training batch across this many XLA devices (CPU cores are exposed as host devices);
+        batch_size must be divisible by it
+   'ensemble': 0; if > 0, trains this many models (independent initial weights) in lockstep, as one ensemble: the
+        members are folded into the channels of one model (block-diagonal weights, see conv), so each shift runs once
+        per batch for all of them, and one loss + gradient covers every member. The ensemble predicts the members'
+        averaged probabilities; each member's test accuracy is also reported. Not supported with 'streaming' or for
+        'bunch'. This is not a speedup on CPU: the shifts' cost grows with the # of channels, so K members cost about
+        as much as one model with K times the channels. Measured for K = 4 (3 layers of 16 channels, batch of 100), a
+        train step takes 0.89x (dense shifts), 0.97x ('sparse'), 1.09x (dense, 'batched' + 'fused') and 1.41x
+        ('sparse', 'batched' + 'fused') as long as 4 single-model steps
+   'compile_cache': 'jax_cache'; directory of the persistent compilation cache, so repeated runs of the same model skip
+        compiling it (see enable_compile_cache); '' disables it
 
    'multi_graph': '': if not '', also tests on paths over the graph with the folder suffix set here
    'holes': 1; if generation new data, sets whether the graph should have holes
@@ -56,34 +95,47 @@ More examples:
     python3 trajectory_experiments.py load_data 0 -holes 0 -data_folder_suffix no_holes -model_name tanh_no_holes -multi_graph holes
         -create a dataset using folder suffix no_holes, train a model over it using default settings, and test it over the graph with data folder suffix holes
 """
-import os, sys
+import os, sys, time
+from functools import partial
 import numpy as onp
 from numpy import linalg as la
+import jax
 import jax.numpy as np
+from jax import vmap
 from jax.scipy.special import logsumexp
+from scipy import sparse
 
 
 
 
 try:
     from trajectory_analysis.bunch_model_matrices import compute_shift_matrices
-    from trajectory_analysis.synthetic_data_gen import load_dataset, generate_dataset, neighborhood, conditional_incidence_matrix, flow_to_path
-    from trajectory_analysis.scone_trajectory_model import Scone_GCN
+    from trajectory_analysis.synthetic_data_gen import load_dataset, generate_dataset, neighborhood, conditional_incidence_matrix, flow_to_path, incident_edge_tables, neighbor_edge_tables, \
+        load_flows, to_sparse_flows, pad_sparse_flows, dense_flows
+    from trajectory_analysis.scone_trajectory_model import Scone_GCN, fuse_weights
     from trajectory_analysis.markov_model import Markov_Model
+    from trajectory_analysis.sparse_shifts import SparseShift, hodge_laplacians
+    from trajectory_analysis.streaming_predictor import Streaming_Predictor
+    from trajectory_analysis.model_artifact import save_artifact, load_artifact
 except Exception:
     from bunch_model_matrices import compute_shift_matrices
-    from synthetic_data_gen import load_dataset, generate_dataset, neighborhood, conditional_incidence_matrix, flow_to_path
-    from scone_trajectory_model import Scone_GCN
+    from synthetic_data_gen import load_dataset, generate_dataset, neighborhood, conditional_incidence_matrix, flow_to_path, incident_edge_tables, neighbor_edge_tables, \
+        load_flows, to_sparse_flows, pad_sparse_flows, dense_flows
+    from scone_trajectory_model import Scone_GCN, fuse_weights
     from markov_model import Markov_Model
+    from sparse_shifts import SparseShift, hodge_laplacians
+    from streaming_predictor import Streaming_Predictor
+    from model_artifact import save_artifact, load_artifact
 
 
-def hyperparams():
+def hyperparams(args=None):
     """
-    Parse hyperparameters from command line
+    Parse hyperparameters from command line (sys.argv by default); returns the defaults below, updated with the parsed
+        arguments
 
     For hidden_layers, input [(3, 8), (3, 8)] as 3_8_3_8
     """
-    args = sys.argv
+    args = sys.argv if args is None else args
     hyperparams = {'model': 'scnn3',
                    'epochs': 2,
                    'learning_rate': 0.001,
@@ -95,24 +147,39 @@ def hyperparams():
                    'describe': 1,
                    'reverse': 1,
                    'load_data': 1,
+                   'n_nodes': 400,
+                   'n_walks': 1000,
+                   'walks': 'networkx',
+                   'n_anchors': 0,
                    'load_model': 0,
                    'markov': 0,
                    'model_name': 'model',
                    'regional': 0,
                    'flip_edges': 0,
+                   'sparse': 0,
+                   'batched': 0,
+                   'fused': 0,
+                   'scan_epochs': 0,
+                   'sparse_flows': 0,
+                   'streaming': 0,
+                   'multi_hop': 0,
+                   'beam_width': 0,
+                   'devices': 1,
+                   'ensemble': 0,
+                   'compile_cache': 'jax_cache',
                    'data_folder_suffix': 'working',
                    'multi_graph': '',
                    'holes': 1}
 
     for i in range(len(args) - 1):
-        if args[i][0] == '-':
+        if args[i].startswith('-'):
             if args[i][1:] == 'hidden_layers':
                 nums = list(map(int, args[i + 1].split("_")))
 
                 hyperparams['hidden_layers'] = []
                 for j in range(0, len(nums), 2):
                     hyperparams['hidden_layers'] += [(nums[j], nums[j + 1])]
-            elif args[i][1:] in ['model_name', 'data_folder_suffix', 'multi_graph', 'model']:
+            elif args[i][1:] in ['model_name', 'data_folder_suffix', 'multi_graph', 'model', 'host', 'socket', 'compile_cache', 'walks']:
                 hyperparams[args[i][1:]] = str(args[i+1])
             elif args[i][1:] in ['k1_scnn','k2_scnn']:
                 hyperparams[args[i][1:]] = int(args[i+1])
@@ -120,9 +187,46 @@ def hyperparams():
                 hyperparams[args[i][1:]] = float(args[i+1])
 
 
-    return hyperparams
+    return model_params(hyperparams)
+
+def model_params(params):
+    """
+    Sets the SCNN filter orders fixed by legacy model names ('scnn2', 'scnn3', 'scnn4') in params (in place); returns params
+    """
+    if params['model'] in ['scnn2', 'scnn3', 'scnn4']:
+        params['k1_scnn'] = params['k2_scnn'] = int(params['model'][-1])
+    return params
+
+# defaults until configure() parses the command line, so that importing this module has no side effects
+HYPERPARAMS = hyperparams([])
+
+def configure(args=None):
+    """
+    Sets HYPERPARAMS (in place) from the command line args (sys.argv by default), then applies the process-wide settings
+        that depend on them: XLA devices, the persistent compilation cache and the numpy seed of weight initialization +
+        batch shuffling. Scripts call this once, before running anything with jax
+    """
+    HYPERPARAMS.update(hyperparams(args))
 
-HYPERPARAMS = hyperparams()
+    if HYPERPARAMS['devices'] > 1 and 'xla_force_host_platform_device_count' not in os.environ.get('XLA_FLAGS', ''):
+        # expose CPU cores as separate XLA devices; must be set before jax initializes its backend
+        os.environ['XLA_FLAGS'] = os.environ.get('XLA_FLAGS', '') + ' --xla_force_host_platform_device_count={}'.format(int(HYPERPARAMS['devices']))
+    enable_compile_cache()
+    onp.random.seed(1030)
+
+def enable_compile_cache(cache_dir=None):
+    """
+    Turns on JAX's persistent compilation cache in cache_dir (HYPERPARAMS['compile_cache'] by default; '' disables it).
+        Compiled functions are stored on disk, keyed by a hash of the lowered computation (model type, layer spec + the
+        shapes and dtypes of the weights, operators and inputs) and of the jax version / backend, so a later run with the
+        same model + dataset loads them instead of recompiling. Must be called before the first compilation
+    """
+    cache_dir = HYPERPARAMS['compile_cache'] if cache_dir is None else cache_dir
+    if not cache_dir:
+        return
+    jax.config.update('jax_compilation_cache_dir', os.path.abspath(cache_dir))
+    # cache every compiled function: most of them compile quickly on their own, but there are dozens per run
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
 
 ### Model definition ###
 
@@ -139,136 +243,144 @@ def tanh(x):
 def leaky_relu(x):
     return np.where(x >= 0, x, 0.01 * x)
 
-# SCoNe function
-def scone_func(weights, S_lower, S_upper, Bcond_func, last_node, flow):
+# Layer helpers; signals are either (# edges, channels) for one flow, or (# edges, batch, channels) for a batch of flows
+#   stacked as columns (see Scone_GCN.setup(batched=True)). Model inputs may also be sparse flows: a tuple of (L,) edge
+#   indices + (L,) signs for one flow, or (batch, L) of each for a batch (see flow_inputs)
+def shift(S, x):
     """
-    Forward pass of the SCoNe model with variable number of layers
+    Applies shift matrix S to signal x; a batched signal is flattened to (# edges, batch * channels) so that the shift is
+        a single matrix-matrix product. For a sparse flow, S @ x is the signed sum of the columns of S on its edges
     """
-    n_layers = (len(weights) - 1) / 3
-    print('#weights:',len(weights),'#layers:',n_layers)
-    assert n_layers % 1 == 0, 'wrong number of weights'
-    cur_out = flow
-    print(S_lower.size)
-    for i in range(int(n_layers)):
-        cur_out = cur_out @ weights[i * 3] \
-                  + S_lower @ cur_out @ weights[i*3 + 1] \
-                  + S_upper @ cur_out @ weights[i*3 + 2]
-
-        cur_out = tanh(cur_out)
-
-    logits = Bcond_func(last_node) @ cur_out @ weights[-1]
-    #print(logits)
-    return logits - logsumexp(logits) # log of the softmax function 
-
-# SCNN with order K
-# def scnn_func(weights, *shifts, Bcond_func, last_node, flow, k1=HYPERPARAMS['k1_scnn'], k2=HYPERPARAMS['k2_scnn']):
-#     """
-#     Forward pass of the SCoNe model with variable number of layers
-#     """
-#     n_layers = (len(weights) - 1) / (1+k1+k2)
-#     print('#weights:',len(weights),'#layers:',n_layers)
-#     assert n_layers % 1 == 0, 'wrong number of weights'
-#     cur_out = flow
-#     for i in range(int(n_layers)):
-#         cur_out = cur_out @ weights[i*(1+k1+k2)] 
-#         cur_out.sum(shifts[k] @ cur_out @ weights[i*(1+k1+k2) + k] for k in len(shifts)) 
-
-#         cur_out = tanh(cur_out)
-
-#     logits = Bcond_func(last_node) @ cur_out @ weights[-1]
-#     return logits - logsumexp(logits)
-
-def scnn_func_2(weights, S_lower, S2_lower, S_upper, S2_upper, Bcond_func, last_node, flow, k1=HYPERPARAMS['k1_scnn'], k2=HYPERPARAMS['k2_scnn']):
+    if isinstance(x, tuple):
+        idxs, signs = x
+        if idxs.ndim == 2:
+            return np.moveaxis(vmap(shift, in_axes=(None, 0))(S, x), 0, 1)
+        if isinstance(S, SparseShift):
+            return S.column_sum(idxs, signs)[:, None]
+        return (S[:, idxs] @ signs)[:, None]
+    if x.ndim == 2 or isinstance(S, SparseShift):
+        return S @ x
+    return (S @ x.reshape((x.shape[0], -1))).reshape((S.shape[0],) + x.shape[1:])
+
+def dense_flow(x, n_edges):
     """
-    Forward pass of the SCoNe model with variable number of layers
+    Returns signal x as a dense (# edges, 1) (or (# edges, batch, 1)) array; only sparse flows are converted
     """
-    n_layers = (len(weights) - 1) / (1+k1+k2) # k1=k2=2
-    n_k = 1+k1+k2
-    print('#weights:',len(weights),'#layers:',n_layers)
+    if not isinstance(x, tuple):
+        return x
+    idxs, signs = x
+    if idxs.ndim == 2:
+        return np.moveaxis(vmap(dense_flow, in_axes=(0, None))(x, n_edges), 0, 1)
+    return np.zeros((n_edges, 1), signs.dtype).at[idxs, 0].add(signs)
+
+def readout(Bcond_func, last_node, x, W):
+    """
+    Log-softmax over the neighbors of last_node, computed from the last layer's edge signal x;
+        Bcond_func(last_node, x) returns the conditional incidence matrix of last_node times x (see data_setup).
+        Grouped readout weights (K, C, C_out) of an ensemble (see conv) give each member's log-softmax, stacked along a
+        new leading axis
+    """
+    if x.ndim == 3:
+        return vmap(readout, in_axes=(None, 0, 1, None))(Bcond_func, last_node, x, W)
+    if W.ndim == 3:
+        logits = Bcond_func(last_node, x) @ block_diagonal(W)
+        logits = np.moveaxis(logits.reshape(logits.shape[:-1] + (W.shape[0], -1)), -2, 0)
+        return logits - logsumexp(logits, axis=(1, 2), keepdims=True)
+    logits = Bcond_func(last_node, x) @ W
+    return logits - logsumexp(logits) # log of the softmax function
+
+def layer_weights(weights, n_k):
+    """
+    Splits weights into a list of per-layer weights + the readout weights. Each layer's weights are either n_k separate
+        (C_in, C_out) matrices, or one stacked (n_k, C_in, C_out) array (fused layout, see Scone_GCN.generate_weights);
+        an ensemble's grouped weights (see conv) have an extra member axis before C_in
+    """
+    if weights[0].ndim == weights[-1].ndim + 1:
+        return list(weights[:-1]), weights[-1]
+    n_layers = (len(weights) - 1) / n_k
     assert n_layers % 1 == 0, 'wrong number of weights'
-    cur_out = flow
-    for i in range(int(n_layers)):
-        cur_out = cur_out @ weights[i*n_k] \
-                  + S_lower @ cur_out @ weights[i*n_k + 1] \
-                  + S2_lower @ cur_out @ weights[i*n_k + 2] \
-                  + S_upper @ cur_out @ weights[i*n_k + 3] \
-                  + S2_upper @ cur_out @ weights[i*n_k +4]    
+    return [weights[i * n_k:(i + 1) * n_k] for i in range(int(n_layers))], weights[-1]
 
-        cur_out = tanh(cur_out)
+def block_diagonal(W):
+    """
+    Returns the (K * C_in, K * C_out) block-diagonal matrix of the K (C_in, C_out) matrices W
+    """
+    K, C_in, C_out = W.shape
+    return np.einsum('kcd,kl->kcld', W, np.eye(K, dtype=W.dtype)).reshape((K * C_in, K * C_out))
 
-    logits = Bcond_func(last_node) @ cur_out @ weights[-1]
-    return logits - logsumexp(logits)
+def conv(shifted, W):
+    """
+    Combines the shifted signals [x, S_1 x, S_2 x, ...] of one layer with that layer's weights. Fused weights are applied
+        as a single product of the channel-concatenated shifted signals with the stacked weight matrix.
+    Grouped weights ((K, C_in, C_out) per shift; see group_members) apply K ensemble members at once: their signals are
+        concatenated along the channel axis, so each shift runs once for all members. A signal shared by every member
+        (C_in channels, e.g. the flows) meets the members' weights side by side, a signal of K * C_in channels meets
+        them as a block-diagonal matrix, so member k's channels only meet member k's weights
+    """
+    if W[0].ndim == 3:
+        K, C_in, C_out = W[0].shape
+        if shifted[0].shape[-1] == C_in:
+            W = [np.moveaxis(w, 0, 1).reshape((C_in, K * C_out)) for w in W]
+        else:
+            W = [block_diagonal(w) for w in W]
+        return np.concatenate(shifted, axis=-1) @ np.concatenate(W)
+    if getattr(W, 'ndim', None) == 3:
+        return np.concatenate(shifted, axis=-1) @ W.reshape((-1, W.shape[-1]))
+    out = shifted[0] @ W[0]
+    for x, w in zip(shifted[1:], W[1:]):
+        out += x @ w
+    return out
 
-def scnn_func_3(weights, S_lower, S2_lower, S3_lower, S_upper, S2_upper, S3_upper, Bcond_func, last_node, flow, k1=HYPERPARAMS['k1_scnn'], k2=HYPERPARAMS['k2_scnn']):
+# SCoNe function
+def scone_func(weights, S_lower, S_upper, Bcond_func, last_node, flow):
     """
     Forward pass of the SCoNe model with variable number of layers
     """
-    n_layers = (len(weights) - 1) / (1+k1+k2) # k1=k2=3
-    n_k = 1+k1+k2
-    print('#weights:',len(weights),'#layers:',n_layers)
-    assert n_layers % 1 == 0, 'wrong number of weights'
+    layers, W_out = layer_weights(weights, 3)
     cur_out = flow
-    for i in range(int(n_layers)):
-        cur_out = cur_out @ weights[i*n_k] \
-                  + S_lower @ cur_out @ weights[i*n_k + 1] \
-                  + S2_lower @ cur_out @ weights[i*n_k + 2] \
-                  + S3_lower @ cur_out @ weights[i*n_k + 3] \
-                  + S_upper @ cur_out @ weights[i*n_k + 4] \
-                  + S2_upper @ cur_out @ weights[i*n_k +5] \
-                  + S3_upper @ cur_out @ weights[i*n_k + 6]       
-
-        cur_out = tanh(cur_out)
+    for W in layers:
+        cur_out = tanh(conv([dense_flow(cur_out, S_lower.shape[1]), shift(S_lower, cur_out), shift(S_upper, cur_out)], W))
 
-    logits = Bcond_func(last_node) @ cur_out @ weights[-1]
-    return logits - logsumexp(logits)
+    return readout(Bcond_func, last_node, cur_out, W_out)
 
-def scnn_func_4(weights, S_lower, S2_lower, S3_lower, S4_lower, S_upper, S2_upper, S3_upper, S4_upper, Bcond_func, last_node, flow, k1=HYPERPARAMS['k1_scnn'], k2=HYPERPARAMS['k2_scnn']):
+# SCNN with order K
+def scnn_func(weights, S_lower, S_upper, Bcond_func, last_node, flow, k1=1, k2=1):
     """
-    Forward pass of the SCoNe model with variable number of layers
+    Forward pass of the SCNN model (filters of order k1 over S_lower, k2 over S_upper) with variable number of layers.
+    Powers of the shifts are applied recursively to the signal, S @ (S @ x), so S^k is never formed
     """
-    n_layers = (len(weights) - 1) / (1+k1+k2) # k1=k2=4
-    n_k = 1+k1+k2
-    print('#weights:',len(weights),'#layers:',n_layers)
-    assert n_layers % 1 == 0, 'wrong number of weights'
+    layers, W_out = layer_weights(weights, 1 + k1 + k2)
     cur_out = flow
-    for i in range(int(n_layers)):
-        cur_out = cur_out @ weights[i*n_k] \
-                  + S_lower @ cur_out @ weights[i*n_k + 1] \
-                  + S2_lower @ cur_out @ weights[i*n_k + 2] \
-                  + S3_lower @ cur_out @ weights[i*n_k + 3] \
-                  + S4_upper @ cur_out @ weights[i*n_k + 4] \
-                  + S_upper @ cur_out @ weights[i*n_k + 5] \
-                  + S2_upper @ cur_out @ weights[i*n_k + 6] \
-                  + S3_upper @ cur_out @ weights[i*n_k + 7] \
-                  + S4_upper @ cur_out @ weights[i*n_k + 8]         
-
-        cur_out = tanh(cur_out)
-
-    logits = Bcond_func(last_node) @ cur_out @ weights[-1]
-    return logits - logsumexp(logits)
+    for W in layers:
+        shifted = [dense_flow(cur_out, S_lower.shape[1])]
+        for S, k in ((S_lower, k1), (S_upper, k2)):
+            x = cur_out
+            for _ in range(k):
+                x = shift(S, x)
+                shifted.append(x)
+
+        cur_out = tanh(conv(shifted, W))
+
+    return readout(Bcond_func, last_node, cur_out, W_out)
 
 # Ebli function
-def ebli_func(weights, S, S2, S3, Bcond_func, last_node, flow):
+def ebli_func(weights, S, Bcond_func, last_node, flow):
     """
-    Forward pass of the Ebli model with variable number of layers
-    note that here 
-    S_lower = L1
-    S_upper = L1^2
+    Forward pass of the Ebli model (filters of order 3 over S = L1) with variable number of layers.
+    As in scnn_func, the powers L1^2, L1^3 are applied recursively to the signal, so they are never formed
     """
-    n_layers = (len(weights) - 1) / 4
-    print('#weights:',len(weights),'#layers:',n_layers)
-    assert n_layers % 1 == 0, 'wrong number of weights'
+    layers, W_out = layer_weights(weights, 4)
     cur_out = flow
-    for i in range(int(n_layers)):
-        cur_out = cur_out @ weights[i * 4] \
-                  + S @ cur_out @ weights[i*4 + 1] \
-                  + S2 @ cur_out @ weights[i*4 + 2] \
-                  + S3 @ cur_out @ weights[i*4 + 3]
+    for W in layers:
+        shifted = [dense_flow(cur_out, S.shape[1])]
+        x = cur_out
+        for _ in range(3):
+            x = shift(S, x)
+            shifted.append(x)
 
-        cur_out = tanh(cur_out)
+        cur_out = tanh(conv(shifted, W))
 
-    logits = Bcond_func(last_node) @ cur_out @ weights[-1]
-    return logits - logsumexp(logits)
+    return readout(Bcond_func, last_node, cur_out, W_out)
 
 # Bunch function
 def bunch_func(weights, S_00, S_10, S_01, S_11, S_21, S_12, S_22, nbrhoods, last_node, flow):
@@ -276,31 +388,114 @@ def bunch_func(weights, S_00, S_10, S_01, S_11, S_21, S_12, S_22, nbrhoods, last
     Forward pass of the Bunch model with variable number of layers
     """
     n_layers = (len(weights)) / 7
-    print('#weights:',len(weights),'#layers:',n_layers)
     assert n_layers % 1 == 0, 'wrong number of weights'
-    cur_out = [np.zeros((S_00.shape[1], 1)), flow, np.zeros((S_22.shape[1], 1))]
+    batch_shape = flow[0].shape[:-1] + (1,) if isinstance(flow, tuple) else flow.shape[1:]
+    cur_out = [np.zeros((S_00.shape[1],) + batch_shape), flow, np.zeros((S_22.shape[1],) + batch_shape)]
 
     for i in range(int(n_layers)):
         next_out = [None, None, None]
         # node level
-        next_out[0] = S_00 @ cur_out[0] @ weights[i * 7] \
-                   + S_10 @ cur_out[1] @ weights[i * 7 + 1]
+        next_out[0] = shift(S_00, cur_out[0]) @ weights[i * 7] \
+                   + shift(S_10, cur_out[1]) @ weights[i * 7 + 1]
 
-        next_out[1] = S_01 @ cur_out[0] @ weights[i * 7 + 2] \
-                   + S_11 @ cur_out[1] @ weights[i * 7 + 3] \
-                   + S_21 @ cur_out[2] @ weights[i * 7 + 4]
+        next_out[1] = shift(S_01, cur_out[0]) @ weights[i * 7 + 2] \
+                   + shift(S_11, cur_out[1]) @ weights[i * 7 + 3] \
+                   + shift(S_21, cur_out[2]) @ weights[i * 7 + 4]
 
-        next_out[2] = S_12 @ cur_out[1] @ weights[i * 7 + 5] \
-                   + S_22 @ cur_out[2] @ weights[i * 7 + 6]
+        next_out[2] = shift(S_12, cur_out[1]) @ weights[i * 7 + 5] \
+                   + shift(S_22, cur_out[2]) @ weights[i * 7 + 6]
 
         cur_out = [relu(c) for c in next_out]
 
     nodes_out = cur_out[0] # use the last layer output on the node level as the final output 
     # values at nbrs of last node
+    if nodes_out.ndim == 3:
+        logits = vmap(lambda n, out: out[nbrhoods[n]], in_axes=(0, 1))(last_node, nodes_out)
+        return logits - logsumexp(logits, axis=(1, 2), keepdims=True)
     logits = nodes_out[nbrhoods[last_node]]
     return logits - logsumexp(logits)
 
 
+def streaming_operators(shifts):
+    """
+    Returns the shift matrices of the current model as scipy sparse matrices, and the highest power of each that a layer
+        applies (see Streaming_Predictor); powers are applied recursively by the predictor, never formed
+    """
+    if HYPERPARAMS['model'] == 'bunch':
+        raise ValueError('streaming prediction is not supported for bunch')
+    shifts = [S.to_scipy() if isinstance(S, SparseShift) else sparse.csr_matrix(S) for S in shifts]
+    if HYPERPARAMS['model'].startswith('scnn'):
+        return shifts, (HYPERPARAMS['k1_scnn'], HYPERPARAMS['k2_scnn'])
+    elif HYPERPARAMS['model'] == 'ebli':
+        return shifts, (3,)
+    return shifts, (1,) * len(shifts)
+
+def flow_inputs(X, n_edges):
+    """
+    Returns flows X, as loaded by load_dataset (dense, or ragged sparse), in the format fed to the models: padded
+        ((# flows, max path length) edge indices, (# flows, max path length) signs) if HYPERPARAMS['sparse_flows'],
+        else dense (# flows, # edges, 1)
+    """
+    if HYPERPARAMS['sparse_flows']:
+        if not isinstance(X, tuple):
+            X = to_sparse_flows(X)
+        return pad_sparse_flows(*X)
+    if isinstance(X, tuple):
+        return dense_flows(*X, n_edges)
+    return X
+
+def edge_flips(n_edges):
+    """
+    Returns the orientation (+-1) of each edge for flip_edges: a random ~20% of the edges are flipped (reseeds numpy)
+    """
+    onp.random.seed(1)
+    return onp.random.choice([1, -1], size=n_edges, replace=True, p=[0.8, 0.2])
+
+def model_shifts(B1, B2, model=None, flips=None):
+    """
+    Returns the shift operators of model (HYPERPARAMS['model'] by default) for incidence matrices B1, B2, as SparseShifts
+        if HYPERPARAMS['sparse'], else dense arrays
+
+    :param flips: optional vector of +-1 per edge; if given, edge orientations are flipped (see data_setup)
+    """
+    model = model or HYPERPARAMS['model']
+    if not HYPERPARAMS['sparse'] or model == 'bunch':
+        # dense operators (+ bunch's normalized ones) are computed from dense incidence matrices
+        B1, B2 = [B.toarray() if sparse.issparse(B) else B for B in (B1, B2)]
+    if HYPERPARAMS['sparse']:
+        L1_lower, L1_upper = hodge_laplacians(B1, B2, flips=flips)
+    else:
+        L1_lower = B1.T @ B1
+        L1_upper = B2 @ B2.T
+        if flips is not None:
+            F = np.diag(flips)
+            L1_lower = F @ L1_lower @ F
+            L1_upper = F @ L1_upper @ F
+
+
+    if model == 'scone':
+        shifts = [L1_lower, L1_upper]
+        # shifts = [L1_lower, L1_lower]
+
+    elif model.startswith('scnn'):
+        # powers are applied recursively inside scnn_func
+        shifts = [L1_lower, L1_upper]
+
+    elif model == 'ebli':
+        # powers are applied recursively inside ebli_func
+        shifts = [L1_lower + L1_upper]
+
+    elif model == 'bunch':
+        # S_00, S_01, S_01, S_11, S_21, S_12, S_22
+        shifts = compute_shift_matrices(B1, B2)
+
+    else:
+        raise Exception('invalid model type')
+
+    if HYPERPARAMS['sparse']:
+        shifts = [SparseShift.from_scipy(S) for S in shifts]
+    return shifts
+
 def data_setup(hops=(1,), load=True, folder_suffix='schaub'):
     """
     Imports and sets up flow, target, and shift matrices for model training. Supports generating data for multiple hops
@@ -311,15 +506,14 @@ def data_setup(hops=(1,), load=True, folder_suffix='schaub'):
 
     if HYPERPARAMS['flip_edges']:
         # Flip orientation of a random subset of edges
-        onp.random.seed(1)
         _, _, _, _, _, G_undir, _, _ = load_dataset('trajectory_data_1hop_' + folder_suffix)
-        flips = onp.random.choice([1, -1], size=len(G_undir.edges), replace=True, p=[0.8, 0.2])
-        F = np.diag(flips)
+        flips = edge_flips(len(G_undir.edges))
 
 
     if not load:
         # Generate new data
-        generate_dataset(400, 1000, folder=folder_suffix, holes=HYPERPARAMS['holes'])
+        generate_dataset(int(HYPERPARAMS['n_nodes']), int(HYPERPARAMS['n_walks']), folder=folder_suffix, holes=HYPERPARAMS['holes'],
+                         sparse_flows=bool(HYPERPARAMS['sparse_flows']), walks=HYPERPARAMS['walks'], n_anchors=int(HYPERPARAMS['n_anchors']) or None)
         raise Exception('Data generation done')
 
 
@@ -331,52 +525,16 @@ def data_setup(hops=(1,), load=True, folder_suffix='schaub'):
         target_nodes_all.append(target_nodes)
 
 
-        inputs_all.append([None, onp.array(last_nodes), X])
+        inputs_all.append([None, onp.array(last_nodes), flow_inputs(X, B1.shape[1])])
         y_all.append(y)
 
         # Define shifts
-        L1_lower = B1.T @ B1
-        L1_upper = B2 @ B2.T
-        if HYPERPARAMS['flip_edges']:
-            L1_lower = F @ L1_lower @ F
-            L1_upper = F @ L1_upper @ F
-
-
-        if HYPERPARAMS['model'] == 'scone':
-            shifts = [L1_lower, L1_upper]
-            # shifts = [L1_lower, L1_lower]
-        
-        elif HYPERPARAMS['model'] == 'scnn2':
-            # shifts = [la.matrix_power(L1_lower,i+1) for i in range(HYPERPARAMS['k1_scnn'])]
-            # shifts.append(la.matrix_power(L1_upper,i+1) for i in range(HYPERPARAMS['k2_scnn']))
-            shifts = [L1_lower, L1_lower@L1_lower, L1_upper, L1_upper@L1_upper]
-            #L1 = L1_lower + L1_upper
-            #shifts = [L1, L1 @ L1, L1@L1@L1,L1@L1@L1@L1] # test order 4 ebli _func 
-            
-        elif HYPERPARAMS['model'] == 'scnn3':
-            shifts = [L1_lower, L1_lower@L1_lower, L1_lower@L1_lower@L1_lower,L1_upper, L1_upper@L1_upper, L1_upper@L1_upper@L1_upper]    
-
-        elif HYPERPARAMS['model'] == 'scnn4':
-            shifts = [L1_lower, L1_lower@L1_lower, L1_lower@L1_lower@L1_lower, L1_lower@L1_lower@L1_lower@L1_lower, L1_upper, L1_upper@L1_upper, L1_upper@L1_upper@L1_upper, L1_upper@L1_upper@L1_upper@L1_upper] 
-            
-        elif HYPERPARAMS['model'] == 'ebli':
-            L1 = L1_lower + L1_upper
-            shifts = [L1, L1 @ L1, L1@L1@L1] # L1, L1^2
-
-        elif HYPERPARAMS['model'] == 'bunch':
-            # S_00, S_01, S_01, S_11, S_21, S_12, S_22
-            shifts = compute_shift_matrices(B1, B2)
+        shifts = model_shifts(B1, B2, flips=flips if HYPERPARAMS['flip_edges'] else None)
 
-        else:
-            raise Exception('invalid model type')
-
-    # Build E_lookup for multi-hop training
-    e = onp.nonzero(B1.T)[1]
-    edges = onp.array_split(e, len(e)/2)
-    E, E_lookup = [], {}
-    for i, e in enumerate(edges):
-        E.append(tuple(e))
-        E_lookup[tuple(e)] = i
+    # Build E_lookup for multi-hop training; column i of B1 holds the (sorted) nodes of edge i
+    B1.sort_indices()
+    E = list(map(tuple, B1.indices.reshape((-1, 2))))
+    E_lookup = {e: i for i, e in enumerate(E)}
 
     # set up neighborhood data
     last_nodes = inputs_all[0][1]
@@ -394,32 +552,207 @@ def data_setup(hops=(1,), load=True, folder_suffix='schaub'):
     try:
         prefixes = list(np.load('trajectory_data_1hop_' + folder_suffix + '/prefixes.npy', allow_pickle=True))
     except:
-        prefixes = [flow_to_path(inputs_all[0][-1][i], E, last_nodes[i]) for i in range(len(last_nodes))]
+        X = inputs_all[0][-1]
+        if isinstance(X, tuple):
+            # sparse flows: densify one at a time
+            prefixes = [flow_to_path(onp.bincount(X[0][i], X[1][i], len(E)), E, last_nodes[i]) for i in range(len(last_nodes))]
+        else:
+            prefixes = [flow_to_path(X[i], E, last_nodes[i]) for i in range(len(last_nodes))]
 
-    B1_jax = np.append(B1, np.zeros((1, B1.shape[1])), axis=0)
+    tables = incidence_tables(B1 @ sparse.diags(flips) if HYPERPARAMS['flip_edges'] else B1, nbrhoods)
 
     if HYPERPARAMS['flip_edges']:
-        B1_jax = B1_jax @ F
         for i in range(len(inputs_all)):
+            if HYPERPARAMS['sparse_flows']:
+                idxs, signs = inputs_all[i][-1]
+                inputs_all[i][-1] = (idxs, signs * flips[idxs])
+                continue
             print(inputs_all[i][-1].shape)
-            n_flows, n_edges = inputs_all[i][-1].shape[:2]
-            inputs_all[i][-1] = inputs_all[i][-1].reshape((n_flows, n_edges)) @ F
-            inputs_all[i][-1] = inputs_all[i][-1].reshape((n_flows, n_edges, 1))
-
-    def Bconds_func(n):
-        """
-        Returns rows of B1 corresponding to neighbors of node n
-        """
-        Nv = nbrhoods[n]
-        return B1_jax[Nv]
+            inputs_all[i][-1] = inputs_all[i][-1] * flips[:, None]
 
     for i in range(len(inputs_all)):
-        if HYPERPARAMS['model'] != 'bunch':
-            inputs_all[i][0] = Bconds_func
-        else:
-            inputs_all[i][0] = nbrhoods
+        inputs_all[i][0] = shared_input(nbrhoods, tables)
     
-    return inputs_all, y_all, train_mask, test_mask, shifts, G_undir, E_lookup, nbrhoods, n_nbrs, target_nodes_all, prefixes
+    return inputs_all, y_all, train_mask, test_mask, shifts, G_undir, E_lookup, nbrhoods, n_nbrs, target_nodes_all, prefixes, tables
+
+def incidence_tables(B1, nbrhoods):
+    """
+    Returns the tables the models, rollouts and streaming predictor index B1 through, as a dict:
+        'B1': B1 as a scipy CSC matrix; 'edges': (# edges, 2) nodes of each edge, sorted
+        'node_edges', 'node_signs': incident edges + orientations of each node, for the neighbor-local readout (see
+            incident_edge_tables)
+        'nbr_edges', 'nbr_signs': edge + flow value of each (node, neighbor slot) hop, for multi-hop rollouts (see
+            neighbor_edge_tables)
+
+    :param B1: node-edge incidence matrix (columns flipped, if edges are flipped)
+    :param nbrhoods: padded (# nodes, max degree) neighbor table, padded with -1
+    """
+    node_edges, node_signs = incident_edge_tables(B1)
+    nbr_edges, nbr_signs = neighbor_edge_tables(B1, nbrhoods)
+    B1 = sparse.csc_matrix(B1)
+    B1.sort_indices()
+    return {'B1': B1, 'edges': B1.indices.reshape((-1, 2)), 'node_edges': np.array(node_edges), 'node_signs': np.array(node_signs),
+            'nbr_edges': nbr_edges, 'nbr_signs': nbr_signs}
+
+def shared_input(nbrhoods, tables, model=None):
+    """
+    Returns the model input shared by every sample: the neighbor table for 'bunch', else Bconds_func(n, x), which returns
+        (rows of B1 corresponding to neighbors of node n) @ x, only gathering the entries of x on the edges incident to each
+        neighbor; padded neighbors (-1) select the all-zero padding row
+    """
+    if (model or HYPERPARAMS['model']) == 'bunch':
+        return nbrhoods
+    node_edges, node_signs = tables['node_edges'], tables['node_signs']
+
+    def Bconds_func(n, x):
+        Nv = nbrhoods[n]
+        return np.sum(node_signs[Nv][..., None] * x[node_edges[Nv]], axis=1)
+    return Bconds_func
+
+def build_model(shifts, inputs, y, train_mask, params=HYPERPARAMS):
+    """
+    Returns a Scone_GCN set up for the model + hidden layers set in params (HYPERPARAMS by default), with freshly
+        generated weights
+    """
+    scone = Scone_GCN(params['epochs'], params['learning_rate'], params['batch_size'], params['weight_decay'])
+    in_axes = tuple(([None] * len(shifts)) + [None, None, 0, 0])
+
+    if params['model'] == 'scone':
+        model_func = scone_func
+    elif params['model'] == 'ebli':
+        model_func = ebli_func
+    elif params['model'] == 'bunch':
+        model_func = bunch_func
+    elif params['model'] in ['scnn', 'scnn2', 'scnn3', 'scnn4']:
+        model_func = partial(scnn_func, k1=params['k1_scnn'], k2=params['k2_scnn'])
+    else:
+        raise Exception('invalid model')
+
+
+    if params['model'].startswith('scnn'):
+        scone.setup_scnn(model_func, params['hidden_layers'], params['k1_scnn'], params['k2_scnn'], shifts, inputs, y, in_axes, train_mask, model_type=params['model'], batched=params['batched'], fused=params['fused'], n_members=int(params['ensemble']) or None)
+    else:
+        scone.setup(model_func, params['hidden_layers'], shifts, inputs, y, in_axes, train_mask, model_type=params['model'], batched=params['batched'], fused=params['fused'], n_members=int(params['ensemble']) or None)
+    return scone
+
+def model_file():
+    """
+    Returns the file a model is saved to / loaded from: models/model_name_model_epochs[_regional].npy
+    """
+    return 'models/' + HYPERPARAMS['model_name'] + '_' + HYPERPARAMS['model'] + '_' + str(int(HYPERPARAMS['epochs'])) \
+        + ('_regional' if HYPERPARAMS['regional'] else '') + '.npy'
+
+def artifact_file():
+    """
+    Returns the model artifact file (see save_model) next to model_file(): models/model_name_model_epochs[_regional].scone
+    """
+    return model_file()[:-4] + '.scone'
+
+def save_weights(filename, weights):
+    """
+    Saves a list of weight arrays of different shapes to filename (.npy) as a 1-D object array
+    """
+    weights_obj = onp.empty(len(weights), dtype=object)
+    for i, W in enumerate(weights):
+        weights_obj[i] = onp.asarray(W)
+    onp.save(filename, weights_obj)
+
+def shift_arrays(shifts, arrays, prefix='shift'):
+    """
+    Adds the arrays of shift operators shifts to arrays (dict of name -> numpy array, see save_artifact): the nonzeros +
+        column tables of SparseShifts, or dense arrays, named prefix_i[_field]. Returns the metadata load_shifts needs
+    """
+    shift_meta = []
+    for i, S in enumerate(shifts):
+        if isinstance(S, SparseShift):
+            for name in ('rows', 'cols', 'vals', 'col_rows', 'col_vals'):
+                arrays['{}_{}_{}'.format(prefix, i, name)] = onp.asarray(getattr(S, name))
+            shift_meta.append({'format': 'sparse', 'shape': list(S.shape)})
+        else:
+            arrays['{}_{}'.format(prefix, i)] = onp.asarray(S)
+            shift_meta.append({'format': 'dense', 'shape': list(onp.shape(S))})
+    return shift_meta
+
+def load_shifts(arrays, shift_meta, prefix='shift'):
+    """
+    Inverse of shift_arrays: returns the shift operators stored in arrays
+    """
+    shifts = []
+    for i, meta in enumerate(shift_meta):
+        if meta['format'] == 'sparse':
+            rows, cols, vals, col_rows, col_vals = [np.asarray(arrays['{}_{}_{}'.format(prefix, i, name)]) for name in ('rows', 'cols', 'vals', 'col_rows', 'col_vals')]
+            shifts.append(SparseShift(rows, cols, vals, meta['shape'], col_rows, col_vals))
+        else:
+            shifts.append(np.asarray(arrays['{}_{}'.format(prefix, i)]))
+    return shifts
+
+# hyperparameters that define a trained model, stored in its artifact
+ARTIFACT_PARAMS = ['model', 'hidden_layers', 'k1_scnn', 'k2_scnn', 'sparse', 'batched', 'fused', 'sparse_flows', 'ensemble',
+                   'epochs', 'learning_rate', 'batch_size', 'weight_decay']
+
+def save_model(filename, scone, shifts, nbrhoods, tables):
+    """
+    Saves everything needed to run scone without its dataset to a single model artifact (see model_artifact.py): its
+        weights + the hyperparameters in ARTIFACT_PARAMS, its shift operators (SparseShift nonzeros + column tables, or
+        dense arrays), the neighbor table, the incidence tables of data_setup and the edge index
+
+    :param tables: dict returned by incidence_tables
+    """
+    arrays = {'nbrhoods': onp.asarray(nbrhoods), 'edges': tables['edges'],
+              'B1_indptr': tables['B1'].indptr, 'B1_indices': tables['B1'].indices, 'B1_data': tables['B1'].data}
+    for name in ('node_edges', 'node_signs', 'nbr_edges', 'nbr_signs'):
+        arrays[name] = onp.asarray(tables[name])
+    for i, W in enumerate(scone.weights):
+        arrays['weight_' + str(i)] = onp.asarray(W)
+
+    shift_meta = shift_arrays(shifts, arrays)
+
+    meta = {'params': {key: HYPERPARAMS[key] for key in ARTIFACT_PARAMS}, 'shifts': shift_meta,
+            'n_weights': len(scone.weights), 'B1_shape': list(tables['B1'].shape)}
+    save_artifact(filename, arrays, meta)
+
+def load_model(filename):
+    """
+    Loads a model artifact written by save_model, without loading its dataset; returns (scone, shifts, shared_inputs,
+        nbrhoods, tables, params): shared_inputs are the inputs shared by every sample (see data_setup), so that
+        scone.predict(shifts, shared_inputs + [last_nodes, flows]) runs the model, and params are the model's
+        hyperparameters (HYPERPARAMS, overridden by the ones stored in the artifact)
+    """
+    arrays, meta = load_artifact(filename)
+    params = dict(HYPERPARAMS, **{'ensemble': 0, **meta['params']})
+    params['hidden_layers'] = [tuple(layer) for layer in params['hidden_layers']]
+
+    shifts = load_shifts(arrays, meta['shifts'])
+    if params['model'] == 'ebli':
+        # older ebli artifacts also stored L1^2, L1^3, which ebli_func now applies recursively
+        shifts = shifts[:1]
+
+    B1 = sparse.csc_matrix((arrays['B1_data'], arrays['B1_indices'], arrays['B1_indptr']), shape=meta['B1_shape'])
+    tables = {'B1': B1, 'edges': arrays['edges'], 'node_edges': np.asarray(arrays['node_edges']), 'node_signs': np.asarray(arrays['node_signs']),
+              'nbr_edges': arrays['nbr_edges'], 'nbr_signs': arrays['nbr_signs']}
+    nbrhoods = np.asarray(arrays['nbrhoods'])
+    shared_inputs = [shared_input(nbrhoods, tables, model=params['model'])]
+
+    # weights are replaced right away; setup only needs the # of flow channels and outputs
+    weights = [np.asarray(arrays['weight_' + str(i)]) for i in range(meta['n_weights'])]
+    W = weights[0][0] if params['ensemble'] else weights[0]
+    in_channels = W.shape[-2] if W.ndim == 3 else W.shape[0]
+    dummy_flows = (onp.zeros((1, 1), dtype=int), onp.zeros((1, 1))) if params['sparse_flows'] else onp.zeros((1, B1.shape[1], in_channels))
+    scone = build_model(shifts, shared_inputs + [onp.zeros(1, dtype=int), dummy_flows], onp.zeros((1, 1, weights[-1].shape[-1])), onp.ones(1), params=params)
+    scone.weights = weights
+    return scone, shifts, shared_inputs, nbrhoods, tables, params
+
+def load_weights(scone):
+    """
+    Loads the weights saved in model_file() into scone, converted to its weight layout
+    """
+    n_k = scone.weights[0].shape[0] # # of shifts per layer, if the freshly generated weights are fused
+    scone.weights = onp.load(model_file(), allow_pickle=True)
+    print('load successful')
+    if HYPERPARAMS['fused'] and scone.weights[0].ndim == 2:
+        # weights were saved in the per-shift layout
+        scone.weights = fuse_weights(scone.weights, n_k)
+    scone.weights = list(scone.weights)
 
 ##
 def train_model():
@@ -428,14 +761,12 @@ def train_model():
     """
 
     # load dataset
-    inputs_all, y_all, train_mask, test_mask, shifts, G_undir, E_lookup, nbrhoods, n_nbrs, target_nodes_all, prefixes = data_setup(hops=(1,2), load=HYPERPARAMS['load_data'], folder_suffix=HYPERPARAMS['data_folder_suffix'])
+    inputs_all, y_all, train_mask, test_mask, shifts, G_undir, E_lookup, nbrhoods, n_nbrs, target_nodes_all, prefixes, tables = data_setup(hops=(1,2), load=HYPERPARAMS['load_data'], folder_suffix=HYPERPARAMS['data_folder_suffix'])
 
     (inputs_1hop, inputs_2hop), (y_1hop, y_2hop) = inputs_all, y_all
     #print(len(inputs_1hop), len(y_1hop))
     last_nodes = inputs_1hop[1]
 
-    in_axes = tuple(([None] * len(shifts)) + [None, None, 0, 0])
-
     # Train Markov model
     if HYPERPARAMS['markov'] == 1:
         order = 1
@@ -536,28 +867,7 @@ def train_model():
         raise Exception
 
     # Initialize model
-    scone = Scone_GCN(HYPERPARAMS['epochs'], HYPERPARAMS['learning_rate'], HYPERPARAMS['batch_size'], HYPERPARAMS['weight_decay'])
-
-    if HYPERPARAMS['model'] == 'scone':
-        model_func = scone_func
-    elif HYPERPARAMS['model'] == 'ebli':
-        model_func = ebli_func
-    elif HYPERPARAMS['model'] == 'bunch':
-        model_func = bunch_func
-    elif HYPERPARAMS['model'] == 'scnn2':
-        model_func = scnn_func_2
-    elif HYPERPARAMS['model'] == 'scnn3':
-        model_func = scnn_func_3
-    elif HYPERPARAMS['model'] == 'scnn4':
-        model_func = scnn_func_4
-    else:
-        raise Exception('invalid model')
-
-
-    if HYPERPARAMS['model'] == 'scnn2' or HYPERPARAMS['model'] == 'scnn3' or HYPERPARAMS['model'] == 'scnn4':
-        scone.setup_scnn(model_func, HYPERPARAMS['hidden_layers'], HYPERPARAMS['k1_scnn'], HYPERPARAMS['k2_scnn'], shifts, inputs_1hop, y_1hop, in_axes, train_mask, model_type=HYPERPARAMS['model'])
-    else:
-        scone.setup(model_func, HYPERPARAMS['hidden_layers'], shifts, inputs_1hop, y_1hop, in_axes, train_mask, model_type=HYPERPARAMS['model'])
+    scone = build_model(shifts, inputs_1hop, y_1hop, train_mask)
 
     if HYPERPARAMS['regional']:
         # Train either on upper region only or all data (synthetic dataset)
@@ -573,12 +883,7 @@ def train_model():
 
     # load a model from file + train it more
     if HYPERPARAMS['load_model']:
-        if HYPERPARAMS['regional']:
-            scone.weights = onp.load('models/' + HYPERPARAMS['model_name'] + '_' + HYPERPARAMS['model'] + '_' + str(int(HYPERPARAMS['epochs'])) + '_regional' + '.npy', allow_pickle=True)
-            print('load successful')
-        else:
-            scone.weights = onp.load('models/' + HYPERPARAMS['model_name'] + '_' + HYPERPARAMS['model'] + '_' + str(int(HYPERPARAMS['epochs'])) + '.npy', allow_pickle=True)
-            print('load successful')
+        load_weights(scone)
         # if HYPERPARAMS['epochs'] != 0:
         #     # train model for additional epochs
         #     scone.train(inputs_1hop, y_1hop, train_mask, test_mask, n_nbrs)
@@ -587,46 +892,73 @@ def train_model():
         #     except:
         #         pass
         #     onp.save('models/' + HYPERPARAMS['model_name'] + '_' + HYPERPARAMS['model'] + '_' + str(HYPERPARAMS['epochs']), scone.weights)
-
-        (test_loss, test_acc) = scone.test(inputs_1hop, y_1hop, test_mask, n_nbrs)
-        print('test successful')
     else:
 
-        train_loss, train_acc, test_loss, test_acc = scone.train(inputs_1hop, y_1hop, train_mask, test_mask, n_nbrs)
+        train_loss, train_acc, test_loss, test_acc = scone.train(inputs_1hop, y_1hop, train_mask, test_mask, n_nbrs, scan_epochs=HYPERPARAMS['scan_epochs'], n_devices=int(HYPERPARAMS['devices']))
 
         try:
             os.mkdir('models')
         except:
             pass
-        if HYPERPARAMS['regional']:
-            onp.save('models/' + HYPERPARAMS['model_name'] + '_' + HYPERPARAMS['model'] + '_' + str(int(HYPERPARAMS['epochs'])) + '_regional', scone.weights)
-        else: 
-            onp.save('models/' + HYPERPARAMS['model_name'] + '_' + HYPERPARAMS['model'] + '_' + str(int(HYPERPARAMS['epochs'])), scone.weights)
+        save_weights(model_file()[:-4], scone.weights)
+        save_model(artifact_file(), scone, shifts, nbrhoods, tables)
 
-    # standard experiment
+    # standard experiment; one forward pass over the flows for every metric + mask
+    report = scone.evaluate(shifts, inputs_1hop, y_1hop, {'train': train_mask, 'test': test_mask}, n_nbrs)
     print('standard test set:')
-    scone.test(inputs_1hop, y_1hop, test_mask, n_nbrs)
-    
-    train_2target, test_2target = scone.two_target_accuracy(shifts, inputs_1hop, y_1hop, train_mask, n_nbrs), scone.two_target_accuracy(shifts, inputs_1hop, y_1hop, test_mask, n_nbrs)
-
-    print('2-target accs:', train_2target, test_2target)
+    print("Test loss: {:.6f}, Test acc: {:.3f}".format(report['test']['loss'], report['test']['acc']))
+    print('2-target accs:', report['train']['2target'], report['test']['2target'])
+    if HYPERPARAMS['ensemble']:
+        member_accs = [member['test']['acc'] for member in scone.evaluate_members(shifts, inputs_1hop, y_1hop, {'test': test_mask}, n_nbrs)]
+        print('Ensemble of {}: member test accs: {} (mean {:.3f}, std {:.3f})'.format(len(member_accs), ', '.join('{:.3f}'.format(acc) for acc in member_accs),
+                                                                                   onp.mean(member_accs), onp.std(member_accs)))
 
 
     if HYPERPARAMS['reverse']:
         # reverse direction of test flows
         rev_flows_in, rev_targets_1hop, rev_targets_2hop, rev_last_nodes = \
-            onp.load('trajectory_data_1hop_' + HYPERPARAMS['data_folder_suffix'] + '/rev_flows_in.npy'), onp.load('trajectory_data_1hop_' + HYPERPARAMS['data_folder_suffix'] + '/rev_targets.npy'), \
+            flow_inputs(load_flows('trajectory_data_1hop_' + HYPERPARAMS['data_folder_suffix'] + '/rev_flows_in'), len(G_undir.edges)), onp.load('trajectory_data_1hop_' + HYPERPARAMS['data_folder_suffix'] + '/rev_targets.npy'), \
             onp.load('trajectory_data_2hop_' + HYPERPARAMS['data_folder_suffix'] + '/rev_targets.npy'), onp.load('trajectory_data_1hop_' + HYPERPARAMS['data_folder_suffix'] + '/rev_last_nodes.npy')
         rev_n_nbrs = [len(neighborhood(G_undir, n)) for n in rev_last_nodes]
+        rev_report = scone.evaluate(shifts, [inputs_1hop[0], rev_last_nodes, rev_flows_in], rev_targets_1hop, {'test': test_mask}, rev_n_nbrs, metrics=('loss', 'acc'))
         print('Reverse experiment:')
-        scone.test([inputs_1hop[0], rev_last_nodes, rev_flows_in], rev_targets_1hop, test_mask, rev_n_nbrs)
+        print("Test loss: {:.6f}, Test acc: {:.3f}".format(rev_report['test']['loss'], rev_report['test']['acc']))
+
+
+
+    if HYPERPARAMS['streaming']:
+        # predict the next node after every hop of each test trajectory, updating the first layer incrementally
+        predictor = Streaming_Predictor(scone, *streaming_operators(shifts), tables['B1'], nbrhoods)
+        preds = scone.predict(shifts, inputs_1hop)
+
+        hop_times, full_times, max_diff = [], [], 0.
+        for i in onp.where(onp.asarray(test_mask) == 1)[0]:
+            trajectory = predictor.start(prefixes[i][0])
+            for node in prefixes[i][1:]:
+                start = time.perf_counter()
+                predictor.push(trajectory, node)
+                pred = predictor.predict(trajectory).block_until_ready()
+                hop_times.append(time.perf_counter() - start)
 
+            start = time.perf_counter()
+            scone.predict(shifts, scone.gather(inputs_1hop, y_1hop, onp.array([i]))[0]).block_until_ready()
+            full_times.append(time.perf_counter() - start)
+            max_diff = max(max_diff, float(np.max(np.abs(pred - preds[i]))))
 
+        # skip the first (compiling) calls
+        print('Streaming: {:.1f} us / hop (update + prediction), full forward: {:.1f} us; max diff vs full forward: {:.2e}'
+              .format(1e6 * onp.median(hop_times[10:]), 1e6 * onp.median(full_times[1:]), max_diff))
 
-    # print('Multi hop accs:',
-    #       scone.multi_hop_accuracy_dist(shifts, inputs_1hop, target_nodes_all[1], [train_mask, test_mask], nbrhoods,
-    #                                     E_lookup, last_nodes, prefixes, 2))
+    if HYPERPARAMS['multi_hop']:
+        print('Greedy 2-hop accs:', [scone.multi_hop_accuracy_binary(shifts, inputs_1hop, y_2hop, mask, nbrhoods, tables['nbr_edges'], tables['nbr_signs'], 2) for mask in (train_mask, test_mask)])
+        print('Multi hop accs:', scone.multi_hop_accuracy_dist(shifts, inputs_1hop, target_nodes_all[1], [train_mask, test_mask], nbrhoods, tables['nbr_edges'], tables['nbr_signs'], 2))
+        paths, _, reach_probs = scone.rollout(shifts, inputs_1hop, nbrhoods, tables['nbr_edges'], tables['nbr_signs'], 2, beam_width=HYPERPARAMS['beam_width'] or None,
+                                              top_k=1, target_nodes=target_nodes_all[1])
+        correct = paths[:, 0, -1] == target_nodes_all[1]
+        print('2-hop beam search: top path acc (train, test): {:.3f}, {:.3f}; target reach prob (train, test): {:.3f}, {:.3f}'
+              .format(correct[train_mask == 1].mean(), correct[test_mask == 1].mean(), reach_probs[train_mask == 1].mean(), reach_probs[test_mask == 1].mean()))
 
 
 if __name__ == '__main__':
+    configure()
     train_model()
\ No newline at end of file